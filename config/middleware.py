@@ -1,3 +1,16 @@
+import logging
+import random
+import time
+import uuid
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.urls import Resolver404, resolve
+from pdf_editor import log, profiling
+
+
+logger = logging.getLogger('pdf_editor.requests')
+
+
 class DisableXFrameOptionsMiddleware:
     def __init__(self, get_response):
         self.get_response = get_response
@@ -9,4 +22,101 @@ class DisableXFrameOptionsMiddleware:
         if request.path.startswith('/media/'):
             response.headers.pop('X-Frame-Options', None)
         
-        return response
\ No newline at end of file
+        return response
+
+
+class RequestLogMiddleware:
+    """
+    Give every request an id and log one line when it finishes
+
+    The id is taken from the X-Request-ID header when a proxy set one,
+    returned in the response header, and attached to every log record
+    emitted while the request is handled, together with the document id
+    and operation once the view is resolved.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        started = time.perf_counter()
+        request.request_id = request.headers.get('X-Request-ID') or uuid.uuid4().hex
+        # Left set after the response so Django's own request logging,
+        # which runs outside the middleware, still carries the id
+        log.request_id.set(request.request_id)
+        log.document_id.set(None)
+        log.operation.set(None)
+        log.sample_debug(settings.PDF_LOG_DEBUG_SAMPLE_RATE)
+
+        response = self.get_response(request)
+        response['X-Request-ID'] = request.request_id
+        logger.info('%s %s %s', request.method, request.path, response.status_code, extra={
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'duration_ms': round((time.perf_counter() - started) * 1000, 1),
+        })
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if 'pk' in view_kwargs:
+            log.document_id.set(str(view_kwargs['pk']))
+        # ViewSet actions map HTTP methods to names such as 'rotate'
+        actions = getattr(view_func, 'actions', None) or {}
+        op = actions.get(request.method.lower())
+        if op is None and request.resolver_match is not None:
+            op = request.resolver_match.url_name
+        log.operation.set(op)
+        return None
+
+
+class ProfilingMiddleware:
+    """
+    Profile selected PDFDocumentViewSet requests with cProfile and tracemalloc
+
+    A request is profiled when its X-Profile-Token header matches
+    PDF_PROFILE_TOKEN, or when it is picked at PDF_PROFILE_SAMPLE_RATE.
+    The web process and every pool job of the request store a capture
+    under the request id in PDF_PROFILE_DIR; download them from
+    /api/profiles/<id>/. Requests with the token get the id back as
+    X-Profile-ID, sampled ones only log it. With neither setting
+    configured Django drops the middleware at startup, so it costs nothing.
+    """
+
+    def __init__(self, get_response):
+        if not settings.PDF_PROFILE_TOKEN and settings.PDF_PROFILE_SAMPLE_RATE <= 0:
+            raise MiddlewareNotUsed
+        from pdf_editor.views import PDFDocumentViewSet
+        self.get_response = get_response
+        self.viewset = PDFDocumentViewSet
+
+    def __call__(self, request):
+        token = request.headers.get('X-Profile-Token')
+        if token:
+            requested = profiling.token_matches(token)
+            selected = requested
+        else:
+            requested = False
+            selected = random.random() < settings.PDF_PROFILE_SAMPLE_RATE
+        if not selected or not self.is_document_view(request):
+            return self.get_response(request)
+
+        with profiling.capture('web', f'{request.method} {request.path}') as active:
+            context_token = log.profiled.set(active)
+            try:
+                response = self.get_response(request)
+            finally:
+                log.profiled.reset(context_token)
+        if active and requested:
+            response['X-Profile-ID'] = profiling.profile_id()
+        elif active:
+            logger.info('Sampled request profiled as %s', profiling.profile_id())
+        return response
+
+    def is_document_view(self, request):
+        try:
+            match = resolve(request.path_info)
+        except Resolver404:
+            return False
+        view_class = getattr(match.func, 'cls', None)
+        return view_class is not None and issubclass(view_class, self.viewset)
@@ -53,6 +53,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'config.middleware.RequestLogMiddleware',
+    'config.middleware.ProfilingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -89,7 +91,14 @@ WSGI_APPLICATION = 'config.wsgi.application'
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+        'NAME': os.environ.get('SQLITE_PATH', BASE_DIR / 'db.sqlite3'),
+        # Take the write lock when a transaction starts, so concurrent
+        # edits from several workers wait for each other instead of
+        # failing with "database is locked"
+        'OPTIONS': {
+            'transaction_mode': 'IMMEDIATE',
+            'timeout': 20,
+        },
     }
 }
 
@@ -130,16 +139,169 @@ USE_TZ = True
 
 STATIC_URL = '/static/'
 STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
-STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
 
 # Media Files
 MEDIA_URL = '/media/'
-MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
+MEDIA_ROOT = os.environ.get('MEDIA_ROOT', os.path.join(BASE_DIR, 'media'))
+
+# Storage for uploaded and generated PDFs: 'local' (MEDIA_ROOT) or 's3'
+# for any S3-compatible store (AWS, MinIO, ...)
+PDF_STORAGE_BACKEND = os.environ.get('PDF_STORAGE_BACKEND', 'local')
+
+STORAGES = {
+    'default': {
+        'BACKEND': 'pdf_editor.storage.LocalPDFStorage',
+    },
+    'staticfiles': {
+        'BACKEND': 'whitenoise.storage.CompressedManifestStaticFilesStorage',
+    },
+}
+
+if PDF_STORAGE_BACKEND == 's3':
+    STORAGES['default'] = {
+        'BACKEND': 'pdf_editor.s3_storage.S3PDFStorage',
+        'OPTIONS': {
+            'bucket_name': os.environ.get('AWS_STORAGE_BUCKET_NAME'),
+            'endpoint_url': os.environ.get('AWS_S3_ENDPOINT_URL'),
+            'region_name': os.environ.get('AWS_S3_REGION_NAME'),
+            'access_key': os.environ.get('AWS_ACCESS_KEY_ID'),
+            'secret_key': os.environ.get('AWS_SECRET_ACCESS_KEY'),
+            'file_overwrite': False,
+        },
+    }
+
+PDF_S3_MULTIPART_THRESHOLD = int(os.environ.get('PDF_S3_MULTIPART_THRESHOLD', 8 * 1024 * 1024))
+PDF_S3_MULTIPART_CHUNK_SIZE = int(os.environ.get('PDF_S3_MULTIPART_CHUNK_SIZE', 8 * 1024 * 1024))
+
+# Local read-through cache for files kept in remote storage
+PDF_STORAGE_CACHE_DIR = os.environ.get('PDF_STORAGE_CACHE_DIR', os.path.join(BASE_DIR, '.storage_cache'))
+PDF_STORAGE_CACHE_MAX_BYTES = int(os.environ.get('PDF_STORAGE_CACHE_MAX_BYTES', 2 * 1024 ** 3))
+
+# File delivery for downloads and /media/:
+#   'sendfile'         - FileResponse, sent with os.sendfile() by gunicorn
+#   'python'           - stream chunks from Python (works everywhere)
+#   'x-accel-redirect' - let nginx send the file from an internal location
+#   'x-sendfile'       - let Apache/lighttpd send the file
+PDF_FILE_DELIVERY = os.environ.get('PDF_FILE_DELIVERY', 'sendfile')
+PDF_X_ACCEL_REDIRECT_PREFIX = os.environ.get('PDF_X_ACCEL_REDIRECT_PREFIX', '/protected-media/')
 
 # File Upload Settings
 FILE_UPLOAD_MAX_MEMORY_SIZE = 52428800  # 50MB
 DATA_UPLOAD_MAX_MEMORY_SIZE = 52428800  # 50MB
 
+# Document versions: chains deeper than this are flattened into one file
+PDF_VERSION_MAX_DEPTH = int(os.environ.get('PDF_VERSION_MAX_DEPTH', '20'))
+
+# Lock files serializing in-place edits of a document on databases without
+# SELECT ... FOR UPDATE (SQLite); must be shared by all web workers
+PDF_LOCK_DIR = os.environ.get('PDF_LOCK_DIR', os.path.join(BASE_DIR, '.locks'))
+
+# Prime views and MuPDF when the WSGI app is loaded (see gunicorn.conf.py)
+PDF_WARMUP = os.environ.get('PDF_WARMUP', 'True') == 'True'
+
+# Worker processes used for parallel PDF operations
+PDF_WORKER_PROCESSES = int(os.environ.get('PDF_WORKER_PROCESSES', min(4, os.cpu_count() or 1)))
+
+# Limits for each worker process, so a malformed or hostile PDF costs one
+# job rather than a web worker. 0 disables a limit.
+#   MEMORY_LIMIT - address space in bytes (RLIMIT_AS)
+#   CPU_LIMIT    - CPU seconds per job (RLIMIT_CPU)
+#   JOB_TIMEOUT  - wall-clock seconds per job; keep below gunicorn's timeout
+#   MAX_TASKS    - jobs before a worker is replaced by a fresh process
+PDF_WORKER_MEMORY_LIMIT = int(os.environ.get('PDF_WORKER_MEMORY_LIMIT', 2 * 1024 ** 3))
+PDF_WORKER_CPU_LIMIT = int(os.environ.get('PDF_WORKER_CPU_LIMIT', '60'))
+PDF_WORKER_JOB_TIMEOUT = int(os.environ.get('PDF_WORKER_JOB_TIMEOUT', '90'))
+PDF_WORKER_MAX_TASKS = int(os.environ.get('PDF_WORKER_MAX_TASKS', '50'))
+
+# Run SimplePDFEditor operations in the limited worker processes instead
+# of the web worker. When off, all of them, including bulk, extraction,
+# export and split jobs, run inline one after another (development, tests)
+PDF_WORKER_ISOLATION = os.environ.get('PDF_WORKER_ISOLATION', 'True') == 'True'
+
+# Merge writes font and image streams shared by the inputs only once,
+# unless a request sets "dedup": false
+PDF_MERGE_DEDUP = os.environ.get('PDF_MERGE_DEDUP', 'True') == 'True'
+
+# Maximum number of documents accepted by one bulk request
+PDF_BULK_MAX_DOCUMENTS = int(os.environ.get('PDF_BULK_MAX_DOCUMENTS', '500'))
+
+# Logging: one JSON object per line on stdout, written from a background
+# thread. PDF_LOG_FORMAT=text gives plain lines for local development.
+# Per-page detail is logged at DEBUG; with PDF_LOG_LEVEL=DEBUG only a
+# PDF_LOG_DEBUG_SAMPLE_RATE fraction of requests emit it.
+PDF_LOG_LEVEL = os.environ.get('PDF_LOG_LEVEL', 'INFO')
+PDF_LOG_FORMAT = os.environ.get('PDF_LOG_FORMAT', 'json')
+PDF_LOG_DEBUG_SAMPLE_RATE = float(os.environ.get('PDF_LOG_DEBUG_SAMPLE_RATE', '1.0'))
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'filters': {
+        'context': {'()': 'pdf_editor.log.ContextFilter'},
+        'debug_sampling': {'()': 'pdf_editor.log.DebugSamplingFilter'},
+    },
+    'formatters': {
+        'json': {'()': 'pdf_editor.log.JSONFormatter'},
+        'text': {'format': '%(asctime)s %(levelname)s %(name)s [%(request_id)s] %(message)s'},
+    },
+    'handlers': {
+        'console': {
+            '()': 'pdf_editor.log.QueuedStreamHandler',
+            'formatter': PDF_LOG_FORMAT,
+            'filters': ['context', 'debug_sampling'],
+        },
+    },
+    'root': {
+        'handlers': ['console'],
+        'level': 'WARNING',
+    },
+    'loggers': {
+        'django': {'level': 'INFO', 'propagate': True},
+        'pdf_editor': {'level': PDF_LOG_LEVEL, 'propagate': True},
+    },
+}
+
+# Profiling of document API requests (config.middleware.ProfilingMiddleware):
+# requests with an X-Profile-Token header equal to PDF_PROFILE_TOKEN, and a
+# PDF_PROFILE_SAMPLE_RATE fraction of the rest, are profiled. The token is
+# also required to list and download profiles. Leave both unset to disable.
+PDF_PROFILE_TOKEN = os.environ.get('PDF_PROFILE_TOKEN', '')
+PDF_PROFILE_SAMPLE_RATE = float(os.environ.get('PDF_PROFILE_SAMPLE_RATE', '0'))
+# Captures are stored here, outside MEDIA_ROOT; shared by all workers
+PDF_PROFILE_DIR = os.environ.get('PDF_PROFILE_DIR', os.path.join(BASE_DIR, '.profiles'))
+
+# Page image export: highest dpi accepted, pages rendered per pool job, and
+# memory the pixmaps of concurrently running jobs may use in total
+PDF_RASTER_MAX_DPI = int(os.environ.get('PDF_RASTER_MAX_DPI', '600'))
+PDF_RASTER_CHUNK_PAGES = int(os.environ.get('PDF_RASTER_CHUNK_PAGES', '4'))
+PDF_RASTER_MEMORY_LIMIT = int(os.environ.get('PDF_RASTER_MEMORY_LIMIT', 512 * 1024 ** 2))
+
+# Caches; page text/layout extraction results are kept on disk so all
+# workers share them
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'pdf_extraction': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.environ.get('PDF_EXTRACTION_CACHE_DIR', os.path.join(BASE_DIR, '.extraction_cache')),
+        'TIMEOUT': int(os.environ.get('PDF_EXTRACTION_CACHE_TIMEOUT', 7 * 24 * 3600)),
+        'OPTIONS': {
+            # One entry per PDF_EXTRACTION_CHUNK_PAGES pages; the file cache
+            # lists every entry on each set() to cull, so keep this modest
+            'MAX_ENTRIES': int(os.environ.get('PDF_EXTRACTION_CACHE_MAX_ENTRIES', '5000')),
+        },
+    },
+}
+
+PDF_EXTRACTION_CACHE = 'pdf_extraction'
+
+# Extraction results are cached in chunks of PDF_EXTRACTION_CHUNK_PAGES
+# pages; at least PDF_EXTRACTION_PARALLEL_MIN_PAGES uncached pages are
+# extracted one chunk per job across the worker pool
+PDF_EXTRACTION_PARALLEL_MIN_PAGES = int(os.environ.get('PDF_EXTRACTION_PARALLEL_MIN_PAGES', '64'))
+PDF_EXTRACTION_CHUNK_PAGES = int(os.environ.get('PDF_EXTRACTION_CHUNK_PAGES', '32'))
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
@@ -175,6 +337,7 @@ CORS_ALLOW_HEADERS = [
     'origin',
     'user-agent',
     'x-csrftoken',
+    'x-profile-token',
     'x-requested-with',
 ]
 
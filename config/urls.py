@@ -1,7 +1,8 @@
 from django.contrib import admin
-from django.urls import path, include
+from django.urls import path, re_path, include
 from django.conf import settings
 from django.conf.urls.static import static
+from pdf_editor.views import media_file
 
 urlpatterns = [
     path('admin/', admin.site.urls),
@@ -10,4 +11,9 @@ urlpatterns = [
 
 # THIS IS CRITICAL FOR MEDIA FILES TO WORK
 if settings.DEBUG:
-    urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
\ No newline at end of file
+    urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+else:
+    # Production: hand media off to the configured delivery backend
+    urlpatterns += [
+        re_path(r'^%s(?P<path>.+)$' % settings.MEDIA_URL.lstrip('/'), media_file),
+    ]
\ No newline at end of file
@@ -9,8 +9,15 @@ https://docs.djangoproject.com/en/5.2/howto/deployment/wsgi/
 
 import os
 
+from django.conf import settings
 from django.core.wsgi import get_wsgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
 
 application = get_wsgi_application()
+
+# With gunicorn's preload_app this runs once in the master before workers
+# are forked, so every worker starts with views imported and MuPDF primed.
+if settings.PDF_WARMUP:
+    from pdf_editor.warmup import warm_up
+    warm_up()
@@ -0,0 +1,44 @@
+"""
+Gunicorn settings
+
+Loaded automatically from the working directory; every value can be
+overridden on the command line or through GUNICORN_CMD_ARGS.
+"""
+
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+workers = int(os.environ.get('WEB_CONCURRENCY', '2'))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', '120'))
+graceful_timeout = 30
+keepalive = 5
+
+# Import Django, DRF and PyMuPDF once in the master and warm them up
+# (config/wsgi.py) before forking, instead of once per worker on its
+# first request. Workers share the imported code copy-on-write.
+preload_app = True
+
+loglevel = os.environ.get('GUNICORN_LOG_LEVEL', 'info')
+accesslog = '-'
+errorlog = '-'
+
+
+def post_fork(server, worker):
+    # Connections opened while preloading must not be shared across workers
+    from django.db import connections
+    connections.close_all()
+
+    # Each worker has its own PDF pool; start it before taking requests
+    from django.conf import settings
+    if settings.PDF_WARMUP:
+        from pdf_editor.worker_pool import prime_pool
+        state = prime_pool()
+        if state['primed']:
+            server.log.info("PDF worker pool primed in %.3fs", state['seconds'])
+
+
+def when_ready(server):
+    from pdf_editor.warmup import warm_state
+    state = warm_state()
+    if state['warm']:
+        server.log.info("Application preloaded and warmed up in %.3fs", state['seconds'])
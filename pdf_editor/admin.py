@@ -1,9 +1,16 @@
 from django.contrib import admin
-from .models import PDFDocument
+from .models import PDFDocument, DocumentVersion
 
 @admin.register(PDFDocument)
 class PDFDocumentAdmin(admin.ModelAdmin):
     list_display = ['title', 'file_size', 'created_at']
     list_filter = ['created_at']
     search_fields = ['title']
+    readonly_fields = ['id', 'created_at']
+
+@admin.register(DocumentVersion)
+class DocumentVersionAdmin(admin.ModelAdmin):
+    list_display = ['document', 'number', 'operation', 'size', 'created_at']
+    list_filter = ['operation', 'created_at']
+    search_fields = ['document__title', 'content_hash']
     readonly_fields = ['id', 'created_at']
\ No newline at end of file
@@ -0,0 +1,101 @@
+import os
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.storage import default_storage
+from django.http import FileResponse, HttpResponse, HttpResponseRedirect, StreamingHttpResponse
+from .storage import is_local
+
+
+CHUNK_SIZE = 256 * 1024
+
+
+def _read_chunks(path, size=None):
+    remaining = os.path.getsize(path) if size is None else size
+    with open(path, 'rb') as f:
+        while remaining > 0:
+            chunk = f.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def _sendfile_response(path):
+    # FileResponse hands the open file to the server's wsgi.file_wrapper,
+    # which gunicorn implements with os.sendfile().
+    return FileResponse(open(path, 'rb'))
+
+
+def _python_response(path, size=None):
+    response = StreamingHttpResponse(_read_chunks(path, size))
+    response['Content-Length'] = os.path.getsize(path) if size is None else size
+    return response
+
+
+def _x_accel_redirect_response(path):
+    relative_path = os.path.relpath(path, settings.MEDIA_ROOT).replace(os.sep, '/')
+    response = HttpResponse()
+    response['X-Accel-Redirect'] = settings.PDF_X_ACCEL_REDIRECT_PREFIX.rstrip('/') + '/' + relative_path
+    return response
+
+
+def _x_sendfile_response(path):
+    response = HttpResponse()
+    response['X-Sendfile'] = os.path.abspath(path)
+    return response
+
+
+BACKENDS = {
+    'sendfile': _sendfile_response,
+    'python': _python_response,
+    'x-accel-redirect': _x_accel_redirect_response,
+    'x-sendfile': _x_sendfile_response,
+}
+
+
+def serve_file(path, filename=None, as_attachment=False, content_type='application/pdf', size=None):
+    """
+    Build a response delivering a file from MEDIA_ROOT
+
+    The PDF_FILE_DELIVERY setting selects who moves the bytes: the front
+    proxy ('x-accel-redirect', 'x-sendfile'), the WSGI server via
+    sendfile ('sendfile'), or a plain Python loop ('python').
+
+    Args:
+        path: Absolute path of the file
+        filename: Name for Content-Disposition, defaults to the basename
+        as_attachment: Send 'attachment' instead of 'inline'
+        content_type: MIME type of the file
+        size: Only send the first `size` bytes; a file holding more than
+            that, e.g. an append not yet recorded as a version, is streamed
+            from Python whatever the backend
+
+    Returns:
+        HttpResponse
+    """
+    backend = BACKENDS.get(settings.PDF_FILE_DELIVERY)
+    if backend is None:
+        raise ImproperlyConfigured(
+            f"PDF_FILE_DELIVERY must be one of: {', '.join(BACKENDS)}"
+        )
+
+    if size is not None and size < os.path.getsize(path):
+        response = _python_response(path, size)
+    else:
+        response = backend(path)
+    response['Content-Type'] = content_type
+    disposition = 'attachment' if as_attachment else 'inline'
+    response['Content-Disposition'] = f'{disposition}; filename="{filename or os.path.basename(path)}"'
+    return response
+
+
+def serve_stored(name, filename=None, **kwargs):
+    """
+    Like serve_file, for a file in default storage
+
+    Files in remote storage are not proxied: the client is redirected to
+    the storage URL (a signed URL for private S3 buckets).
+    """
+    if is_local():
+        return serve_file(default_storage.path(name), filename=filename or os.path.basename(name), **kwargs)
+    return HttpResponseRedirect(default_storage.url(name))
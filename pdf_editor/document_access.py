@@ -0,0 +1,66 @@
+import hashlib
+import mmap
+import os
+from contextlib import contextmanager
+import fitz  # PyMuPDF
+from .storage import local_path
+
+
+def open_pdf(source, size=None):
+    """
+    Open a PDF from a FieldFile or a path
+
+    Stored files are resolved through pdf_editor.storage, so remote files
+    come from the local read-through cache. Whole files are opened by path
+    so MuPDF reads them lazily instead of holding a copy in memory; a
+    `size` shorter than the file (an older version sharing its file with
+    later ones) is opened from that prefix.
+
+    Args:
+        source: FieldFile or filesystem path
+        size: Number of leading bytes that make up the document
+
+    Returns:
+        fitz.Document
+    """
+    path = source if isinstance(source, str) else local_path(source.name)
+    if size is None or size >= os.path.getsize(path):
+        return fitz.open(path)
+
+    with map_file(path, size) as buffer:
+        return fitz.open(stream=bytes(buffer), filetype='pdf')
+
+
+@contextmanager
+def map_file(path, size=None):
+    """
+    Map a file read-only and yield a memoryview of its first `size` bytes
+
+    The view must not be used after the block exits.
+    """
+    with open(path, 'rb') as f:
+        file_size = os.fstat(f.fileno()).st_size
+        length = file_size if size is None else min(size, file_size)
+        if length == 0:
+            yield memoryview(b'')
+            return
+
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(mapped)[:length]
+        try:
+            yield view
+        finally:
+            view.release()
+            mapped.close()
+
+
+def file_sha256(path, size=None):
+    """
+    Hash a file, or only its first `size` bytes
+
+    Returns:
+        str: Hex digest
+    """
+    with map_file(path, size) as buffer:
+        return hashlib.sha256(buffer).hexdigest()
+
@@ -0,0 +1,103 @@
+import json
+import logging
+from django.conf import settings
+from django.core.cache import caches
+from .storage import local_path
+from .worker_pool import call, submit, result
+
+
+logger = logging.getLogger(__name__)
+
+EXTRACTION_MODES = ('text', 'blocks')
+
+
+def cache_key(content_hash, mode, chunk):
+    return f"pdf:{mode}:{content_hash}:{chunk}"
+
+
+def iter_page_content(version, pages, mode):
+    """
+    Yield (page_num, content) for the given pages of a head version
+
+    Results are cached per content hash and chunk of
+    PDF_EXTRACTION_CHUNK_PAGES pages, so any document with the same bytes
+    reuses them and the cache sees one entry per chunk rather than per
+    page. An entry holds the pages of its chunk extracted so far. Uncached
+    pages of large requests are extracted one chunk per job across the
+    worker pool, those of small ones in one job; output order always
+    follows `pages`.
+
+    Args:
+        version: Head DocumentVersion of the document
+        pages: PageSet or list of 0-indexed page numbers
+        mode: 'text' or 'blocks'
+    """
+    cache = caches[settings.PDF_EXTRACTION_CACHE]
+    chunk_pages = settings.PDF_EXTRACTION_CHUNK_PAGES
+
+    # Position of the last page needing each chunk, after which it is dropped
+    last_use = {page_num // chunk_pages: i for i, page_num in enumerate(pages)}
+    keys = {chunk: cache_key(version.content_hash, mode, chunk) for chunk in last_use}
+    cached = cache.get_many(list(keys.values()))
+    chunks = {chunk: cached.get(key) or {} for chunk, key in keys.items()}
+    del cached
+
+    missing = {}
+    for page_num in pages:
+        chunk = page_num // chunk_pages
+        if page_num not in chunks[chunk]:
+            missing.setdefault(chunk, {})[page_num] = None
+    missing = {chunk: list(page_nums) for chunk, page_nums in missing.items()}
+
+    def store(chunk, contents):
+        # A concurrent request may store the same chunk; pages only one
+        # of them extracted are then extracted again next time
+        chunks[chunk] = {**chunks[chunk], **dict(zip(missing[chunk], contents))}
+        return keys[chunk], chunks[chunk]
+
+    pdf_path = local_path(version.file.name) if missing else None
+    pending = {}
+    if sum(len(page_nums) for page_nums in missing.values()) >= settings.PDF_EXTRACTION_PARALLEL_MIN_PAGES:
+        for chunk, page_nums in missing.items():
+            pending[chunk] = submit('extract_content', pdf_path, page_nums, mode, version.size)
+    elif missing:
+        page_nums = [page_num for chunk_page_nums in missing.values() for page_num in chunk_page_nums]
+        contents = iter(call('extract_content', pdf_path, page_nums, mode, version.size))
+        cache.set_many(dict(
+            store(chunk, [next(contents) for _ in chunk_page_nums]) for chunk, chunk_page_nums in missing.items()
+        ))
+
+    for i, page_num in enumerate(pages):
+        chunk = page_num // chunk_pages
+        if chunk in pending:
+            cache.set(*store(chunk, result(pending.pop(chunk))))
+
+        content = chunks[chunk][page_num]
+        if last_use[chunk] == i:
+            del chunks[chunk]
+
+        yield page_num, content
+
+
+def iter_ndjson(version, pages, mode):
+    """
+    Encode extracted pages as newline-delimited JSON, one page per line
+
+    An error before the first line is raised. Once lines have been sent
+    the response status can no longer change, so a later error ends the
+    stream with an {"error": "..."} line instead.
+    """
+    sent = False
+    try:
+        for page_num, content in iter_page_content(version, pages, mode):
+            if mode == 'blocks':
+                record = {'page': page_num + 1, **content}
+            else:
+                record = {'page': page_num + 1, 'text': content}
+            yield json.dumps(record, ensure_ascii=False) + '\n'
+            sent = True
+    except Exception as e:
+        if not sent:
+            raise
+        logger.exception('Extraction failed mid-stream')
+        yield json.dumps({'error': str(e)}) + '\n'
@@ -0,0 +1,247 @@
+import logging
+import uuid
+from django.core.files.storage import default_storage
+from django.db import transaction
+from .document_access import map_file
+from .models import PDFDocument, DocumentVersion
+from .storage import local_path, staging_path, storage_directories, commit
+from .versioning import version_file_name
+from .worker_pool import run_many
+
+
+logger = logging.getLogger(__name__)
+
+# Image exports, stored as exports/<document id>/...
+EXPORTS_DIRECTORY = 'exports'
+# Outputs of split_range, extract_pages and split_all, which get no row
+UNTRACKED_DIRECTORIES = ('pdfs/split',)
+
+
+def document_checks(document, versions):
+    """
+    Files the rows of a document point to, with what is recorded about them
+
+    Versions carry a size and hash for their file (or its prefix); the
+    upload and edited file are only checked separately when no version
+    covers them.
+
+    Args:
+        document: PDFDocument
+        versions: Its DocumentVersions, newest first
+
+    Returns:
+        list: (label, version or None, check) where check is the
+            (name, size, content_hash, exact) tuple used by
+            SimplePDFEditor.verify_files()
+    """
+    checks = [
+        (f'v{version.number}', version, (version.file.name, version.size, version.content_hash, False))
+        for version in versions
+    ]
+    covered = {version.file.name for version in versions}
+
+    if document.original_file.name not in covered:
+        checks.append(('original', None, (document.original_file.name, document.file_size or None, None, True)))
+    if document.edited_file and document.edited_file.name not in covered | {document.original_file.name}:
+        checks.append(('edited', None, (document.edited_file.name, None, None, False)))
+    return checks
+
+
+def verify(checks, hashes=True, open_files=False, chunk_size=50):
+    """
+    Run verify_files() for many checks across the worker pool
+
+    A chunk whose worker died, e.g. on a file that crashes MuPDF, is
+    checked again one file per job, so only that file is reported. A file
+    whose check fails again gets an 'error' instead of problems: a worker
+    limit or a storage outage says nothing about the file itself.
+
+    Returns:
+        list: verify_files() result per check
+    """
+    jobs = {
+        start: ('verify_files', (checks[start:start + chunk_size], hashes, open_files), {})
+        for start in range(0, len(checks), chunk_size)
+    }
+    results = [None] * len(checks)
+    retry = []
+    for start, (outcome, error) in run_many(jobs).items():
+        if error is None:
+            results[start:start + len(outcome)] = outcome
+        else:
+            retry.extend(range(start, min(start + chunk_size, len(checks))))
+
+    if retry:
+        single = {index: ('verify_files', ([checks[index]], hashes, open_files), {}) for index in retry}
+        for index, (outcome, error) in run_many(single).items():
+            results[index] = outcome[0] if error is None else {'size': None, 'problems': [], 'error': str(error)}
+    return results
+
+
+def assess(document, versions, labelled, results):
+    """
+    Turn check results into a finding for one document
+
+    Files whose check failed are listed as unchecked. They may well be
+    intact, so no repair or unrecoverable verdict is given while a
+    document has any.
+
+    Returns:
+        dict: document_id, title, problems, unchecked, unrecoverable and
+            the repair that would restore a consistent state (None if
+            there is none); None when every file was checked and is intact
+    """
+    problems = []
+    unchecked = []
+    broken = set()
+    sizes = {}
+    for (label, version, check), result in zip(labelled, results):
+        sizes[label] = result['size']
+        if result.get('error'):
+            unchecked.append({'file': check[0], 'what': label, 'error': result['error']})
+        for problem in result['problems']:
+            problems.append({'file': check[0], 'what': label, 'problem': problem})
+            broken.add(label)
+    if not problems and not unchecked:
+        return None
+
+    finding = {
+        'document_id': str(document.id),
+        'title': document.title,
+        'problems': problems,
+        'unchecked': unchecked,
+        'unrecoverable': False,
+        'repair': None,
+    }
+    if unchecked:
+        return finding
+
+    if versions:
+        intact = [version for version in versions if f'v{version.number}' not in broken]
+        if not intact:
+            finding['unrecoverable'] = True
+        elif intact[0] is not versions[0] or 'edited' in broken:
+            finding['repair'] = {'roll_back_to': intact[0].number}
+        return finding
+
+    if 'original' in broken:
+        only_size = all(
+            problem['problem'].startswith('size is') for problem in problems if problem['what'] == 'original'
+        )
+        if not only_size:
+            finding['unrecoverable'] = True
+            return finding
+        finding['repair'] = {'file_size': sizes['original']}
+    if 'edited' in broken:
+        finding['repair'] = dict(finding['repair'] or {}, clear_edited=True)
+    return finding
+
+
+def repair(document, finding):
+    """
+    Apply the repair proposed by assess()
+
+    Rolling back deletes the versions newer than the last intact one and
+    points the document at that version's file. If later versions were
+    appended to that file, the intact version's bytes are copied to a new
+    file first, so the damaged increments are no longer served. Files
+    left without rows are reported by the orphan scan.
+
+    Returns:
+        str: What was done
+    """
+    action = finding['repair']
+    done = []
+
+    good = None
+    good_file = None
+    if 'roll_back_to' in action:
+        good = document.versions.get(number=action['roll_back_to'])
+        if good.number > 0 and good.file.name != document.original_file.name:
+            good_file = good.file.name
+            if default_storage.size(good_file) > good.size:
+                good_file = _copy_prefix(document, good)
+
+    with transaction.atomic():
+        if good is not None:
+            removed, _ = document.versions.filter(number__gt=good.number).delete()
+            if good_file is None:
+                document.edited_file = None
+            else:
+                if good_file != good.file.name:
+                    good.file.name = good_file
+                    good.save(update_fields=['file'])
+                    done.append(f'v{good.number} copied to {good_file}')
+                document.edited_file.name = good_file
+            document.save(update_fields=['edited_file'])
+            done.insert(0, f'rolled back to v{good.number}, {removed} version(s) removed')
+
+        if action.get('clear_edited'):
+            document.edited_file = None
+            document.save(update_fields=['edited_file'])
+            done.append('edited file cleared')
+
+        if 'file_size' in action:
+            document.file_size = action['file_size']
+            document.save(update_fields=['file_size'])
+            done.append(f"file size set to {action['file_size']}")
+
+    logger.info('Repaired %s: %s', document.id, '; '.join(done))
+    return '; '.join(done)
+
+
+def _copy_prefix(document, version):
+    """Store the bytes of `version` in a file of its own and return its name"""
+    name = version_file_name(document, version.number)
+    path = staging_path(name)
+    with map_file(local_path(version.file.name), version.size) as buffer, open(path, 'wb') as f:
+        f.write(buffer)
+    return commit(name, path)
+
+
+def orphan_directories(prefixes):
+    """
+    Directories under `prefixes` searched for orphaned files, sorted
+
+    Split outputs are left out: no row points to them, yet API responses
+    link to them.
+    """
+    directories = set()
+    for prefix in prefixes:
+        directories.update(storage_directories(prefix))
+    return sorted(
+        directory for directory in directories
+        if not any(
+            directory == untracked or directory.startswith(f'{untracked}/') for untracked in UNTRACKED_DIRECTORIES
+        )
+    )
+
+
+def unreferenced(names):
+    """
+    Names from `names` that nothing points to
+
+    Files under EXPORTS_DIRECTORY belong to the document whose id is the
+    next path component and are orphans once it is deleted; any other
+    file needs a PDFDocument or DocumentVersion row pointing to it.
+    """
+    names = set(names)
+    exports = {name: _export_document_id(name) for name in names if name.startswith(f'{EXPORTS_DIRECTORY}/')}
+    existing = set(PDFDocument.objects.filter(
+        id__in={document_id for document_id in exports.values() if document_id is not None}
+    ).values_list('id', flat=True))
+    orphans = {name for name, document_id in exports.items() if document_id not in existing}
+
+    names -= set(exports)
+    referenced = set(PDFDocument.objects.filter(original_file__in=names).values_list('original_file', flat=True))
+    referenced.update(PDFDocument.objects.filter(edited_file__in=names).values_list('edited_file', flat=True))
+    referenced.update(DocumentVersion.objects.filter(file__in=names).values_list('file', flat=True))
+    return (names - referenced) | orphans
+
+
+def _export_document_id(name):
+    parts = name.split('/')
+    try:
+        return uuid.UUID(parts[1]) if len(parts) > 2 else None
+    except ValueError:
+        return None
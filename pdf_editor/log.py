@@ -0,0 +1,151 @@
+import contextvars
+import copy
+import json
+import logging
+import os
+import queue
+import random
+import sys
+import weakref
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+
+# Fields describing the request being handled; set by RequestLogMiddleware
+request_id = contextvars.ContextVar('request_id', default=None)
+document_id = contextvars.ContextVar('document_id', default=None)
+operation = contextvars.ContextVar('operation', default=None)
+debug_sampled = contextvars.ContextVar('debug_sampled', default=True)
+# Set by ProfilingMiddleware so pool jobs of the request are profiled too
+profiled = contextvars.ContextVar('profiled', default=False)
+
+CONTEXT_FIELDS = {
+    'request_id': request_id,
+    'document_id': document_id,
+    'op': operation,
+}
+
+# Attributes every LogRecord has; anything else came in through `extra`
+_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+class ContextFilter(logging.Filter):
+    """Copy the request context onto records, in the thread that logs them"""
+
+    def filter(self, record):
+        for field, var in CONTEXT_FIELDS.items():
+            if getattr(record, field, None) is None:
+                setattr(record, field, var.get())
+        return True
+
+
+class DebugSamplingFilter(logging.Filter):
+    """Drop DEBUG records of requests that were not picked for sampling"""
+
+    def filter(self, record):
+        return record.levelno > logging.DEBUG or debug_sampled.get()
+
+
+def sample_debug(rate):
+    """Decide whether the current request logs at DEBUG"""
+    debug_sampled.set(rate >= 1 or random.random() < rate)
+
+
+def current_context():
+    """Request context to hand to another process"""
+    context = {field: var.get() for field, var in CONTEXT_FIELDS.items()}
+    context['debug_sampled'] = debug_sampled.get()
+    context['profiled'] = profiled.get()
+    return context
+
+
+def restore_context(context):
+    """Apply a context captured with current_context()"""
+    for field, var in CONTEXT_FIELDS.items():
+        var.set(context.get(field))
+    debug_sampled.set(context.get('debug_sampled', True))
+    profiled.set(context.get('profiled', False))
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per line with the request context and any extras"""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for field in CONTEXT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS and key not in CONTEXT_FIELDS and key not in entry:
+                entry[key] = value
+
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class QueuedStreamHandler(QueueHandler):
+    """
+    Non-blocking handler: records are queued and written to the stream by
+    a background thread, so request threads never wait on stdout
+
+    Args:
+        stream: Target stream, stdout by default
+    """
+
+    def __init__(self, stream=None):
+        super().__init__(queue.SimpleQueue())
+        self.target = logging.StreamHandler(stream or sys.stdout)
+        self.listener = None
+        self.start()
+        _queued_handlers.add(self)
+
+    def start(self):
+        self.listener = QueueListener(self.queue, self.target, respect_handler_level=False)
+        self.listener.start()
+
+    def setFormatter(self, fmt):
+        # Formatting happens on the listener thread
+        self.target.setFormatter(fmt)
+
+    def prepare(self, record):
+        # Resolve the message and traceback now, but keep the record's
+        # fields so the formatter can still emit them separately
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def close(self):
+        # Called by logging.shutdown() at exit; flushes what is queued
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+        super().close()
+
+
+_queued_handlers = weakref.WeakSet()
+
+
+def _restart_after_fork():
+    # The listener thread does not survive a fork (gunicorn workers are
+    # forked from a preloaded master), so each child starts its own
+    for handler in list(_queued_handlers):
+        if handler.listener is not None:
+            handler.queue = queue.SimpleQueue()
+            handler.start()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_restart_after_fork)
@@ -0,0 +1,223 @@
+import json
+import os
+import time
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.db.models import Prefetch
+from pdf_editor.integrity import (
+    EXPORTS_DIRECTORY, document_checks, verify, assess, repair, orphan_directories, unreferenced
+)
+from pdf_editor.models import PDFDocument, DocumentVersion
+
+
+STATS = (
+    'documents', 'files_checked', 'damaged', 'unchecked', 'unrecoverable', 'repaired',
+    'stored_files', 'orphans', 'orphan_bytes', 'orphans_deleted',
+)
+
+
+class Command(BaseCommand):
+    help = (
+        'Check that the files of every document exist, have the recorded size '
+        'and hash and optionally open, flag or repair broken rows, and report '
+        'stored files no row points to. Progress is checkpointed, so an '
+        'interrupted scan resumes where it stopped.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--checkpoint', default=os.path.join(settings.BASE_DIR, '.check_storage.json'),
+                            help='File the scan position and totals are saved to after every batch')
+        parser.add_argument('--restart', action='store_true',
+                            help='Ignore an existing checkpoint and scan from the start')
+        parser.add_argument('--batch', type=int, default=500,
+                            help='Documents loaded and checked per batch')
+        parser.add_argument('--chunk', type=int, default=50,
+                            help='Files per worker pool job')
+        parser.add_argument('--quick', action='store_true',
+                            help='Only check existence and size, not content hashes')
+        parser.add_argument('--open', action='store_true',
+                            help='Also open every file with MuPDF')
+        parser.add_argument('--repair', action='store_true',
+                            help='Roll damaged documents back to their newest intact version, '
+                                 'clear missing edited files and fix recorded sizes')
+        parser.add_argument('--skip-orphans', action='store_true',
+                            help='Do not look for stored files without a row')
+        parser.add_argument('--prefix', action='append',
+                            help='Storage directory searched for orphaned files, repeat for several; '
+                                 'pdfs and exports by default. pdfs/split is never searched: split '
+                                 'outputs have no row but are linked from API responses')
+        parser.add_argument('--delete-orphans', action='store_true',
+                            help='Delete orphaned files older than --orphan-min-age')
+        parser.add_argument('--orphan-min-age', type=float, default=24,
+                            help='Hours a file must be unreferenced before it is deleted, so files '
+                                 'of edits still in progress are kept')
+        parser.add_argument('--report',
+                            help='Append every finding to this file as JSON lines')
+
+    def handle(self, *args, **options):
+        options['prefix'] = options['prefix'] or ['pdfs', EXPORTS_DIRECTORY]
+        self.options = options
+        state = self.load_checkpoint()
+        started = time.monotonic()
+
+        if state['phase'] == 'documents':
+            self.scan_documents(state)
+            state.update(phase='files', directory=None, last_file=None)
+            self.save_checkpoint(state)
+
+        if state['phase'] == 'files' and not options['skip_orphans']:
+            self.scan_files(state)
+        state['phase'] = 'done'
+        self.save_checkpoint(state)
+
+        stats = state['stats']
+        self.stdout.write(
+            f"Checked {stats['documents']} document(s) and {stats['files_checked']} file(s) "
+            f"in {time.monotonic() - started:.1f}s: {stats['damaged']} damaged, "
+            f"{stats['unrecoverable']} unrecoverable, {stats['repaired']} repaired, "
+            f"{stats['unchecked']} not fully checked"
+        )
+        if not options['skip_orphans']:
+            self.stdout.write(
+                f"{stats['orphans']} of {stats['stored_files']} stored file(s) under "
+                f"{', '.join(f'{prefix}/' for prefix in options['prefix'])} "
+                f"are not referenced: {stats['orphan_bytes'] / 2 ** 20:.1f} MB, "
+                f"{stats['orphans_deleted']} deleted"
+            )
+        style = self.style.SUCCESS if not stats['damaged'] and not stats['unchecked'] else self.style.WARNING
+        self.stdout.write(style('Scan complete'))
+
+    def load_checkpoint(self):
+        path = self.options['checkpoint']
+        if not self.options['restart'] and os.path.exists(path):
+            with open(path) as f:
+                state = json.load(f)
+            if state['phase'] != 'done':
+                self.stderr.write(f"Resuming {state['phase']} scan from {path}")
+                state['stats'] = dict(dict.fromkeys(STATS, 0), **state['stats'])
+                return state
+        return {
+            'phase': 'documents',
+            'last_document': None,
+            'directory': None,
+            'last_file': None,
+            'stats': dict.fromkeys(STATS, 0),
+        }
+
+    def save_checkpoint(self, state):
+        path = self.options['checkpoint']
+        temporary = f'{path}.tmp'
+        with open(temporary, 'w') as f:
+            json.dump(state, f)
+        os.replace(temporary, path)
+
+    def record(self, finding):
+        if self.options['report']:
+            with open(self.options['report'], 'a') as f:
+                f.write(json.dumps(finding) + '\n')
+
+    def scan_documents(self, state):
+        stats = state['stats']
+        documents = PDFDocument.objects.order_by('id').prefetch_related(
+            Prefetch('versions', queryset=DocumentVersion.objects.order_by('-number'))
+        )
+        while True:
+            batch = documents
+            if state['last_document']:
+                batch = batch.filter(id__gt=state['last_document'])
+            batch = list(batch[:self.options['batch']])
+            if not batch:
+                return
+
+            labelled = {}
+            checks = []
+            for document in batch:
+                versions = list(document.versions.all())
+                labelled[document.id] = (versions, document_checks(document, versions))
+                checks.extend(check for _, _, check in labelled[document.id][1])
+
+            results = iter(verify(
+                checks,
+                hashes=not self.options['quick'],
+                open_files=self.options['open'],
+                chunk_size=self.options['chunk'],
+            ))
+
+            for document in batch:
+                versions, document_labelled = labelled[document.id]
+                document_results = [next(results) for _ in document_labelled]
+                finding = assess(document, versions, document_labelled, document_results)
+                if finding is None:
+                    continue
+
+                stats['damaged'] += bool(finding['problems'])
+                stats['unchecked'] += bool(finding['unchecked'])
+                stats['unrecoverable'] += finding['unrecoverable']
+                if self.options['repair'] and finding['repair']:
+                    finding['repaired'] = repair(document, finding)
+                    stats['repaired'] += 1
+                self.report_finding(finding)
+
+            stats['documents'] += len(batch)
+            stats['files_checked'] += len(checks)
+            state['last_document'] = str(batch[-1].id)
+            self.save_checkpoint(state)
+            self.stderr.write(
+                f"{stats['documents']} document(s), {stats['files_checked']} file(s) checked, "
+                f"{stats['damaged']} damaged, {stats['unchecked']} not fully checked"
+            )
+
+    def report_finding(self, finding):
+        self.record(finding)
+        if finding['unrecoverable']:
+            status = 'UNRECOVERABLE'
+        elif finding.get('repaired'):
+            status = f"repaired: {finding['repaired']}"
+        elif finding['unchecked']:
+            status = 'some files could not be checked, run again'
+            if finding['problems']:
+                status += '; damaged, no repair until every file is checked'
+        elif finding['repair']:
+            status = f"repairable: {json.dumps(finding['repair'])}"
+        else:
+            status = 'older versions damaged, current file intact'
+        self.stdout.write(f"{finding['document_id']} {finding['title']!r}: {status}")
+        for problem in finding['problems']:
+            self.stdout.write(f"  {problem['what']} {problem['file']}: {problem['problem']}")
+        for failure in finding['unchecked']:
+            self.stdout.write(f"  {failure['what']} {failure['file']}: check failed: {failure['error']}")
+
+    def scan_files(self, state):
+        stats = state['stats']
+        min_age = time.time() - self.options['orphan_min_age'] * 3600
+
+        for directory in orphan_directories(self.options['prefix']):
+            if state['directory'] and directory < state['directory']:
+                continue
+            if directory != state['directory']:
+                state.update(directory=directory, last_file=None)
+
+            try:
+                _, names = default_storage.listdir(directory)
+            except FileNotFoundError:
+                continue
+            names = sorted(name for name in names if state['last_file'] is None or name > state['last_file'])
+
+            for start in range(0, len(names), self.options['batch']):
+                chunk = [f'{directory}/{name}' for name in names[start:start + self.options['batch']]]
+                for name in sorted(unreferenced(chunk)):
+                    size = default_storage.size(name)
+                    stats['orphans'] += 1
+                    stats['orphan_bytes'] += size
+
+                    deleted = False
+                    if self.options['delete_orphans'] and default_storage.get_modified_time(name).timestamp() < min_age:
+                        default_storage.delete(name)
+                        stats['orphans_deleted'] += 1
+                        deleted = True
+                    self.record({'orphan': name, 'size': size, 'deleted': deleted})
+
+                stats['stored_files'] += len(chunk)
+                state['last_file'] = chunk[-1].rsplit('/', 1)[-1]
+                self.save_checkpoint(state)
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Max
+from pdf_editor.models import PDFDocument
+from pdf_editor.versioning import compact_versions
+
+
+class Command(BaseCommand):
+    help = 'Flatten document version chains deeper than --min-depth'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--min-depth', type=int, default=2,
+                            help='Only compact chains at least this deep')
+        parser.add_argument('--document', action='append', default=[],
+                            help='Document id to compact (repeatable)')
+
+    def handle(self, *args, **options):
+        documents = PDFDocument.objects.annotate(max_depth=Max('versions__depth'))
+        documents = documents.filter(max_depth__gte=options['min_depth'])
+        if options['document']:
+            documents = documents.filter(id__in=options['document'])
+
+        compacted = 0
+        for document in documents.iterator():
+            version = compact_versions(document)
+            compacted += 1
+            self.stdout.write(f"{document.id}: v{version.number} ({version.size} bytes)")
+
+        self.stdout.write(self.style.SUCCESS(f"Compacted {compacted} document(s)"))
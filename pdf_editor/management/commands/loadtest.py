@@ -0,0 +1,481 @@
+import json
+import math
+import os
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from collections import defaultdict
+import fitz  # PyMuPDF
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+
+DEFAULT_MIX = 'upload=1,page_count=4,download=4,split=1,merge=1,rotate=2,find_replace=1'
+
+
+class Command(BaseCommand):
+    help = (
+        'Start the app under gunicorn on this machine and replay a mix of API '
+        'requests against synthetic PDFs; reports throughput, latency '
+        'percentiles, error rate and worker memory'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--duration', type=float, default=30,
+                            help='Seconds to generate load for')
+        parser.add_argument('--concurrency', type=int, default=8,
+                            help='Concurrent clients')
+        parser.add_argument('--mix', default=DEFAULT_MIX,
+                            help=f'Relative weight per operation (default: {DEFAULT_MIX})')
+        parser.add_argument('--workers', type=int, default=int(os.environ.get('WEB_CONCURRENCY', '2')),
+                            help='gunicorn workers')
+        parser.add_argument('--timeout', type=int, default=120,
+                            help='gunicorn worker timeout')
+        parser.add_argument('--pages', type=int, default=10,
+                            help='Pages per synthetic PDF')
+        parser.add_argument('--documents', type=int, default=10,
+                            help='Documents uploaded before the measured run')
+        parser.add_argument('--url',
+                            help='Load an already running server instead of starting one')
+        parser.add_argument('--seed', type=int, default=None,
+                            help='Random seed for a repeatable request sequence')
+        parser.add_argument('--keep', action='store_true',
+                            help='Keep the temporary database, media and server log')
+        parser.add_argument('--json', action='store_true',
+                            help='Print the report as JSON')
+
+    def handle(self, *args, **options):
+        mix = parse_mix(options['mix'])
+        workdir = tempfile.mkdtemp(prefix='pdf-loadtest-')
+        server = None
+        try:
+            if options['url']:
+                base_url = options['url'].rstrip('/')
+            else:
+                server = Server(workdir, options['workers'], options['timeout'])
+                self.stderr.write(f"Starting gunicorn with {options['workers']} worker(s) on {server.url}")
+                server.start()
+                base_url = server.url
+
+            run = LoadRun(base_url, make_samples(options['pages']), options['seed'])
+            self.stderr.write(f"Uploading {options['documents']} seed document(s)")
+            run.seed(options['documents'])
+
+            sampler = MemorySampler(server.process.pid) if server else None
+            if sampler:
+                sampler.start()
+            self.stderr.write(
+                f"Running {options['concurrency']} client(s) for {options['duration']:g}s: {options['mix']}"
+            )
+            elapsed = run.run(mix, options['duration'], options['concurrency'])
+            memory = sampler.stop() if sampler else None
+
+            report = build_report(run.results, elapsed, memory, options)
+            if options['json']:
+                self.stdout.write(json.dumps(report, indent=2))
+            else:
+                self.write_report(report)
+        finally:
+            if server:
+                server.stop()
+            if options['keep']:
+                self.stderr.write(f"Kept {workdir}")
+            else:
+                shutil.rmtree(workdir, ignore_errors=True)
+
+    def write_report(self, report):
+        self.stdout.write(
+            f"\n{report['requests']} requests in {report['elapsed_seconds']}s: "
+            f"{report['throughput_rps']} req/s, {report['error_rate']:.2%} errors\n"
+        )
+        self.stdout.write(f"{'operation':<14}{'count':>7}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+        for op, row in report['operations'].items():
+            self.stdout.write(
+                f"{op:<14}{row['count']:>7}{row['errors']:>8}"
+                f"{row['p50_ms']:>10}{row['p95_ms']:>10}{row['p99_ms']:>10}{row['max_ms']:>10}"
+            )
+        if report['statuses']:
+            self.stdout.write(f"\nstatuses: {report['statuses']}")
+
+        memory = report.get('memory')
+        if memory:
+            self.stdout.write(
+                f"\nmemory (peak RSS): master {memory['master_mb']} MB, "
+                f"{memory['web_workers']} web worker(s) {memory['web_worker_max_mb']} MB max / "
+                f"{memory['web_workers_total_mb']} MB total, "
+                f"{memory['pdf_workers']} PDF worker(s) {memory['pdf_workers_total_mb']} MB total"
+            )
+        self.stdout.write(self.style.SUCCESS('\nDone'))
+
+
+def parse_mix(spec):
+    """'upload=1,rotate=2' -> {'upload': 1.0, 'rotate': 2.0}"""
+    mix = {}
+    for item in spec.split(','):
+        if not item.strip():
+            continue
+        name, _, weight = item.partition('=')
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise CommandError(f"Unknown operation '{name}'. Use: {', '.join(OPERATIONS)}")
+        try:
+            mix[name] = float(weight or 1)
+        except ValueError:
+            raise CommandError(f"Invalid weight in '{item}'")
+    if not mix or not any(mix.values()):
+        raise CommandError('The mix needs at least one operation with a positive weight')
+    return mix
+
+
+def make_samples(pages):
+    """A few synthetic PDFs of different weight, as bytes"""
+    samples = []
+    for variant in range(3):
+        pdf = fitz.open()
+        for page_num in range(pages):
+            page = pdf.new_page()
+            page.insert_text((72, 72), f'Invoice {variant}-{page_num + 1}', fontsize=18)
+            for line in range(20 * (variant + 1)):
+                page.insert_text((72, 110 + line * 14 % 650), f'Item {line}: Total {line * 7} EUR', fontsize=10)
+            page.draw_rect(fitz.Rect(400, 40, 540, 90), color=(0, 0, 0.6), fill=(0.85, 0.9, 1))
+        samples.append(pdf.tobytes(garbage=3, deflate=True))
+        pdf.close()
+    return samples
+
+
+class Server:
+    """gunicorn running the project against a throwaway database and media root"""
+
+    def __init__(self, workdir, workers, timeout):
+        self.workdir = workdir
+        self.port = free_port()
+        self.url = f'http://127.0.0.1:{self.port}'
+        self.log_path = os.path.join(workdir, 'server.log')
+        self.env = dict(
+            os.environ,
+            SQLITE_PATH=os.path.join(workdir, 'db.sqlite3'),
+            MEDIA_ROOT=os.path.join(workdir, 'media'),
+            PDF_STORAGE_CACHE_DIR=os.path.join(workdir, 'storage_cache'),
+            PDF_EXTRACTION_CACHE_DIR=os.path.join(workdir, 'extraction_cache'),
+            PORT=str(self.port),
+            WEB_CONCURRENCY=str(workers),
+            GUNICORN_TIMEOUT=str(timeout),
+            PDF_LOG_LEVEL=os.environ.get('PDF_LOG_LEVEL', 'WARNING'),
+        )
+        self.process = None
+
+    def start(self):
+        migrate = subprocess.run(
+            [sys.executable, 'manage.py', 'migrate', '--noinput'],
+            cwd=settings.BASE_DIR, env=self.env, capture_output=True, text=True
+        )
+        if migrate.returncode:
+            raise CommandError(f'migrate failed:\n{migrate.stderr}')
+
+        self.log = open(self.log_path, 'wb')
+        self.process = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', 'config.wsgi:application',
+             '-c', 'gunicorn.conf.py', '--bind', f'127.0.0.1:{self.port}'],
+            cwd=settings.BASE_DIR, env=self.env, stdout=self.log, stderr=subprocess.STDOUT
+        )
+
+        deadline = time.monotonic() + 60
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise CommandError(f'gunicorn exited:\n{self.log_tail()}')
+            status, _ = request('GET', f'{self.url}/api/health/ready/', timeout=2)
+            if status == 200:
+                return
+            time.sleep(0.25)
+        raise CommandError(f'gunicorn did not become ready:\n{self.log_tail()}')
+
+    def stop(self):
+        if self.process and self.process.poll() is None:
+            self.process.send_signal(signal.SIGTERM)
+            try:
+                self.process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        if self.process:
+            self.log.close()
+
+    def log_tail(self, lines=30):
+        self.log.flush()
+        with open(self.log_path, 'rb') as f:
+            return b''.join(f.readlines()[-lines:]).decode('utf-8', 'replace')
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def request(method, url, body=None, content_type=None, timeout=180):
+    """Send a request; returns (status, body), status 0 on connection errors"""
+    headers = {'Content-Type': content_type} if content_type else {}
+    req = urllib.request.Request(url, data=body, method=method, headers=headers)
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as response:
+            return response.status, response.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.read()
+    except (urllib.error.URLError, OSError):
+        return 0, b''
+
+
+def multipart(field, filename, data):
+    boundary = uuid.uuid4().hex
+    body = (
+        f'--{boundary}\r\n'
+        f'Content-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+        f'Content-Type: application/pdf\r\n\r\n'
+    ).encode() + data + f'\r\n--{boundary}--\r\n'.encode()
+    return body, f'multipart/form-data; boundary={boundary}'
+
+
+class LoadRun:
+    """Clients replaying the operation mix against one server"""
+
+    def __init__(self, base_url, samples, seed=None):
+        self.api = f'{base_url}/api/documents'
+        self.samples = samples
+        self.seed_value = seed
+        self.documents = []
+        self.lock = threading.Lock()
+        self.results = []
+
+    def seed(self, count):
+        rng = random.Random(self.seed_value)
+        for _ in range(count):
+            status, _ = self.upload(rng)
+            if status != 201:
+                raise CommandError(f'Seed upload failed with status {status}')
+
+    def run(self, mix, duration, concurrency):
+        ops = list(mix)
+        weights = [mix[op] for op in ops]
+        deadline = time.monotonic() + duration
+
+        def client(index):
+            rng = random.Random(None if self.seed_value is None else self.seed_value + index + 1)
+            results = []
+            try:
+                while time.monotonic() < deadline:
+                    op = rng.choices(ops, weights)[0]
+                    started = time.perf_counter()
+                    try:
+                        status, _ = OPERATIONS[op](self, rng)
+                    except Exception as e:
+                        # e.g. a truncated response; counted as an error
+                        # under the exception's name
+                        status = type(e).__name__
+                    results.append((op, time.perf_counter() - started, status))
+            finally:
+                with self.lock:
+                    self.results.extend(results)
+
+        started = time.monotonic()
+        threads = [threading.Thread(target=client, args=(i,)) for i in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.monotonic() - started
+
+    def document(self, rng):
+        with self.lock:
+            return rng.choice(self.documents)
+
+    def post_json(self, url, data):
+        return request('POST', url, json.dumps(data).encode(), 'application/json')
+
+    def upload(self, rng):
+        body, content_type = multipart('file', 'loadtest.pdf', rng.choice(self.samples))
+        status, response = request('POST', f'{self.api}/', body, content_type)
+        if status == 201:
+            with self.lock:
+                self.documents.append(json.loads(response)['id'])
+        return status, response
+
+    def page_count(self, rng):
+        return request('GET', f'{self.api}/{self.document(rng)}/page_count/')
+
+    def download(self, rng):
+        return request('GET', f'{self.api}/{self.document(rng)}/download/')
+
+    def split(self, rng):
+        return self.post_json(f'{self.api}/{self.document(rng)}/split/', {
+            'mode': 'range', 'start_page': 1, 'end_page': 2
+        })
+
+    def merge(self, rng):
+        return self.post_json(f'{self.api}/merge/', {
+            'document_ids': [self.document(rng), self.document(rng)]
+        })
+
+    def rotate(self, rng):
+        return self.post_json(f'{self.api}/{self.document(rng)}/rotate/', {
+            'angle': 90, 'pages': '1', 'in_place': True
+        })
+
+    def find_replace(self, rng):
+        return self.post_json(f'{self.api}/{self.document(rng)}/find_replace/', {
+            'find_text': 'Total', 'replace_text': 'Total'
+        })
+
+
+OPERATIONS = {
+    'upload': LoadRun.upload,
+    'page_count': LoadRun.page_count,
+    'download': LoadRun.download,
+    'split': LoadRun.split,
+    'merge': LoadRun.merge,
+    'rotate': LoadRun.rotate,
+    'find_replace': LoadRun.find_replace,
+}
+
+
+class MemorySampler:
+    """
+    Peak RSS of the gunicorn master, its workers and their PDF pool
+    processes, read from /proc (Linux only)
+    """
+
+    def __init__(self, master_pid, interval=0.5):
+        self.master_pid = master_pid
+        self.interval = interval
+        self.peaks = {}
+        self.parents = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def start(self):
+        if os.path.isdir('/proc'):
+            self._thread.start()
+
+    def stop(self):
+        if not self._thread.is_alive():
+            return None
+        self._stop.set()
+        self._thread.join()
+
+        workers = [pid for pid, parent in self.parents.items() if parent == self.master_pid]
+        pool = [pid for pid, parent in self.parents.items() if parent in workers]
+        mb = lambda kb: round(kb / 1024, 1)
+        return {
+            'master_mb': mb(self.peaks.get(self.master_pid, 0)),
+            'web_workers': len(workers),
+            'web_worker_max_mb': mb(max((self.peaks[pid] for pid in workers), default=0)),
+            'web_workers_total_mb': mb(sum(self.peaks[pid] for pid in workers)),
+            'pdf_workers': len(pool),
+            'pdf_workers_total_mb': mb(sum(self.peaks[pid] for pid in pool)),
+        }
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            children = defaultdict(list)
+            for entry in os.listdir('/proc'):
+                if entry.isdigit():
+                    parent = _ppid(entry)
+                    if parent is not None:
+                        children[parent].append(int(entry))
+
+            tree = [self.master_pid]
+            for pid in tree:
+                for child in children.get(pid, ()):
+                    self.parents[child] = pid
+                    tree.append(child)
+            for pid in tree:
+                rss = _rss_kb(pid)
+                if rss:
+                    self.peaks[pid] = max(self.peaks.get(pid, 0), rss)
+
+
+def _ppid(pid):
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            # The command name may contain spaces; fields resume after ')'
+            return int(f.read().rsplit(')', 1)[1].split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def _rss_kb(pid):
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an ascending list"""
+    if not sorted_values:
+        return 0
+    # Rounded first so float noise (0.07 * 100 = 7.000000000000001) does not skip a rank
+    rank = math.ceil(round(fraction * len(sorted_values), 9))
+    index = max(0, min(len(sorted_values) - 1, rank - 1))
+    return sorted_values[index]
+
+
+def build_report(results, elapsed, memory, options):
+    by_op = defaultdict(list)
+    errors = defaultdict(int)
+    statuses = defaultdict(int)
+    for op, latency, status in results:
+        by_op[op].append(latency)
+        statuses[str(status)] += 1
+        if not (isinstance(status, int) and 200 <= status < 300):
+            errors[op] += 1
+
+    operations = {}
+    for op in OPERATIONS:
+        if op not in by_op:
+            continue
+        latencies = sorted(by_op[op])
+        ms = lambda seconds: round(seconds * 1000, 1)
+        operations[op] = {
+            'count': len(latencies),
+            'errors': errors[op],
+            'p50_ms': ms(percentile(latencies, 0.50)),
+            'p95_ms': ms(percentile(latencies, 0.95)),
+            'p99_ms': ms(percentile(latencies, 0.99)),
+            'max_ms': ms(latencies[-1]),
+        }
+
+    total = len(results)
+    all_latencies = sorted(latency for _, latency, _ in results)
+    report = {
+        'requests': total,
+        'elapsed_seconds': round(elapsed, 2),
+        'throughput_rps': round(total / elapsed, 2) if elapsed else 0,
+        'error_rate': round(sum(errors.values()) / total, 4) if total else 0,
+        'p50_ms': round(percentile(all_latencies, 0.50) * 1000, 1),
+        'p95_ms': round(percentile(all_latencies, 0.95) * 1000, 1),
+        'p99_ms': round(percentile(all_latencies, 0.99) * 1000, 1),
+        'operations': operations,
+        'statuses': dict(statuses),
+        'config': {
+            'workers': None if options['url'] else options['workers'],
+            'timeout': None if options['url'] else options['timeout'],
+            'concurrency': options['concurrency'],
+            'mix': options['mix'],
+            'pages': options['pages'],
+        },
+    }
+    if memory:
+        report['memory'] = memory
+    return report
@@ -0,0 +1,35 @@
+# Generated by Django 5.2.7 on 2026-10-19 14:08
+
+import django.db.models.deletion
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pdf_editor', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DocumentVersion',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('number', models.PositiveIntegerField(default=0)),
+                ('depth', models.PositiveIntegerField(default=0)),
+                ('operation', models.CharField(max_length=50)),
+                ('params', models.JSONField(blank=True, default=dict)),
+                ('file', models.FileField(max_length=255, upload_to='pdfs/edited/')),
+                ('content_hash', models.CharField(max_length=64)),
+                ('size', models.BigIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('document', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='versions', to='pdf_editor.pdfdocument')),
+                ('parent', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='children', to='pdf_editor.documentversion')),
+            ],
+            options={
+                'ordering': ['document', '-number'],
+                'constraints': [models.UniqueConstraint(fields=('document', 'number'), name='unique_document_version_number')],
+            },
+        ),
+    ]
@@ -13,4 +13,41 @@ class PDFDocument(models.Model):
         ordering = ['-created_at']
     
     def __str__(self):
-        return self.title
\ No newline at end of file
+        return self.title
+    
+    @property
+    def current_file(self):
+        """File of the latest version: the edited file if any, else the upload"""
+        if self.edited_file and self.edited_file.name:
+            return self.edited_file
+        return self.original_file
+
+
+class DocumentVersion(models.Model):
+    """
+    One step in a document's edit history.
+    
+    Versions produced by incremental saves share their parent's file and
+    differ only in size: the content of a version is the first `size`
+    bytes of `file`.
+    """
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    document = models.ForeignKey(PDFDocument, related_name='versions', on_delete=models.CASCADE)
+    parent = models.ForeignKey('self', related_name='children', null=True, blank=True, on_delete=models.SET_NULL)
+    number = models.PositiveIntegerField(default=0)
+    depth = models.PositiveIntegerField(default=0)
+    operation = models.CharField(max_length=50)
+    params = models.JSONField(default=dict, blank=True)
+    file = models.FileField(upload_to='pdfs/edited/', max_length=255)
+    content_hash = models.CharField(max_length=64)
+    size = models.BigIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        ordering = ['document', '-number']
+        constraints = [
+            models.UniqueConstraint(fields=['document', 'number'], name='unique_document_version_number'),
+        ]
+    
+    def __str__(self):
+        return f"{self.document.title} v{self.number} ({self.operation})"
@@ -0,0 +1,188 @@
+import re
+
+
+_RANGE_RE = re.compile(r'^(-?\d+|last)\s*-\s*(-?\d+|last)?$')
+_SINGLE_RE = re.compile(r'^(-?\d+)$')
+
+KEYWORDS = {
+    'all': lambda total_pages: range(total_pages),
+    'odd': lambda total_pages: range(0, total_pages, 2),
+    'even': lambda total_pages: range(1, total_pages, 2),
+    'last': lambda total_pages: range(total_pages - 1, total_pages) if total_pages else range(0),
+}
+
+
+class PageSelectionError(ValueError):
+    """A page selection that cannot be parsed or is outside the document"""
+
+
+class PageSet:
+    """
+    Ordered selection of pages, stored as ranges instead of page lists
+
+    Selections use 1-based page numbers and accept:
+        "all", "odd", "even", "last"
+        "5", "1-5", "5-" (to the end)
+        negative numbers counted from the end: "-1" is the last page,
+        "-3--1" the last three
+    and any comma-separated combination or list of those, e.g. "1,3,5-9"
+    or [1, 3, "5-9"]. Iterating yields 0-indexed page numbers in selection
+    order, duplicates included.
+    """
+
+    def __init__(self, ranges, total_pages):
+        self.ranges = [r for r in ranges if len(r)]
+        self.total_pages = total_pages
+
+    @classmethod
+    def parse(cls, selection, total_pages, strict=True):
+        """
+        Parse a selection against a document of total_pages pages
+
+        Args:
+            selection: String, int, or list of those
+            total_pages: Number of pages in the document
+            strict: Raise on pages outside the document instead of
+                dropping them
+
+        Returns:
+            PageSet
+        """
+        if selection is None or selection == '':
+            raise PageSelectionError('No pages selected')
+
+        if isinstance(selection, (list, tuple)):
+            items = list(selection)
+        elif isinstance(selection, int):
+            items = [selection]
+        else:
+            items = str(selection).split(',')
+
+        ranges = []
+        invalid = []
+        for item in items:
+            item = str(item).strip().lower()
+            if not item:
+                continue
+            if item in KEYWORDS:
+                ranges.append(KEYWORDS[item](total_pages))
+                continue
+
+            bounds = cls._parse_bounds(item, total_pages)
+            if bounds is None:
+                raise PageSelectionError(f'Invalid page selection: {item}')
+
+            start, stop = bounds
+            if 0 <= start < stop <= total_pages:
+                ranges.append(range(start, stop))
+            elif strict:
+                invalid.append(item)
+            else:
+                ranges.append(range(max(start, 0), min(stop, total_pages)))
+
+        if invalid:
+            raise PageSelectionError(
+                f'Invalid pages: {", ".join(invalid)}. Document has {total_pages} pages.'
+            )
+        return cls(ranges, total_pages)
+
+    @classmethod
+    def from_range(cls, start_page, end_page, total_pages):
+        """Pages start_page..end_page (1-based, inclusive)"""
+        return cls.parse(f'{int(start_page)}-{int(end_page)}', total_pages)
+
+    @classmethod
+    def all(cls, total_pages):
+        return cls([range(total_pages)], total_pages)
+
+    @staticmethod
+    def _parse_bounds(item, total_pages):
+        """Return (start, stop) 0-indexed half-open, or None"""
+        def index(bound):
+            if bound == 'last':
+                return total_pages - 1
+            number = int(bound)
+            if number < 0:
+                return total_pages + number
+            if number == 0:
+                return -1
+            return number - 1
+
+        match = _SINGLE_RE.match(item)
+        if match:
+            page = index(match.group(1))
+            return page, page + 1
+
+        match = _RANGE_RE.match(item)
+        if match:
+            start = index(match.group(1))
+            stop = index(match.group(2)) + 1 if match.group(2) else total_pages
+            if start >= stop:
+                return None
+            return start, stop
+
+        return None
+
+    def __iter__(self):
+        for r in self.ranges:
+            yield from r
+
+    def __len__(self):
+        return sum(len(r) for r in self.ranges)
+
+    def __bool__(self):
+        return bool(self.ranges)
+
+    def __contains__(self, page_num):
+        return any(page_num in r for r in self.ranges)
+
+    def unique(self):
+        """Same pages without duplicates, in ascending order"""
+        pages = sorted(set(self))
+        return PageSet([range(first, last + 1) for first, last in _runs([pages])], self.total_pages)
+
+    def runs(self):
+        """
+        Contiguous (first, last) page runs in selection order, 0-indexed
+
+        Adjacent selections are coalesced, so "1-3,4,5-9" is a single run
+        and can be copied with one insert_pdf() call.
+        """
+        return list(_runs(self.ranges))
+
+    def to_spec(self):
+        """Compact 1-based selection string, e.g. "1-3,7" """
+        parts = []
+        for first, last in self.runs():
+            parts.append(str(first + 1) if first == last else f'{first + 1}-{last + 1}')
+        return ','.join(parts)
+
+    def __repr__(self):
+        return f'PageSet({self.to_spec()!r}, total_pages={self.total_pages})'
+
+
+def _runs(sequences):
+    """Coalesce page sequences into (first, last) runs of consecutive pages"""
+    first = last = None
+    for pages in sequences:
+        if isinstance(pages, range) and pages.step == 1:
+            if not pages:
+                continue
+            if first is not None and pages.start == last + 1:
+                last = pages.stop - 1
+                continue
+            if first is not None:
+                yield first, last
+            first, last = pages.start, pages.stop - 1
+            continue
+
+        for page_num in pages:
+            if first is not None and page_num == last + 1:
+                last = page_num
+                continue
+            if first is not None:
+                yield first, last
+            first = last = page_num
+
+    if first is not None:
+        yield first, last
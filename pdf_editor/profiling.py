@@ -0,0 +1,161 @@
+import cProfile
+import hmac
+import io
+import logging
+import marshal
+import os
+import pstats
+import re
+import threading
+import time
+import tracemalloc
+import zipfile
+from contextlib import contextmanager
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from . import log
+
+
+logger = logging.getLogger(__name__)
+
+STATS_LINES = 40
+MEMORY_LINES = 15
+
+# Request ids come from a client header when a proxy sets one, so only
+# ids that are safe as a storage directory name are used as profile ids
+_PROFILE_ID_RE = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+# The profiler hook and tracemalloc are per process; one capture at a time
+_capture_lock = threading.Lock()
+
+
+def token_matches(token):
+    """Whether `token` is the configured PDF_PROFILE_TOKEN"""
+    if not settings.PDF_PROFILE_TOKEN or not token:
+        return False
+    return hmac.compare_digest(token.encode(), settings.PDF_PROFILE_TOKEN.encode())
+
+
+def profile_storage():
+    """
+    Storage the captures are kept in
+
+    PDF_PROFILE_DIR is outside MEDIA_ROOT, so /media/ never serves them;
+    they are only reachable through the token-protected profile views.
+    """
+    return FileSystemStorage(location=settings.PDF_PROFILE_DIR)
+
+
+def profile_id():
+    """Id the captures of the current request are stored under"""
+    request_id = log.request_id.get()
+    if request_id and _PROFILE_ID_RE.match(request_id):
+        return request_id
+    return None
+
+
+@contextmanager
+def capture(name, title):
+    """
+    Profile the block and store the result under the current request
+
+    Writes `<name>-<pid>.prof` (pstats format, for pstats or snakeviz) and
+    `<name>-<pid>.txt` (slowest functions by cumulative time, peak Python
+    memory and the largest allocations still held at the end). MuPDF's
+    own allocations are not visible to tracemalloc.
+
+    Yields:
+        bool: False when the request has no usable id or another capture
+            is running in this process; the block then runs unprofiled
+    """
+    if profile_id() is None or not _capture_lock.acquire(blocking=False):
+        yield False
+        return
+
+    profiler = cProfile.Profile()
+    started_tracing = not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    started = time.perf_counter()
+    profiler.enable()
+    try:
+        yield True
+    finally:
+        profiler.disable()
+        elapsed = time.perf_counter() - started
+        _, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot()
+        if started_tracing:
+            tracemalloc.stop()
+        _capture_lock.release()
+        try:
+            _store(name, title, profiler, snapshot, peak, elapsed)
+        except Exception:
+            logger.exception('Could not store profile %s', name)
+
+
+def _store(name, title, profiler, snapshot, peak, elapsed):
+    storage = profile_storage()
+    base = f'{profile_id()}/{name}-{os.getpid()}'
+    profiler.create_stats()
+    storage.save(f'{base}.prof', ContentFile(marshal.dumps(profiler.stats)))
+
+    report = io.StringIO()
+    report.write(f'{title} (pid {os.getpid()}): {elapsed * 1000:.1f} ms\n')
+    pstats.Stats(profiler, stream=report).sort_stats('cumulative').print_stats(STATS_LINES)
+    report.write(f'Python memory peak: {peak / 2 ** 20:.1f} MB; largest allocations still held:\n')
+    snapshot = snapshot.filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),))
+    for stat in snapshot.statistics('lineno')[:MEMORY_LINES]:
+        report.write(f'  {stat}\n')
+    storage.save(f'{base}.txt', ContentFile(report.getvalue().encode()))
+
+
+def list_profiles():
+    """
+    Stored profiles, newest first
+
+    Returns:
+        list: {'id', 'created', 'files'} per profiled request
+    """
+    storage = profile_storage()
+    try:
+        ids, _ = storage.listdir('')
+    except FileNotFoundError:
+        return []
+
+    profiles = []
+    for id_ in ids:
+        _, files = storage.listdir(id_)
+        if not files:
+            continue
+        created = min(storage.get_modified_time(f'{id_}/{name}') for name in files)
+        profiles.append({'id': id_, 'created': created, 'files': sorted(files)})
+    profiles.sort(key=lambda profile: profile['created'], reverse=True)
+    return profiles
+
+
+def bundle(id_):
+    """
+    ZIP archive of every capture stored for one request
+
+    Returns:
+        bytes: The archive, or None if there is no such profile
+    """
+    if not _PROFILE_ID_RE.match(id_):
+        return None
+    storage = profile_storage()
+    try:
+        _, files = storage.listdir(id_)
+    except FileNotFoundError:
+        return None
+    if not files:
+        return None
+
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for name in sorted(files):
+            with storage.open(f'{id_}/{name}') as f:
+                archive.writestr(name, f.read())
+    return buffer.getvalue()
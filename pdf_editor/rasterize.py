@@ -0,0 +1,175 @@
+import os
+import zipfile
+from collections import deque
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from .storage import local_path
+from .worker_pool import call, submit, result
+
+
+# format name -> (Pillow format, file extension, colorspaces it can hold)
+IMAGE_FORMATS = {
+    'png': ('PNG', 'png', ('rgb', 'gray')),
+    'jpeg': ('JPEG', 'jpg', ('rgb', 'gray', 'cmyk')),
+    'webp': ('WEBP', 'webp', ('rgb',)),
+}
+CHANNELS = {'rgb': 3, 'gray': 1, 'cmyk': 4}
+
+
+def render_options(data):
+    """
+    Validate image export parameters from a request
+
+    Raises:
+        ValueError: Unsupported or out-of-range value
+
+    Returns:
+        dict: dpi, colorspace, image_format, quality, extension
+    """
+    image_format = str(data.get('format', 'png')).lower()
+    if image_format == 'jpg':
+        image_format = 'jpeg'
+    if image_format not in IMAGE_FORMATS:
+        raise ValueError(f'Unsupported format. Use one of: {", ".join(IMAGE_FORMATS)}')
+    pillow_format, extension, colorspaces = IMAGE_FORMATS[image_format]
+
+    colorspace = str(data.get('colorspace', 'rgb')).lower()
+    if colorspace not in colorspaces:
+        raise ValueError(f'{image_format} supports colorspace {", ".join(colorspaces)}')
+
+    dpi = int(data.get('dpi', 150))
+    if not 1 <= dpi <= settings.PDF_RASTER_MAX_DPI:
+        raise ValueError(f'dpi must be between 1 and {settings.PDF_RASTER_MAX_DPI}')
+
+    quality = int(data.get('quality', 85))
+    if not 1 <= quality <= 100:
+        raise ValueError('quality must be between 1 and 100')
+
+    return {
+        'dpi': dpi,
+        'colorspace': colorspace,
+        'image_format': pillow_format,
+        'quality': quality,
+        'extension': extension,
+    }
+
+
+def pixmap_bytes(width, height, dpi, colorspace):
+    """Memory needed to render a page of `width` x `height` points"""
+    zoom = dpi / 72
+    return int(width * zoom + 1) * int(height * zoom + 1) * CHANNELS[colorspace]
+
+
+def plan_jobs(version, pages, options):
+    """
+    Group pages into pool jobs
+
+    Returns:
+        list: (pages, peak bytes) per job; the peak is the largest page,
+            doubled for the copy Pillow encodes from
+    """
+    sizes = call('page_sizes', local_path(version.file.name), list(pages), version.size)
+    costs = [2 * pixmap_bytes(width, height, options['dpi'], options['colorspace']) for width, height in sizes]
+
+    largest = max(costs, default=0)
+    if largest > settings.PDF_RASTER_MEMORY_LIMIT:
+        raise ValueError(
+            f'A page at {options["dpi"]} dpi needs {largest // 2 ** 20} MB, over the '
+            f'{settings.PDF_RASTER_MEMORY_LIMIT // 2 ** 20} MB limit; use a lower dpi'
+        )
+
+    chunk_size = settings.PDF_RASTER_CHUNK_PAGES
+    pages = list(pages)
+    return [
+        (pages[i:i + chunk_size], max(costs[i:i + chunk_size]))
+        for i in range(0, len(pages), chunk_size)
+    ]
+
+
+def iter_rendered(version, jobs, options):
+    """
+    Yield (page_num, image bytes) in page order
+
+    Jobs are submitted to the worker pool only while the pixmaps they may
+    hold at once fit in PDF_RASTER_MEMORY_LIMIT, so wide selections at
+    high dpi queue up instead of exhausting memory.
+    """
+    pdf_path = local_path(version.file.name)
+    render_args = {key: options[key] for key in ('dpi', 'colorspace', 'image_format', 'quality')}
+    render_args['size'] = version.size
+    budget = settings.PDF_RASTER_MEMORY_LIMIT
+
+    waiting = deque(jobs)
+    running = deque()
+    in_use = 0
+    try:
+        while waiting or running:
+            while waiting and (not running or in_use + waiting[0][1] <= budget):
+                pages, cost = waiting.popleft()
+                running.append((pages, cost, submit('render_pages', pdf_path, pages, **render_args)))
+                in_use += cost
+
+            pages, cost, future = running.popleft()
+            images = result(future)
+            in_use -= cost
+            yield from zip(pages, images)
+    finally:
+        for _, _, future in running:
+            future.cancel()
+
+
+class _ZipStream:
+    """Write-only file object whose content is collected and drained"""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def iter_zip(rendered, name, extension):
+    """
+    Stream rendered pages as a ZIP archive
+
+    Entries are stored uncompressed (the images already are) and sent as
+    soon as each page is ready.
+    """
+    stream = _ZipStream()
+    with zipfile.ZipFile(stream, 'w', zipfile.ZIP_STORED) as archive:
+        for page_num, data in rendered:
+            archive.writestr(f'{name}-page-{page_num + 1}.{extension}', data)
+            yield stream.drain()
+    yield stream.drain()
+
+
+def store_images(rendered, prefix, extension):
+    """
+    Save rendered pages to default storage
+
+    Returns:
+        list: {'page': 1-based number, 'file': storage name} per page
+    """
+    stored = []
+    for page_num, data in rendered:
+        name = default_storage.save(
+            os.path.join(prefix, f'page-{page_num + 1}.{extension}'),
+            ContentFile(data)
+        )
+        stored.append({'page': page_num + 1, 'file': name})
+    return stored
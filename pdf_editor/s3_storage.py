@@ -0,0 +1,36 @@
+from boto3.s3.transfer import TransferConfig
+from django.conf import settings
+from storages.backends.s3 import S3Storage
+from storages.utils import clean_name
+
+
+class S3PDFStorage(S3Storage):
+    """
+    S3-compatible storage (AWS, MinIO, ...) with the LocalPDFStorage extras
+
+    Uploads and downloads use boto3's managed transfers, which switch to
+    multipart requests above PDF_S3_MULTIPART_THRESHOLD.
+    """
+    is_local = False
+
+    def __init__(self, **kwargs):
+        kwargs.setdefault('transfer_config', TransferConfig(
+            multipart_threshold=settings.PDF_S3_MULTIPART_THRESHOLD,
+            multipart_chunksize=settings.PDF_S3_MULTIPART_CHUNK_SIZE,
+        ))
+        super().__init__(**kwargs)
+
+    def _object(self, name):
+        return self.bucket.Object(self._normalize_name(clean_name(name)))
+
+    def fingerprint(self, name):
+        """The object's ETag, which changes whenever its content does"""
+        return self._object(name).e_tag
+
+    def replace(self, name, content):
+        """Store content under exactly `name`, overwriting any existing object"""
+        return self._save(name, content)
+
+    def download_to(self, name, path):
+        """Download a stored file to a local path"""
+        self._object(name).download_file(path, Config=self.transfer_config)
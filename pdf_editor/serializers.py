@@ -1,5 +1,5 @@
 from rest_framework import serializers
-from .models import PDFDocument
+from .models import PDFDocument, DocumentVersion
 
 class PDFDocumentSerializer(serializers.ModelSerializer):
     original_file = serializers.SerializerMethodField()
@@ -19,4 +19,12 @@ class PDFDocumentSerializer(serializers.ModelSerializer):
         request = self.context.get('request')
         if obj.edited_file and request:
             return request.build_absolute_uri(obj.edited_file.url)
-        return None
\ No newline at end of file
+        return None
+
+class DocumentVersionSerializer(serializers.ModelSerializer):
+    parent = serializers.PrimaryKeyRelatedField(read_only=True)
+    
+    class Meta:
+        model = DocumentVersion
+        fields = ['id', 'parent', 'number', 'depth', 'operation', 'params',
+                  'content_hash', 'size', 'created_at']
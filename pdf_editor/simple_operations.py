@@ -1,106 +1,199 @@
+import bisect
 import fitz  # PyMuPDF
+import hashlib
+import io
+import itertools
+import logging
 import os
+import re
+import shutil
+import time
 from datetime import datetime
-from django.conf import settings
+from django.core.files.storage import default_storage
+from PIL import Image
+from .document_access import open_pdf, map_file, file_sha256
+from .page_selection import PageSet
+from .storage import local_path
+from .warmup import warm_up_mupdf
+
+
+logger = logging.getLogger(__name__)
+
+# Indirect reference "12 0 R"; PyMuPDF always uses generation 0
+_REF_RE = re.compile(r'\b(\d+) 0 R\b')
+
+# Font dictionary keys that point to font-related streams
+_FONT_STREAM_KEYS = ('FontFile', 'FontFile2', 'FontFile3', 'ToUnicode')
+
+# Keys leading from an object back to its page or the page tree; not
+# followed when collecting the objects a page needs
+_PAGE_LINK_RE = re.compile(r'/(?:Parent|P)\s+\d+ 0 R')
+
+# Bytes a saved object takes besides its content: "n 0 obj", "endobj",
+# stream keywords and its cross-reference entry
+_OBJECT_OVERHEAD = 60
+
+# Share of a word box's height cut from its top and bottom when redacting
+# pattern matches, so lines above and below are left alone
+_LINE_TRIM = 0.2
+
+
+class IncrementalUpdateError(Exception):
+    """A PDF cannot take an incremental update, e.g. because MuPDF had to repair it"""
 
 
 class SimplePDFEditor:
     """Simple PDF operations using PyMuPDF"""
     
-    def __init__(self):
-        # Ensure output directories exist
-        self.output_dir = os.path.join(settings.MEDIA_ROOT, 'pdfs', 'edited')
-        os.makedirs(self.output_dir, exist_ok=True)
+    # Operations accepted by apply_operation
+    BULK_OPERATIONS = ('rotate', 'find_replace', 'reorder', 'redact')
     
-    def merge_pdfs(self, pdf_paths):
+    # Split modes that plan their parts up front, see split_plan
+    SPLIT_PLAN_MODES = ('outline', 'every', 'size')
+    
+    def warm_up(self):
+        """Load MuPDF's fonts and context in a fresh pool worker"""
+        started = time.monotonic()
+        warm_up_mupdf()
+        return time.monotonic() - started
+    
+    def merge_pdfs(self, pdf_paths, sizes=None):
         """
         Merge multiple PDFs into one
         
         Args:
             pdf_paths: List of paths to PDF files
+            sizes: Leading bytes of each file that make up its document,
+                None for whole files
             
         Returns:
-            str: Path to merged PDF
+            bytes: Merged PDF, ready to go into storage
         """
         try:
-            result = fitz.open()
-            
-            for pdf_path in pdf_paths:
-                print(f"  📄 Opening: {pdf_path}")
-                pdf = fitz.open(pdf_path)
-                result.insert_pdf(pdf)
-                pdf.close()
-            
-            # Save merged PDF
-            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-            output_filename = f"merged_{timestamp}.pdf"
-            output_path = os.path.join(self.output_dir, output_filename)
-            
-            result.save(output_path)
+            result = self._concatenate(pdf_paths, sizes)
+            data = result.tobytes()
             result.close()
             
-            print(f"✅ Merged {len(pdf_paths)} PDFs into: {output_filename}")
-            return output_path
+            logger.info('Merged %d PDFs (%d bytes)', len(pdf_paths), len(data))
+            return data
             
-        except Exception as e:
-            print(f"❌ Merge error: {str(e)}")
-            import traceback
-            traceback.print_exc()
+        except Exception:
+            logger.exception('Merge error')
             return None
     
-    def find_and_replace(self, input_path, find_text, replace_text):
+    def merge_dedup(self, pdf_paths, sizes=None):
         """
-        Find and replace text in PDF
+        Merge PDFs, writing identical fonts and images only once
+        
+        Inputs made from the same template carry their own copies of the
+        same font programs and images; those are collapsed into one.
         
         Args:
-            input_path: Path to input PDF
-            find_text: Text to find
-            replace_text: Text to replace with
+            pdf_paths: List of paths to PDF files
+            sizes: As for merge_pdfs()
             
         Returns:
-            str: Path to edited PDF
+            dict: 'data' with the merged PDF bytes and 'dedup' with the
+                statistics from dedup_resources()
         """
+        result = self._concatenate(pdf_paths, sizes)
         try:
-            pdf = fitz.open(input_path)
-            replacements = 0
-            
-            for page in pdf:
-                # Search for text
-                text_instances = page.search_for(find_text)
-                
-                for inst in text_instances:
-                    # Add redaction annotation
-                    page.add_redact_annot(inst, replace_text)
-                    replacements += 1
-                
-                # Apply redactions
-                page.apply_redactions()
+            stats = self.dedup_resources(result)
+            data = result.tobytes(garbage=3, deflate=True)
+        finally:
+            result.close()
+        
+        logger.info('Merged %d PDFs (%d bytes), %d of %d font/image streams were duplicates (%.2fx)',
+                    len(pdf_paths), len(data), stats['duplicate_streams'], stats['streams'], stats['ratio'])
+        return {'data': data, 'dedup': stats}
+    
+    def _concatenate(self, pdf_paths, sizes=None):
+        result = fitz.open()
+        for pdf_path, size in zip(pdf_paths, sizes or [None] * len(pdf_paths)):
+            logger.debug('Opening: %s', pdf_path)
+            pdf = open_pdf(pdf_path, size)
+            result.insert_pdf(pdf)
+            pdf.close()
+        return result
+    
+    @staticmethod
+    def dedup_resources(pdf):
+        """
+        Point all references to identical font and image streams at one copy
+        
+        Streams are compared by the hash of their raw (still encoded) bytes
+        plus their dictionary. Dictionaries are compared with references to
+        already merged objects resolved, so an image and its /SMask collapse
+        together; this repeats until nothing new matches. The duplicates are
+        left unreferenced and dropped when the document is saved with
+        garbage collection.
+        
+        Args:
+            pdf: Open fitz.Document, modified in place
             
-            if replacements > 0:
-                # Save edited PDF
-                timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-                filename = os.path.basename(input_path)
-                name_without_ext = os.path.splitext(filename)[0]
-                output_filename = f"{name_without_ext}_{timestamp}_edited.pdf"
-                output_path = os.path.join(self.output_dir, output_filename)
-                
-                pdf.save(output_path)
-                pdf.close()
-                
-                print(f"✅ Replaced {replacements} instance(s). Saved: {output_filename}")
-                return output_path
-            else:
-                pdf.close()
-                print(f"⚠️ Text '{find_text}' not found in PDF")
-                return None
-                
-        except Exception as e:
-            print(f"❌ Find/Replace error: {str(e)}")
-            import traceback
-            traceback.print_exc()
-            return None
+        Returns:
+            dict: streams, duplicate_streams, bytes, duplicate_bytes and
+                ratio (resource bytes before / after)
+        """
+        candidates = set()
+        for xref in range(1, pdf.xref_length()):
+            if pdf.xref_is_image(xref):
+                candidates.add(xref)
+                continue
+            for key in _FONT_STREAM_KEYS:
+                kind, value = pdf.xref_get_key(xref, key)
+                if kind == 'xref':
+                    candidates.add(int(value.split()[0]))
+        streams = sorted(xref for xref in candidates if pdf.xref_is_stream(xref))
+        
+        digests = {}
+        sizes = {}
+        for xref in streams:
+            raw = pdf.xref_stream_raw(xref)
+            digests[xref] = hashlib.sha256(raw).digest()
+            sizes[xref] = len(raw)
+        
+        canonical = {}
+        
+        def repoint(match):
+            xref = int(match.group(1))
+            return f"{canonical.get(xref, xref)} 0 R"
+        
+        while True:
+            seen = {}
+            found = 0
+            for xref in streams:
+                if xref in canonical:
+                    continue
+                key = (_REF_RE.sub(repoint, pdf.xref_object(xref, compressed=True)), digests[xref])
+                if key in seen:
+                    canonical[xref] = seen[key]
+                    found += 1
+                else:
+                    seen[key] = xref
+            if not found:
+                break
+        
+        if canonical:
+            for xref in range(1, pdf.xref_length()):
+                if xref in canonical:
+                    continue
+                source = pdf.xref_object(xref, compressed=True)
+                updated = _REF_RE.sub(repoint, source)
+                if updated != source:
+                    pdf.update_object(xref, updated)
+        
+        total = sum(sizes.values())
+        duplicate = sum(sizes[xref] for xref in canonical)
+        return {
+            'streams': len(streams),
+            'duplicate_streams': len(canonical),
+            'bytes': total,
+            'duplicate_bytes': duplicate,
+            'ratio': round(total / (total - duplicate), 2) if total > duplicate else 1.0
+        }
     
-    def split_pdf(self, input_path, mode='all', start_page=None, end_page=None, pages_list=None):
+    def split_pdf(self, input_path, mode='all', start_page=None, end_page=None, pages=None, size=None):
         """
         Split PDF into multiple files
         
@@ -109,13 +202,14 @@ class SimplePDFEditor:
             mode: 'all', 'range', or 'extract'
             start_page: Start page number (1-indexed)
             end_page: End page number (1-indexed)
-            pages_list: List of page numbers to extract
+            pages: PageSet of pages to extract
+            size: Leading bytes of input_path that make up the document
             
         Returns:
-            list: Paths to split PDF files
+            list: (filename, bytes) tuple for each part
         """
         try:
-            pdf = fitz.open(input_path)
+            pdf = open_pdf(input_path, size)
             output_files = []
             timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
             
@@ -126,11 +220,8 @@ class SimplePDFEditor:
                     new_pdf.insert_pdf(pdf, from_page=page_num, to_page=page_num)
                     
                     output_filename = f"page_{page_num + 1}_{timestamp}.pdf"
-                    output_path = os.path.join(self.output_dir, output_filename)
-                    
-                    new_pdf.save(output_path)
+                    output_files.append((output_filename, new_pdf.tobytes()))
                     new_pdf.close()
-                    output_files.append(output_path)
                     
             elif mode == 'range' and start_page and end_page:
                 # Extract page range
@@ -138,31 +229,852 @@ class SimplePDFEditor:
                 new_pdf.insert_pdf(pdf, from_page=start_page-1, to_page=end_page-1)
                 
                 output_filename = f"pages_{start_page}-{end_page}_{timestamp}.pdf"
-                output_path = os.path.join(self.output_dir, output_filename)
-                
-                new_pdf.save(output_path)
+                output_files.append((output_filename, new_pdf.tobytes()))
                 new_pdf.close()
-                output_files.append(output_path)
                 
-            elif mode == 'extract' and pages_list:
-                # Extract specific pages
+            elif mode == 'extract' and pages:
+                # Extract specific pages, one insert per contiguous run
                 new_pdf = fitz.open()
-                for page_num in pages_list:
-                    new_pdf.insert_pdf(pdf, from_page=page_num-1, to_page=page_num-1)
+                for first, last in pages.runs():
+                    new_pdf.insert_pdf(pdf, from_page=first, to_page=last)
                 
                 output_filename = f"extracted_{timestamp}.pdf"
-                output_path = os.path.join(self.output_dir, output_filename)
-                
-                new_pdf.save(output_path)
+                output_files.append((output_filename, new_pdf.tobytes()))
                 new_pdf.close()
-                output_files.append(output_path)
             
             pdf.close()
-            print(f"✅ Split complete. Created {len(output_files)} file(s)")
+            logger.info('Split complete, created %d file(s)', len(output_files))
+            return output_files
+            
+        except Exception:
+            logger.exception('Split error')
+            return []
+    
+    def split_plan(self, input_path, mode, level=1, every=None, max_bytes=None, size=None):
+        """
+        Work out the parts of a split from the document's metadata
+        
+        Modes:
+            outline: A part per outline entry of at most `level`; pages
+                before the first entry form their own part
+            every: Parts of `every` pages
+            size: Consecutive pages grouped while the streams and objects
+                they use stay within `max_bytes`; shared fonts and images
+                count once per part, a page larger than that is a part alone
+        
+        size is the number of leading bytes of input_path that make up the
+        document.
+            
+        Raises:
+            ValueError: Invalid parameter, or no outline in outline mode
+            
+        Returns:
+            list: {'filename', 'first', 'last'} per part, pages 0-indexed
+                and inclusive
+        """
+        pdf = open_pdf(input_path, size)
+        try:
+            total_pages = len(pdf)
+            if mode == 'outline':
+                ranges = self._outline_ranges(pdf, self._positive_int(level, 'level'))
+            elif mode == 'every':
+                every = self._positive_int(every, 'every')
+                ranges = [
+                    (None, first, min(first + every, total_pages) - 1)
+                    for first in range(0, total_pages, every)
+                ]
+            elif mode == 'size':
+                ranges = self._size_ranges(pdf, self._positive_int(max_bytes, 'max_bytes'))
+            else:
+                raise ValueError(f'Unsupported split mode: {mode}')
+        finally:
+            pdf.close()
+        
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        width = len(str(len(ranges)))
+        parts = []
+        for index, (title, first, last) in enumerate(ranges, 1):
+            if title is None:
+                name = f"pages_{first + 1}-{last + 1}"
+            else:
+                slug = re.sub(r'[^\w-]+', '_', title).strip('_')[:60] or 'section'
+                name = f"{index:0{width}d}_{slug}"
+            parts.append({'filename': f"{name}_{timestamp}.pdf", 'first': first, 'last': last})
+        
+        logger.info('Split plan: %d part(s) by %s', len(parts), mode)
+        return parts
+    
+    @staticmethod
+    def _positive_int(value, name):
+        try:
+            number = int(value)
+        except (TypeError, ValueError):
+            number = 0
+        if number < 1:
+            raise ValueError(f'{name} must be a whole number of 1 or more')
+        return number
+    
+    @staticmethod
+    def _outline_ranges(pdf, level):
+        starts = {}
+        for entry_level, title, page in pdf.get_toc(simple=True):
+            if entry_level <= level and 1 <= page <= len(pdf):
+                starts.setdefault(page - 1, title)
+        if not starts:
+            raise ValueError(f'Document has no outline entries up to level {level}')
+        
+        if 0 not in starts:
+            starts[0] = 'front_matter'
+        firsts = sorted(starts)
+        ends = [first - 1 for first in firsts[1:]] + [len(pdf) - 1]
+        return [(starts[first], first, last) for first, last in zip(firsts, ends)]
+    
+    def _size_ranges(self, pdf, max_bytes):
+        children = {}
+        sizes = {}
+        ranges = []
+        first = 0
+        used = set()
+        total = 0
+        for page_num in range(len(pdf)):
+            page = pdf[page_num]
+            objects = self.page_objects(pdf, page, children)
+            page_size = len(pdf.xref_object(page.xref)) + _OBJECT_OVERHEAD
+            added = page_size + sum(self._object_size(pdf, xref, sizes) for xref in objects - used)
+            if page_num > first and total + added > max_bytes:
+                # Start a new part; its shared objects are counted afresh
+                ranges.append((None, first, page_num - 1))
+                first = page_num
+                used = set()
+                added = page_size + sum(self._object_size(pdf, xref, sizes) for xref in objects)
+                total = 0
+            total += added
+            used |= objects
+        ranges.append((None, first, len(pdf) - 1))
+        return ranges
+    
+    @staticmethod
+    def page_objects(pdf, page, children):
+        """
+        Objects a page needs: its content streams and everything its
+        resources reference, e.g. fonts, images and form XObjects
+        
+        Args:
+            children: Dict of xref -> referenced xrefs, shared across calls
+        """
+        stack = []
+        for key in ('Contents', 'Resources'):
+            kind, value = pdf.xref_get_key(page.xref, key)
+            if kind != 'null':
+                stack.extend(int(xref) for xref in _REF_RE.findall(value))
+        
+        found = set()
+        while stack:
+            xref = stack.pop()
+            if xref in found:
+                continue
+            found.add(xref)
+            if xref not in children:
+                source = _PAGE_LINK_RE.sub('', pdf.xref_object(xref, compressed=True))
+                children[xref] = [int(ref) for ref in _REF_RE.findall(source)]
+            stack.extend(children[xref])
+        return found
+    
+    @staticmethod
+    def _object_size(pdf, xref, sizes):
+        if xref not in sizes:
+            size = len(pdf.xref_object(xref, compressed=True)) + _OBJECT_OVERHEAD
+            if pdf.xref_is_stream(xref):
+                kind, length = pdf.xref_get_key(xref, 'Length')
+                size += int(length) if kind == 'int' else len(pdf.xref_stream_raw(xref))
+            sizes[xref] = size
+        return sizes[xref]
+    
+    def split_parts(self, input_path, parts, size=None):
+        """
+        Write planned parts, opening the source once
+        
+        Each part keeps the outline entries that point into it.
+        
+        Args:
+            input_path: Path to input PDF
+            parts: Parts from split_plan()
+            size: Leading bytes of input_path that make up the document
+            
+        Returns:
+            list: (filename, bytes) tuple for each part
+        """
+        pdf = open_pdf(input_path, size)
+        try:
+            toc = pdf.get_toc(simple=True)
+            output_files = []
+            for part in parts:
+                new_pdf = fitz.open()
+                new_pdf.insert_pdf(pdf, from_page=part['first'], to_page=part['last'])
+                part_toc = self.part_outline(toc, part['first'], part['last'])
+                if part_toc:
+                    new_pdf.set_toc(part_toc)
+                output_files.append((part['filename'], new_pdf.tobytes(garbage=3, deflate=True)))
+                new_pdf.close()
             return output_files
+        finally:
+            pdf.close()
+    
+    @staticmethod
+    def part_outline(toc, first, last):
+        """Outline entries within pages first..last, renumbered and re-leveled for the part"""
+        entries = [
+            [level, title, page - first]
+            for level, title, page in toc
+            if first + 1 <= page <= last + 1
+        ]
+        return SimplePDFEditor.relevel_outline(entries)
+    
+    @staticmethod
+    def moved_outline(toc, order):
+        """
+        Outline entries pointing at the new positions of their pages
+        
+        An entry follows its page to the first position the page has in
+        `order`; entries of pages left out are dropped and their children
+        re-leveled. Entries without a destination are kept as they are.
+        """
+        positions = {}
+        for position, page_num in enumerate(order):
+            positions.setdefault(page_num, position + 1)
+        entries = [
+            [level, title, positions[page - 1] if page >= 1 else page]
+            for level, title, page in toc
+            if page < 1 or page - 1 in positions
+        ]
+        return SimplePDFEditor.relevel_outline(entries)
+    
+    @staticmethod
+    def relevel_outline(entries):
+        """Shift and clamp the levels of entries so set_toc() accepts them"""
+        if not entries:
+            return []
+        
+        # set_toc() needs level 1 first and no level skipped on the way down
+        shift = min(level for level, _, _ in entries) - 1
+        previous = 0
+        for entry in entries:
+            entry[0] = min(entry[0] - shift, previous + 1)
+            previous = entry[0]
+        return entries
+    
+    def rotate_pages(self, input_path, angle, pages, base_size=None):
+        """
+        Set the rotation of the given pages in place
+        
+        Rotation only touches the /Rotate key of each page, so the change is
+        appended to input_path as an incremental update instead of
+        rewriting the whole file.
+        
+        Args:
+            input_path: Path to the PDF to update
+            angle: Rotation in degrees (multiple of 90)
+            pages: PageSet or list of 0-indexed page numbers
+            base_size: Bytes of input_path the edit builds on; anything
+                after them, e.g. left by an edit that was never recorded,
+                is cut off first, and again if this edit fails
+            
+        Raises:
+            IncrementalUpdateError: The file cannot be appended to; it is
+                left as it was, use rotate_into() for a new file instead
+            
+        Returns:
+            int: Number of bytes written
+        """
+        if base_size is not None:
+            self._truncate(input_path, base_size)
+        
+        pdf = fitz.open(input_path)
+        try:
+            if not pdf.can_save_incrementally():
+                raise IncrementalUpdateError(f'{os.path.basename(input_path)} cannot take an incremental update')
+            
+            self._set_rotation(pdf, angle, pages)
+            size_before = os.path.getsize(input_path)
+            pdf.save(input_path, incremental=True, encryption=fitz.PDF_ENCRYPT_KEEP)
+            return os.path.getsize(input_path) - size_before
+        except Exception:
+            if base_size is not None:
+                self._truncate(input_path, base_size)
+            raise
+        finally:
+            pdf.close()
+    
+    def rotate_into(self, input_path, output_path, angle, pages, size=None):
+        """
+        Rotate the given pages into a new file
+        
+        The source, or its first `size` bytes, is copied and the rotation
+        appended to the copy; a source that cannot take an incremental
+        update is written to output_path in full instead.
+        
+        Returns:
+            int: Number of bytes written, as for rotate_pages(); the whole
+                file when it was rewritten
+        """
+        self.copy_for_editing(input_path, output_path, size)
+        try:
+            return self.rotate_pages(output_path, angle, pages)
+        except IncrementalUpdateError:
+            pdf = open_pdf(input_path, size)
+            try:
+                self._set_rotation(pdf, angle, pages)
+                pdf.save(output_path, garbage=1)
+            finally:
+                pdf.close()
+            return os.path.getsize(output_path)
+    
+    def _truncate(self, path, size):
+        if os.path.getsize(path) > size:
+            with open(path, 'r+b') as f:
+                f.truncate(size)
+    
+    def rotated_copy(self, input_path, angle, pages, size=None):
+        """
+        Rotate the given pages into a new document
+        
+        Returns:
+            bytes: Rotated PDF, ready to go into storage
+        """
+        pdf = open_pdf(input_path, size)
+        try:
+            self._set_rotation(pdf, angle, pages)
+            return pdf.tobytes()
+        finally:
+            pdf.close()
+    
+    def _set_rotation(self, pdf, angle, pages):
+        # Checked once: formatting a record per page adds up on long documents
+        per_page = logger.isEnabledFor(logging.DEBUG)
+        for page_num in pages:
+            pdf[page_num].set_rotation(angle)
+            if per_page:
+                logger.debug('Rotated page %d by %d°', page_num + 1, angle)
+    
+    def save_compacted(self, input_path, size, output_path):
+        """
+        Rewrite a document without incremental updates or unused objects
+        
+        Args:
+            input_path: Path to the PDF
+            size: Leading bytes of input_path that make up the document
+            output_path: Path for the compacted file
+            
+        Returns:
+            int: Size of the compacted file
+        """
+        pdf = open_pdf(input_path, size)
+        try:
+            pdf.save(output_path, garbage=3, deflate=True)
+        finally:
+            pdf.close()
+        return os.path.getsize(output_path)
+    
+    def copy_for_editing(self, input_path, output_path, size=None):
+        """
+        Copy a PDF so that in-place edits leave the source untouched
+        
+        Args:
+            input_path: Path to source PDF
+            output_path: Path of the working copy
+            size: Only copy the first `size` bytes, e.g. the version of a
+                file that later edits were appended to
+            
+        Returns:
+            str: Path to the working copy
+        """
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        if size is None:
+            shutil.copyfile(input_path, output_path)
+        else:
+            with map_file(input_path, size) as buffer, open(output_path, 'wb') as f:
+                f.write(buffer)
+        return output_path
+    
+    def replace_text(self, input_path, output_path, find_text, replace_text, size=None):
+        """
+        Replace every occurrence of find_text, writing to output_path
+        
+        Nothing is written when the text does not occur.
+        
+        Args:
+            size: Leading bytes of input_path that make up the document
+        
+        Returns:
+            int: Number of replacements
+        """
+        pdf = open_pdf(input_path, size)
+        replacements = 0
+        try:
+            for page in pdf:
+                text_instances = page.search_for(find_text)
+                
+                if text_instances:
+                    for inst in text_instances:
+                        page.add_redact_annot(inst, text=replace_text, fill=(1, 1, 1))
+                        replacements += 1
+                    page.apply_redactions()
+            
+            if replacements > 0:
+                pdf.save(output_path)
+            return replacements
+        finally:
+            pdf.close()
+    
+    @staticmethod
+    def page_order(params, total_pages):
+        """
+        New page order for a reorder request, as 0-indexed page numbers
+        
+        Exactly one of these params is used:
+            order: The new sequence, e.g. "3,1,2,4-" or [3, 1, 2, "4-"];
+                pages may repeat, pages left out are dropped
+            delete: Pages to remove
+            duplicate: Pages to repeat right after themselves
+            
+        Raises:
+            PageSelectionError: Invalid selection
+            ValueError: No or several instructions, or no pages left
+        """
+        given = [key for key in ('order', 'delete', 'duplicate') if params.get(key) not in (None, '', [])]
+        if len(given) != 1:
+            raise ValueError('Provide exactly one of order, delete or duplicate')
+        
+        key = given[0]
+        pages = PageSet.parse(params[key], total_pages)
+        if key == 'order':
+            order = list(pages)
+        elif key == 'delete':
+            order = [page_num for page_num in range(total_pages) if page_num not in pages]
+        else:
+            order = []
+            for page_num in range(total_pages):
+                order.append(page_num)
+                if page_num in pages:
+                    order.append(page_num)
+        
+        if not order:
+            raise ValueError('A document must keep at least one page')
+        return order
+    
+    def reorder_pages(self, input_path, output_path, order, size=None):
+        """
+        Rearrange pages without copying them
+        
+        Document.select() rewrites only the page tree; saving with garbage
+        collection then drops the objects of removed pages. select() also
+        drops the outline, so it is read first and written back with each
+        bookmark moved along with its page.
+        
+        Args:
+            input_path: Path to input PDF
+            output_path: Path for the result
+            order: 0-indexed page numbers in their new order
+            size: Leading bytes of input_path that make up the document
+            
+        Returns:
+            int: Number of pages in the result
+        """
+        pdf = open_pdf(input_path, size)
+        try:
+            toc = pdf.get_toc(simple=True)
+            pdf.select(order)
+            if toc:
+                pdf.set_toc(self.moved_outline(toc, order))
+            pdf.save(output_path, garbage=3, deflate=True)
+            return len(pdf)
+        finally:
+            pdf.close()
+    
+    @staticmethod
+    def redaction_plan(params, total_pages):
+        """
+        Validate the parameters of a redact request
+        
+        Params:
+            regions: [{"page": "1-3", "rect": [x0, y0, x1, y1]}, ...] areas in
+                points from the top-left corner; "page" defaults to all pages
+            patterns: Regular expressions matched against the text of pages
+            pages: Pages searched for patterns, all by default
+            fill: [r, g, b] from 0 to 1 painted over redacted areas, black by default
+            strip_metadata: Also clear the document information and XMP metadata
+            
+        Raises:
+            PageSelectionError: Invalid page selection
+            ValueError: Invalid region, pattern or fill, or nothing to do
+            
+        Returns:
+            dict: regions (page -> list of Rect), patterns (compiled),
+                pages (PageSet), fill, strip_metadata
+        """
+        regions = {}
+        region_list = params.get('regions') or []
+        if not isinstance(region_list, list):
+            raise ValueError('regions must be a list')
+        for region in region_list:
+            if not isinstance(region, dict):
+                raise ValueError('Each region must be an object: {"page": "1-3", "rect": [x0, y0, x1, y1]}')
+            try:
+                rect = fitz.Rect([float(value) for value in region['rect']])
+            except (KeyError, TypeError, ValueError):
+                raise ValueError('Each region needs a "rect" of four numbers [x0, y0, x1, y1]')
+            if rect.is_empty or rect.is_infinite:
+                raise ValueError(f'Region {list(rect)} is empty')
+            for page_num in PageSet.parse(str(region.get('page', 'all')), total_pages).unique():
+                regions.setdefault(page_num, []).append(rect)
+        
+        patterns = []
+        pattern_list = params.get('patterns') or []
+        if not isinstance(pattern_list, list):
+            raise ValueError('patterns must be a list of regular expressions')
+        for pattern in pattern_list:
+            try:
+                patterns.append(re.compile(pattern))
+            except (re.error, TypeError) as e:
+                raise ValueError(f'Invalid pattern {pattern!r}: {e}')
+        
+        fill = params.get('fill', (0, 0, 0))
+        try:
+            fill = tuple(float(value) for value in fill)
+        except (TypeError, ValueError):
+            fill = ()
+        if len(fill) != 3 or not all(0 <= value <= 1 for value in fill):
+            raise ValueError('fill must be [r, g, b] with values from 0 to 1')
+        
+        strip_metadata = str(params.get('strip_metadata', 'false')).lower() in ('1', 'true', 'yes')
+        if not regions and not patterns and not strip_metadata:
+            raise ValueError('Provide regions, patterns or strip_metadata')
+        
+        return {
+            'regions': regions,
+            'patterns': patterns,
+            'pages': PageSet.parse(params.get('pages', 'all'), total_pages).unique(),
+            'fill': fill,
+            'strip_metadata': strip_metadata,
+        }
+    
+    @staticmethod
+    def redaction_record(params):
+        """
+        Parameters of a redaction as kept in the version history
+        
+        Patterns usually spell out what was removed (an account number, a
+        name), so only their number is recorded.
+        """
+        record = {key: value for key, value in params.items() if key != 'patterns'}
+        if 'patterns' in params:
+            record['pattern_count'] = len(params['patterns'] or [])
+        return record
+    
+    @staticmethod
+    def pattern_rects(page, patterns):
+        """
+        Areas covering the pattern matches on a page
+        
+        The words are read once with get_text('words') and joined, words of
+        a line by spaces and lines by newlines, so one pass serves every
+        pattern and a match may span words. Each word a match touches is
+        covered whole; the words of one match on the same line are merged
+        into a single rectangle. Rectangles are trimmed vertically by
+        _LINE_TRIM of their height, since MuPDF removes every character
+        touching one and word boxes of tightly set lines overlap.
+        
+        Returns:
+            tuple: (list of Rect, number of matches per pattern)
+        """
+        words = page.get_text('words')
+        starts = []
+        parts = []
+        offset = 0
+        previous_line = None
+        for word in words:
+            if parts:
+                parts.append(' ' if word[5:7] == previous_line else '\n')
+                offset += 1
+            starts.append(offset)
+            parts.append(word[4])
+            offset += len(word[4])
+            previous_line = word[5:7]
+        text = ''.join(parts)
+        
+        rects = []
+        counts = []
+        for pattern in patterns:
+            count = 0
+            for match in pattern.finditer(text):
+                if match.start() == match.end():
+                    continue
+                first = max(bisect.bisect_right(starts, match.start()) - 1, 0)
+                hit = [
+                    i for i in range(first, bisect.bisect_left(starts, match.end()))
+                    if starts[i] + len(words[i][4]) > match.start()
+                ]
+                if not hit:
+                    continue
+                count += 1
+                for _, line in itertools.groupby(hit, key=lambda i: words[i][5:7]):
+                    line = list(line)
+                    rect = fitz.Rect(words[line[0]][:4])
+                    for i in line[1:]:
+                        rect |= words[i][:4]
+                    trim = rect.height * _LINE_TRIM
+                    rects.append(fitz.Rect(rect.x0, rect.y0 + trim, rect.x1, rect.y1 - trim))
+            counts.append(count)
+        return rects, counts
+    
+    def redact(self, input_path, output_path, params, size=None):
+        """
+        Remove content under regions and pattern matches, writing to output_path
+        
+        All areas of a page are collected first and applied with a single
+        apply_redactions() call. The result is saved with garbage
+        collection so the removed content does not survive as unreferenced
+        objects. Nothing is written when there is nothing to redact.
+        
+        Args:
+            input_path: Path to input PDF
+            output_path: Path for the result
+            params: See redaction_plan()
+            size: Leading bytes of input_path that make up the document
+            
+        Returns:
+            dict: changed, redactions (areas), pages_redacted, matches per
+                pattern, metadata_stripped
+        """
+        pdf = open_pdf(input_path, size)
+        try:
+            plan = self.redaction_plan(params, len(pdf))
+            searched = set(plan['pages']) if plan['patterns'] else set()
+            matches = [0] * len(plan['patterns'])
+            redactions = 0
+            pages_redacted = 0
+            
+            for page_num in sorted(searched | set(plan['regions'])):
+                page = pdf[page_num]
+                rects = list(plan['regions'].get(page_num, []))
+                if page_num in searched:
+                    found, counts = self.pattern_rects(page, plan['patterns'])
+                    rects.extend(found)
+                    matches = [total + count for total, count in zip(matches, counts)]
+                if not rects:
+                    continue
+                
+                for rect in rects:
+                    page.add_redact_annot(rect, fill=plan['fill'])
+                page.apply_redactions()
+                redactions += len(rects)
+                pages_redacted += 1
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug('Redacted %d area(s) on page %d', len(rects), page_num + 1)
+            
+            if plan['strip_metadata']:
+                pdf.set_metadata({})
+                pdf.del_xml_metadata()
+            
+            changed = redactions > 0 or plan['strip_metadata']
+            if changed:
+                pdf.save(output_path, garbage=3, deflate=True)
+            return {
+                'changed': changed,
+                'redactions': redactions,
+                'pages_redacted': pages_redacted,
+                'matches': {pattern.pattern: count for pattern, count in zip(plan['patterns'], matches)},
+                'metadata_stripped': plan['strip_metadata'],
+            }
+        finally:
+            pdf.close()
+    
+    def apply_operation(self, operation, input_path, output_path, params, size=None):
+        """
+        Apply a single-document edit, as used by bulk requests
+        
+        Args:
+            operation: 'rotate', 'find_replace', 'reorder' or 'redact'
+            input_path: Path to the file of the current version
+            output_path: Path for the new version; for rotate this may equal
+                input_path to append an incremental update
+            params: Operation parameters from the request
+            size: Leading bytes of input_path that make up the current
+                version; when appending, anything after them is cut off
+                first, see rotate_pages()
+            
+        Returns:
+            dict: Operation summary, with 'changed' False if nothing was written
+        """
+        if operation == 'rotate':
+            angle = int(params.get('angle', 90))
+            appending = output_path == input_path
+            if appending and size is not None:
+                self._truncate(output_path, size)
+            total_pages = self.page_count(input_path, size)
+            pages = PageSet.parse(params.get('pages', 'all'), total_pages, strict=False).unique()
+            
+            if appending:
+                bytes_written = self.rotate_pages(output_path, angle, pages, size)
+            else:
+                bytes_written = self.rotate_into(input_path, output_path, angle, pages, size)
+            return {'changed': True, 'pages_rotated': len(pages), 'bytes_written': bytes_written}
+        
+        if operation == 'find_replace':
+            find_text = params.get('find_text', '')
+            if not find_text:
+                raise ValueError('Please provide text to find')
+            replacements = self.replace_text(
+                input_path, output_path, find_text, params.get('replace_text', ''), size
+            )
+            return {'changed': replacements > 0, 'replacements': replacements}
+        
+        if operation == 'reorder':
+            total_pages = self.page_count(input_path, size)
+            order = self.page_order(params, total_pages)
+            
+            page_count = self.reorder_pages(input_path, output_path, order, size)
+            return {'changed': True, 'page_count': page_count, 'order': PageSet([order], total_pages).to_spec()}
+        
+        if operation == 'redact':
+            return self.redact(input_path, output_path, params, size)
+        
+        raise ValueError(f"Unsupported operation: {operation}")
+    
+    def render_pages(self, input_path, pages, dpi=150, colorspace='rgb', image_format='png', quality=85, size=None):
+        """
+        Rasterize pages and encode them as images
+        
+        Pages are rendered one after another so only one pixmap is alive at
+        a time in this process.
+        
+        Args:
+            input_path: Path to input PDF
+            pages: List of 0-indexed page numbers
+            dpi: Resolution
+            colorspace: 'rgb', 'gray' or 'cmyk'
+            image_format: Pillow format name, e.g. 'PNG', 'JPEG', 'WEBP'
+            quality: JPEG/WebP quality, 1-100
+            size: Leading bytes of input_path that make up the document
+            
+        Returns:
+            list: Encoded image bytes per page, in the order of pages
+        """
+        fitz_colorspace, mode = {
+            'rgb': (fitz.csRGB, 'RGB'),
+            'gray': (fitz.csGRAY, 'L'),
+            'cmyk': (fitz.csCMYK, 'CMYK'),
+        }[colorspace]
+        
+        pdf = open_pdf(input_path, size)
+        images = []
+        try:
+            for page_num in pages:
+                pix = pdf[page_num].get_pixmap(dpi=dpi, colorspace=fitz_colorspace, alpha=False)
+                image = Image.frombuffer(mode, (pix.width, pix.height), pix.samples_mv, 'raw', mode, pix.stride, 1)
+                
+                buffer = io.BytesIO()
+                if image_format.upper() == 'PNG':
+                    image.save(buffer, 'PNG', dpi=(dpi, dpi))
+                else:
+                    image.save(buffer, image_format, quality=quality, dpi=(dpi, dpi))
+                images.append(buffer.getvalue())
+                del image, pix
+        finally:
+            pdf.close()
+        return images
+    
+    def page_count(self, input_path, size=None):
+        """Number of pages of a PDF, or of the document in its first `size` bytes"""
+        pdf = open_pdf(input_path, size)
+        try:
+            return len(pdf)
+        finally:
+            pdf.close()
+    
+    def page_sizes(self, input_path, pages, size=None):
+        """
+        Page dimensions, e.g. to plan rendering before any page is rendered
+        
+        Returns:
+            list: (width, height) in points per page, in the order of pages
+        """
+        pdf = open_pdf(input_path, size)
+        try:
+            return [(pdf[page_num].rect.width, pdf[page_num].rect.height) for page_num in pages]
+        finally:
+            pdf.close()
+    
+    def extract_content(self, input_path, pages, mode='text', size=None):
+        """
+        Extract text or structured layout from pages
+        
+        Args:
+            input_path: Path to input PDF
+            pages: PageSet or list of 0-indexed page numbers
+            mode: 'text' for plain text, 'blocks' for get_text('dict') output
+            size: Leading bytes of input_path that make up the document
+            
+        Returns:
+            list: Extracted content per page, in the order of pages
+        """
+        pdf = open_pdf(input_path, size)
+        try:
+            return [self.page_content(pdf[page_num], mode) for page_num in pages]
+        finally:
+            pdf.close()
+    
+    @staticmethod
+    def page_content(page, mode):
+        """Text of a page, or its blocks/lines/spans without image data"""
+        if mode == 'blocks':
+            return page.get_text('dict', flags=fitz.TEXTFLAGS_DICT & ~fitz.TEXT_PRESERVE_IMAGES)
+        return page.get_text('text')
+    
+    def verify_files(self, checks, hashes=True, open_files=False):
+        """
+        Compare stored files with what the database records about them
+        
+        Args:
+            checks: (name, size, content_hash, exact) per file to check;
+                the content is the first `size` bytes of the file, or the
+                whole file of exactly `size` bytes with `exact`. size and
+                content_hash may be None when not recorded.
+            hashes: Compare SHA-256 digests where one is recorded
+            open_files: Also open each file, or its prefix, with MuPDF
+            
+        Returns:
+            list: {'size': stored size or None, 'problems': [...]} per check
+        """
+        results = []
+        for name, size, content_hash, exact in checks:
+            if not name or not default_storage.exists(name):
+                results.append({'size': None, 'problems': ['missing']})
+                continue
+            
+            problems = []
+            actual = default_storage.size(name)
+            if size is not None and exact and actual != size:
+                problems.append(f'size is {actual} bytes, {size} recorded')
+            elif size is not None and actual < size:
+                problems.append(f'truncated to {actual} of {size} bytes')
+            
+            if not problems and ((hashes and content_hash) or open_files):
+                path = local_path(name)
+                if hashes and content_hash and file_sha256(path, size) != content_hash:
+                    problems.append('content hash mismatch')
+                if open_files:
+                    try:
+                        pdf = open_pdf(path, size)
+                        page_count = len(pdf)
+                        pdf.close()
+                        if page_count == 0:
+                            problems.append('PDF has no pages')
+                    except MemoryError:
+                        # The worker's limit, not the file: fail the check
+                        raise
+                    except Exception as e:
+                        problems.append(f'does not open: {e}')
             
-        except Exception as e:
-            print(f"❌ Split error: {str(e)}")
-            import traceback
-            traceback.print_exc()
-            return []
\ No newline at end of file
+            results.append({'size': actual, 'problems': problems})
+        return results
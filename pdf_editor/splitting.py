@@ -0,0 +1,57 @@
+from django.conf import settings
+from .worker_pool import call, submit, result
+
+
+def group_parts(parts, groups):
+    """
+    Split a plan into at most `groups` runs of consecutive parts with
+    about the same number of pages each
+    """
+    total_pages = sum(part['last'] - part['first'] + 1 for part in parts)
+    target = total_pages / max(min(groups, len(parts)), 1)
+
+    grouped = [[]]
+    pages = 0
+    for part in parts:
+        if grouped[-1] and pages >= target * len(grouped):
+            grouped.append([])
+        grouped[-1].append(part)
+        pages += part['last'] - part['first'] + 1
+    return grouped
+
+
+def split_planned(input_path, mode, options, size=None):
+    """
+    Split a document by outline, page count or size
+
+    The plan is computed once from the document's metadata, then its parts
+    are written in groups across the worker pool, each worker opening the
+    source once for all parts of its group.
+
+    Args:
+        input_path: Local path of the PDF
+        mode: One of SimplePDFEditor.SPLIT_PLAN_MODES
+        options: level, every or max_bytes for the mode
+        size: Leading bytes of input_path that make up the document
+
+    Raises:
+        ValueError: Invalid mode or options
+
+    Returns:
+        tuple: (parts as planned, (filename, bytes) per part)
+    """
+    parts = call('split_plan', input_path, mode, size=size, **options)
+
+    groups = group_parts(parts, settings.PDF_WORKER_PROCESSES)
+    if len(groups) == 1:
+        return parts, call('split_parts', input_path, parts, size)
+
+    futures = [submit('split_parts', input_path, group, size) for group in groups]
+    output_files = []
+    try:
+        for future in futures:
+            output_files.extend(result(future))
+    finally:
+        for future in futures:
+            future.cancel()
+    return parts, output_files
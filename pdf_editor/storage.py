@@ -0,0 +1,252 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage, default_storage
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows
+    fcntl = None
+
+
+class LocalPDFStorage(FileSystemStorage):
+    """
+    Local-disk storage under MEDIA_ROOT
+
+    Adds the operations the editor needs on top of Django's storage API;
+    S3PDFStorage provides the same ones for S3-compatible object stores.
+    """
+    is_local = True
+
+    def fingerprint(self, name):
+        """Token that changes whenever the stored content does"""
+        stat = os.stat(self.path(name))
+        return f"{stat.st_mtime_ns}-{stat.st_size}"
+
+    def download_to(self, name, path):
+        """Copy a stored file to a local path"""
+        shutil.copyfile(self.path(name), path)
+
+    def replace(self, name, content):
+        """Store content under exactly `name`, overwriting any existing file"""
+        path = self.path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            for chunk in content.chunks():
+                f.write(chunk)
+        os.replace(tmp_path, path)
+        return name
+
+
+class ReadThroughCache:
+    """
+    Local copies of remote files, evicted least recently used first
+
+    Entries are keyed by storage name. Next to each one a tag file holds
+    the storage fingerprint (the ETag on S3) of the content it was
+    fetched or uploaded as; an entry whose tag does not match the remote
+    fingerprint, e.g. a file rewritten from another machine, is fetched
+    again. The directory is shared by every web and pool process on the
+    machine.
+    """
+
+    LOCK_NAME = '.lock'
+    TAG_SUFFIX = '.tag'
+
+    def __init__(self, root, max_bytes, min_age=600):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.min_age = min_age
+        self._lock = threading.Lock()
+
+    def path_for(self, name):
+        digest = hashlib.sha1(name.encode('utf-8')).hexdigest()
+        return os.path.join(self.root, digest[:2], f"{digest}{os.path.splitext(name)[1]}")
+
+    def get(self, storage, name):
+        """Local path holding the current content of `name`"""
+        path = self.path_for(name)
+        # Taken before the download: if the object changes in between, the
+        # tag is already stale and the next get() fetches it again
+        fingerprint = storage.fingerprint(name)
+        if os.path.exists(path) and self._read_tag(path) == fingerprint:
+            os.utime(path)
+            return path
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.invalidate(name)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.part')
+        os.close(fd)
+        try:
+            storage.download_to(name, tmp_path)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self.mark(name, fingerprint)
+
+        self.evict(keep=path)
+        return path
+
+    def mark(self, name, fingerprint):
+        """Record that the entry for `name` holds the content `fingerprint`"""
+        tag_path = self.path_for(name) + self.TAG_SUFFIX
+        with open(tag_path, 'w') as f:
+            f.write(fingerprint)
+
+    def invalidate(self, name):
+        """Forget the fingerprint of `name`, e.g. before rewriting its entry"""
+        try:
+            os.remove(self.path_for(name) + self.TAG_SUFFIX)
+        except FileNotFoundError:
+            pass
+
+    def _read_tag(self, path):
+        try:
+            with open(path + self.TAG_SUFFIX) as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def evict(self, keep=None):
+        """
+        Delete least recently used entries until the cache fits max_bytes
+
+        Runs under a lock file so processes do not evict at the same time.
+        `keep`, downloads in progress and entries used or written within
+        the last min_age seconds are never deleted: another process may
+        have just got them from get() or be writing one as a staging
+        path. Until they age, the cache can exceed max_bytes.
+        """
+        with self._lock, self._file_lock():
+            entries = []
+            total = 0
+            recent = time.time() - self.min_age
+            for dirpath, _, filenames in os.walk(self.root):
+                for filename in filenames:
+                    path = os.path.join(dirpath, filename)
+                    if filename == self.LOCK_NAME or filename.endswith(self.TAG_SUFFIX):
+                        continue
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    total += stat.st_size
+                    if path == keep or filename.endswith('.part') or stat.st_mtime > recent:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, path))
+
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                    total -= size
+                except FileNotFoundError:
+                    pass
+                try:
+                    os.remove(path + self.TAG_SUFFIX)
+                except FileNotFoundError:
+                    pass
+
+    @contextmanager
+    def _file_lock(self):
+        if fcntl is None:
+            yield
+            return
+        os.makedirs(self.root, exist_ok=True)
+        with open(os.path.join(self.root, self.LOCK_NAME), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ReadThroughCache(settings.PDF_STORAGE_CACHE_DIR, settings.PDF_STORAGE_CACHE_MAX_BYTES)
+        return _cache
+
+
+def is_local(storage=None):
+    """Whether files of the storage can be used in place on this machine"""
+    storage = storage or default_storage
+    local = getattr(storage, 'is_local', None)
+    if local is None:
+        try:
+            storage.path('')
+            local = True
+        except NotImplementedError:
+            local = False
+    return local
+
+
+def local_path(name):
+    """
+    Filesystem path with the current content of a stored file
+
+    Remote files are fetched through the read-through cache.
+    """
+    if is_local():
+        return default_storage.path(name)
+    return get_cache().get(default_storage, name)
+
+
+def storage_directories(prefix):
+    """Every directory under `prefix` in default storage, sorted, `prefix` included"""
+    directories = []
+    pending = [prefix]
+    while pending:
+        directory = pending.pop()
+        directories.append(directory)
+        try:
+            subdirectories, _ = default_storage.listdir(directory)
+        except FileNotFoundError:
+            continue
+        pending.extend(f'{directory}/{name}' for name in subdirectories)
+    return sorted(directories)
+
+
+def staging_path(name, fetch=False):
+    """
+    Filesystem path to write the file stored as `name`
+
+    Call commit() afterwards so remote backends receive the result.
+
+    Args:
+        name: Storage name of the file
+        fetch: Start from the stored content, e.g. to append to it
+    """
+    if is_local():
+        path = default_storage.path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    cache = get_cache()
+    path = cache.get(default_storage, name) if fetch else cache.path_for(name)
+    # The entry no longer matches the stored file until commit()
+    cache.invalidate(name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+
+def commit(name, path):
+    """Upload a file written at staging_path(name) to remote storage"""
+    if is_local():
+        return name
+    with open(path, 'rb') as f:
+        name = default_storage.replace(name, File(f, name=os.path.basename(name)))
+    get_cache().mark(name, default_storage.fingerprint(name))
+    return name
+
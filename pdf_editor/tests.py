@@ -1,3 +1,1530 @@
-from django.test import TestCase
+import contextvars
+import hashlib
+import http.client
+import io
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import re
+import shutil
+import tempfile
+import zipfile
+from concurrent.futures import Future
+from unittest import mock, skipIf
 
-# Create your tests here.
+import fitz
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from . import log
+from .document_access import file_sha256, open_pdf
+from .extraction import cache_key
+from .management.commands import loadtest
+from .log import ContextFilter, DebugSamplingFilter, JSONFormatter, QueuedStreamHandler
+from .models import PDFDocument
+from .page_selection import PageSelectionError, PageSet
+from .rasterize import iter_rendered, render_options
+from .simple_operations import SimplePDFEditor
+from .storage import local_path, staging_path
+from .versioning import (
+    VersionConflict, compact_versions, head_version, record_version, version_file_name
+)
+from .worker_pool import WorkerStopped, call, reset_pool, run_many, submit
+
+try:
+    import boto3
+    from moto import mock_aws
+except ImportError:  # Only needed for the S3 tests
+    boto3 = mock_aws = None
+
+
+def make_pdf(pages=3, toc=None):
+    pdf = fitz.open()
+    for page_num in range(pages):
+        pdf.new_page().insert_text((72, 72), f'Page {page_num + 1}')
+    if toc:
+        pdf.set_toc(toc)
+    data = pdf.tobytes()
+    pdf.close()
+    return data
+
+
+def rotations(path, size=None):
+    pdf = open_pdf(path, size)
+    try:
+        return [page.rotation for page in pdf]
+    finally:
+        pdf.close()
+
+
+class StorageTestCase(TestCase):
+    """Runs against a temporary MEDIA_ROOT with PDF work done inline"""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        settings_override = override_settings(
+            MEDIA_ROOT=os.path.join(self.root, 'media'),
+            PDF_LOCK_DIR=os.path.join(self.root, 'locks'),
+            PDF_WORKER_ISOLATION=False,
+            PDF_VERSION_MAX_DEPTH=20,
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def upload(self, pages=3, toc=None):
+        data = make_pdf(pages, toc)
+        return PDFDocument.objects.create(
+            title='doc.pdf',
+            original_file=ContentFile(data, name='doc.pdf'),
+            file_size=len(data)
+        )
+
+    def write_version(self, document, number, rotate_page=0):
+        """Store a rotated copy of the upload as the file of a new version"""
+        name = version_file_name(document, number)
+        pdf = open_pdf(document.original_file)
+        pdf[rotate_page].set_rotation(90)
+        pdf.save(staging_path(name))
+        pdf.close()
+        return name
+
+    def rotate_in_place(self, document, pages):
+        return self.client.post(
+            f'/api/documents/{document.id}/rotate/',
+            {'angle': 90, 'pages': pages, 'in_place': True},
+            content_type='application/json'
+        )
+
+
+class VersionChainTests(StorageTestCase):
+
+    def test_upload_is_version_zero(self):
+        document = self.upload()
+        version = head_version(document)
+
+        self.assertEqual(version.number, 0)
+        self.assertEqual(version.operation, 'upload')
+        self.assertEqual(version.size, document.file_size)
+        self.assertEqual(version.content_hash, file_sha256(local_path(document.original_file.name)))
+
+    def test_record_version_chains_and_moves_current_file(self):
+        document = self.upload()
+        root = head_version(document)
+        name = self.write_version(document, 1)
+
+        version = record_version(document, root, 'rotate', {'angle': 90}, name)
+
+        self.assertEqual((version.number, version.depth, version.parent_id), (1, 1, root.id))
+        self.assertEqual(version.size, os.path.getsize(local_path(name)))
+        self.assertEqual(head_version(document), version)
+        document.refresh_from_db()
+        self.assertEqual(document.current_file.name, name)
+
+    def test_conflict_discards_the_losing_file(self):
+        document = self.upload()
+        root = head_version(document)
+        winner = record_version(document, root, 'rotate', {}, self.write_version(document, 1))
+        loser_name = self.write_version(document, 1, rotate_page=1)
+
+        with self.assertRaises(VersionConflict):
+            record_version(document, root, 'rotate', {}, loser_name)
+
+        self.assertFalse(default_storage.exists(loser_name))
+        self.assertEqual(head_version(document), winner)
+
+    def test_compaction_flattens_the_chain(self):
+        document = self.upload()
+        for number in range(1, 4):
+            parent = head_version(document)
+            record_version(document, parent, 'rotate', {}, self.write_version(document, number, number - 1))
+        stale = [version.file.name for version in document.versions.filter(number__gt=0)]
+
+        with self.captureOnCommitCallbacks(execute=True):
+            compacted = compact_versions(document)
+
+        self.assertEqual(compacted.operation, 'compact')
+        self.assertEqual((compacted.number, compacted.depth), (4, 1))
+        self.assertEqual(list(document.versions.values_list('number', flat=True).order_by('number')), [0, 4])
+        self.assertEqual(compacted.content_hash, file_sha256(local_path(compacted.file.name)))
+        for name in stale:
+            self.assertFalse(default_storage.exists(name))
+        # Compacted from v3, whose file only rotates the third page
+        self.assertEqual(rotations(local_path(compacted.file.name)), [0, 0, 90])
+
+    def test_deep_chain_is_compacted_when_recorded(self):
+        document = self.upload()
+        with override_settings(PDF_VERSION_MAX_DEPTH=2), self.captureOnCommitCallbacks(execute=True):
+            for pages in ('1', '2', '3'):
+                self.assertEqual(self.rotate_in_place(document, pages).status_code, 200)
+
+        head = head_version(document)
+        self.assertEqual(head.operation, 'compact')
+        self.assertEqual(head.depth, 1)
+        self.assertEqual(rotations(local_path(head.file.name)), [90, 90, 90])
+
+
+    def test_compaction_waits_for_the_transaction(self):
+        document = self.upload()
+        with override_settings(PDF_VERSION_MAX_DEPTH=1), self.captureOnCommitCallbacks() as callbacks:
+            for number in (1, 2):
+                parent = head_version(document)
+                version = record_version(document, parent, 'rotate', {}, self.write_version(document, number))
+
+            # Still inside the transaction that holds the document rows
+            self.assertEqual(version.depth, 2)
+            self.assertEqual(head_version(document), version)
+
+        self.assertEqual(len(callbacks), 1)
+        callbacks[0]()
+        self.assertEqual(head_version(document).operation, 'compact')
+
+    def test_versions_of_a_document_without_its_file(self):
+        document = self.upload()
+        default_storage.delete(document.original_file.name)
+
+        response = self.client.get(f'/api/documents/{document.id}/versions/')
+
+        self.assertEqual(response.status_code, 500)
+        self.assertIn('error', response.json())
+
+
+class InPlaceRotateTests(StorageTestCase):
+
+    def test_each_edit_records_its_own_size(self):
+        document = self.upload()
+        self.rotate_in_place(document, '1')
+        self.rotate_in_place(document, '2')
+
+        v1, v2 = document.versions.filter(number__gt=0).order_by('number')
+        path = local_path(v2.file.name)
+        self.assertEqual(v1.file.name, v2.file.name)
+        self.assertLess(v1.size, v2.size)
+        self.assertEqual(os.path.getsize(path), v2.size)
+        self.assertEqual(v1.content_hash, file_sha256(path, v1.size))
+        self.assertEqual(rotations(path, v1.size), [90, 0, 0])
+        self.assertEqual(rotations(path, v2.size), [90, 90, 0])
+
+    def test_unrecorded_bytes_are_cut_off(self):
+        document = self.upload()
+        self.rotate_in_place(document, '1')
+        v1 = head_version(document)
+        path = local_path(v1.file.name)
+        with open(path, 'ab') as f:
+            f.write(b'\n% left by an edit that was never recorded\n')
+
+        self.assertEqual(self.rotate_in_place(document, '2').status_code, 200)
+
+        v2 = head_version(document)
+        self.assertEqual(v2.file.name, v1.file.name)
+        self.assertEqual(os.path.getsize(path), v2.size)
+        self.assertEqual(v2.content_hash, file_sha256(path))
+        self.assertNotIn(b'never recorded', open(path, 'rb').read())
+
+    def test_edits_ignore_bytes_no_version_records(self):
+        document = self.upload()
+        self.rotate_in_place(document, '1')
+        v1 = head_version(document)
+        path = local_path(v1.file.name)
+        # An append still in flight, or left by a request that died
+        SimplePDFEditor().rotate_pages(path, 180, [2])
+        self.assertGreater(os.path.getsize(path), v1.size)
+
+        download = self.client.get(f'/api/documents/{document.id}/download/')
+        self.assertEqual(b''.join(download.streaming_content), open(path, 'rb').read()[:v1.size])
+
+        response = self.client.post(
+            f'/api/documents/{document.id}/find_replace/',
+            {'find_text': 'Page 2', 'replace_text': 'Second'},
+            content_type='application/json'
+        )
+
+        self.assertEqual(response.status_code, 200)
+        v2 = head_version(document)
+        self.assertEqual(v2.parent_id, v1.id)
+        self.assertEqual(rotations(local_path(v2.file.name)), [90, 0, 0])
+
+    def test_failed_record_truncates_the_append(self):
+        document = self.upload()
+        self.rotate_in_place(document, '1')
+        v1 = head_version(document)
+
+        with mock.patch('pdf_editor.views.record_version', side_effect=VersionConflict('edited concurrently')):
+            response = self.rotate_in_place(document, '2')
+
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(os.path.getsize(local_path(v1.file.name)), v1.size)
+        self.assertEqual(head_version(document), v1)
+
+    def test_file_that_cannot_be_appended_to_gets_a_new_file(self):
+        document = self.upload()
+        self.rotate_in_place(document, '1')
+        v1 = head_version(document)
+        path = local_path(v1.file.name)
+        # A wrong xref offset makes MuPDF repair the file on open
+        damaged = re.sub(rb'startxref\s+\d+', b'startxref\n12', open(path, 'rb').read())
+        with open(path, 'wb') as f:
+            f.write(damaged)
+        v1.size = len(damaged)
+        v1.content_hash = file_sha256(path)
+        v1.save()
+
+        self.assertEqual(self.rotate_in_place(document, '2').status_code, 200)
+
+        v2 = head_version(document)
+        self.assertNotEqual(v2.file.name, v1.file.name)
+        self.assertEqual(open(path, 'rb').read(), damaged)
+        self.assertEqual(rotations(local_path(v2.file.name)), [90, 90, 0])
+
+
+class PageSetTests(SimpleTestCase):
+
+    def test_keywords(self):
+        self.assertEqual(list(PageSet.parse('all', 4)), [0, 1, 2, 3])
+        self.assertEqual(list(PageSet.parse('odd', 5)), [0, 2, 4])
+        self.assertEqual(list(PageSet.parse('even', 5)), [1, 3])
+        self.assertEqual(list(PageSet.parse('last', 5)), [4])
+        self.assertEqual(list(PageSet.parse('3-last', 5)), [2, 3, 4])
+
+    def test_negative_numbers_count_from_the_end(self):
+        self.assertEqual(list(PageSet.parse('-1', 5)), [4])
+        self.assertEqual(list(PageSet.parse('-3--1', 5)), [2, 3, 4])
+        self.assertEqual(list(PageSet.parse('4-', 5)), [3, 4])
+
+    def test_lists_and_duplicates_keep_selection_order(self):
+        pages = PageSet.parse([5, '1-2', 1], 5)
+        self.assertEqual(list(pages), [4, 0, 1, 0])
+        self.assertEqual(list(pages.unique()), [0, 1, 4])
+
+    def test_adjacent_selections_coalesce_into_runs(self):
+        self.assertEqual(PageSet.parse('1-3,4,5-9', 10).runs(), [(0, 8)])
+        self.assertEqual(PageSet.parse('7,1-2,3', 10).runs(), [(6, 6), (0, 2)])
+        self.assertEqual(PageSet.parse('odd', 5).runs(), [(0, 0), (2, 2), (4, 4)])
+        self.assertEqual(PageSet.parse('1,2,3,7', 10).to_spec(), '1-3,7')
+
+    def test_strict_rejects_pages_outside_the_document(self):
+        for selection in ('6', '4-6', '0', '-6'):
+            with self.assertRaises(PageSelectionError):
+                PageSet.parse(selection, 5)
+
+    def test_non_strict_drops_pages_outside_the_document(self):
+        self.assertEqual(list(PageSet.parse('4-8', 5, strict=False)), [3, 4])
+        self.assertEqual(list(PageSet.parse('2,9', 5, strict=False)), [1])
+
+    def test_malformed_selections_are_rejected(self):
+        for selection in ('', None, 'abc', '5-2', '1-2-3'):
+            with self.assertRaises(PageSelectionError):
+                PageSet.parse(selection, 5, strict=False)
+
+
+class WorkerPoolTests(SimpleTestCase):
+    """Runs jobs in real spawned worker processes"""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        settings_override = override_settings(
+            PDF_WORKER_ISOLATION=True,
+            PDF_WORKER_PROCESSES=1,
+            PDF_WORKER_JOB_TIMEOUT=1,
+            PDF_WORKER_MEMORY_LIMIT=1536 * 1024 ** 2,
+            PDF_WORKER_MAX_TASKS=0,
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        reset_pool()
+        self.addCleanup(reset_pool)
+
+        self.path = os.path.join(self.root, 'doc.pdf')
+        with open(self.path, 'wb') as f:
+            f.write(make_pdf(3))
+
+    def slow_job(self):
+        # Renders for several seconds, well past the 1 s job timeout
+        return ('render_pages', (self.path, [0, 1, 2] * 40), {'dpi': 300})
+
+    def test_job_past_the_timeout_stops_its_worker(self):
+        method, args, kwargs = self.slow_job()
+        with self.assertRaises(WorkerStopped):
+            call(method, *args, **kwargs)
+
+        # The pool is replaced for the next job
+        self.assertEqual(call('page_count', self.path), 3)
+
+    def test_memory_limit_fails_the_job_not_the_pool(self):
+        large = os.path.join(self.root, 'large.pdf')
+        pdf = fitz.open()
+        pdf.new_page(width=3000, height=3000)
+        pdf.save(large)
+        pdf.close()
+
+        # A 600 dpi pixmap of that page needs about 1.9 GB
+        with self.assertRaises((MemoryError, RuntimeError)):
+            call('render_pages', large, [0], dpi=600)
+        self.assertEqual(call('page_count', self.path), 3)
+
+    def test_workers_are_replaced_after_max_tasks(self):
+        pids = set()
+        with override_settings(PDF_WORKER_MAX_TASKS=2):
+            reset_pool()
+            for _ in range(4):
+                self.assertEqual(call('page_count', self.path), 3)
+                pids.update(process.pid for process in multiprocessing.active_children())
+        self.assertGreaterEqual(len(pids), 2)
+
+    def test_jobs_lost_with_a_worker_are_retried_alone(self):
+        jobs = {
+            'slow': self.slow_job(),
+            'a': ('page_count', (self.path,), {}),
+            'b': ('page_sizes', (self.path, [0]), {}),
+        }
+
+        results = run_many(jobs)
+
+        self.assertEqual(results['a'], (3, None))
+        self.assertEqual(results['b'][0], [(595.0, 842.0)])
+        self.assertIsInstance(results['slow'][1], WorkerStopped)
+
+    def test_jobs_marked_once_are_not_retried(self):
+        jobs = {'slow': self.slow_job(), 'a': ('page_count', (self.path,), {})}
+
+        results = run_many(jobs, once=['slow'])
+
+        self.assertIsInstance(results['slow'][1], WorkerStopped)
+        self.assertEqual(results['a'], (3, None))
+
+    def test_without_isolation_jobs_run_inline(self):
+        with override_settings(PDF_WORKER_ISOLATION=False):
+            future = submit('page_count', self.path)
+            self.assertTrue(future.done())
+            self.assertEqual(future.result(), 3)
+
+            results = run_many({
+                'ok': ('page_count', (self.path,), {}),
+                'missing': ('page_count', (os.path.join(self.root, 'missing.pdf'),), {}),
+            })
+        self.assertEqual(results['ok'], (3, None))
+        self.assertIsNotNone(results['missing'][1])
+
+
+class BulkTests(StorageTestCase):
+
+    def bulk(self, document_ids, **operation):
+        return self.client.post(
+            '/api/documents/bulk/',
+            {'document_ids': document_ids, 'operation': operation},
+            content_type='application/json'
+        )
+
+    def test_failures_are_reported_per_document(self):
+        good = self.upload()
+        broken = self.upload()
+        head_version(broken)
+        with open(local_path(broken.original_file.name), 'wb') as f:
+            f.write(b'not a pdf')
+        missing = '00000000-0000-0000-0000-000000000000'
+
+        response = self.bulk([str(good.id), 'not-a-uuid', missing, str(broken.id)], type='rotate', angle=90)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.data['succeeded'], response.data['failed']), (1, 3))
+        results = response.data['results']
+        self.assertEqual([result['status'] for result in results], ['ok', 'error', 'error', 'error'])
+        self.assertEqual(results[1]['error'], 'Invalid document id')
+        self.assertEqual(results[2]['error'], 'Document not found')
+        self.assertEqual(results[0]['version'], 1)
+        self.assertEqual(head_version(broken).number, 0)
+
+        version = head_version(good)
+        self.assertEqual(rotations(local_path(version.file.name), version.size), [90, 90, 90])
+
+    def test_duplicate_ids_are_processed_once_in_order(self):
+        first = self.upload()
+        second = self.upload()
+        ids = [str(second.id), str(first.id), str(second.id)]
+
+        response = self.bulk(ids, type='rotate', angle=90, pages='1')
+
+        self.assertEqual([result['document_id'] for result in response.data['results']], ids[:2])
+        for document in (first, second):
+            version = head_version(document)
+            self.assertEqual(version.number, 1)
+            self.assertEqual(rotations(local_path(version.file.name), version.size), [90, 0, 0])
+
+    def test_invalid_requests_are_rejected(self):
+        document = self.upload()
+
+        self.assertEqual(self.bulk([], type='rotate', angle=90).status_code, 400)
+        self.assertEqual(self.bulk([str(document.id)], type='split').status_code, 400)
+        with override_settings(PDF_BULK_MAX_DOCUMENTS=1):
+            response = self.bulk([str(document.id), str(self.upload().id)], type='rotate', angle=90)
+        self.assertEqual(response.status_code, 400)
+
+
+class DeliveryTests(StorageTestCase):
+
+    def download(self, document, backend):
+        with override_settings(PDF_FILE_DELIVERY=backend, PDF_X_ACCEL_REDIRECT_PREFIX='/protected/'):
+            return self.client.get(f'/api/documents/{document.id}/download_original/')
+
+    def test_sendfile_hands_the_file_to_the_server(self):
+        document = self.upload()
+
+        response = self.download(document, 'sendfile')
+
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'application/pdf')
+        self.assertEqual(response['Content-Disposition'], 'inline; filename="doc.pdf"')
+        self.assertEqual(b''.join(response.streaming_content), document.original_file.read())
+        response.close()
+
+    def test_python_streams_with_a_content_length(self):
+        document = self.upload()
+
+        response = self.download(document, 'python')
+
+        self.assertEqual(int(response['Content-Length']), document.file_size)
+        self.assertEqual(b''.join(response.streaming_content), document.original_file.read())
+
+    def test_proxy_backends_send_only_headers(self):
+        document = self.upload()
+        name = document.original_file.name
+
+        response = self.download(document, 'x-accel-redirect')
+        self.assertEqual(response['X-Accel-Redirect'], f'/protected/{name}')
+        self.assertEqual(response.content, b'')
+
+        response = self.download(document, 'x-sendfile')
+        self.assertEqual(response['X-Sendfile'], local_path(name))
+        self.assertEqual(response['Content-Type'], 'application/pdf')
+
+    def test_bytes_past_the_head_version_are_streamed_from_python(self):
+        document = self.upload()
+        self.rotate_in_place(document, 'all')
+        version = head_version(document)
+        with open(local_path(version.file.name), 'ab') as f:
+            f.write(b'unrecorded')
+
+        with override_settings(PDF_FILE_DELIVERY='x-accel-redirect'):
+            response = self.client.get(f'/api/documents/{document.id}/download/')
+
+        self.assertNotIn('X-Accel-Redirect', response)
+        self.assertEqual(int(response['Content-Length']), version.size)
+        self.assertEqual(len(b''.join(response.streaming_content)), version.size)
+
+    def test_media_files_are_served_from_storage(self):
+        document = self.upload()
+
+        response = self.client.get(f'/media/{document.original_file.name}')
+        self.assertEqual(b''.join(response.streaming_content), document.original_file.read())
+        response.close()
+
+        for path in ('pdfs/original', 'pdfs/original/missing.pdf', '../settings.py'):
+            self.assertEqual(self.client.get(f'/media/{path}').status_code, 404, path)
+
+    def test_unknown_backend_is_a_configuration_error(self):
+        document = self.upload()
+
+        with self.assertRaises(ImproperlyConfigured):
+            self.download(document, 'carrier-pigeon')
+
+
+class DocumentAccessTests(StorageTestCase):
+
+    def test_a_prefix_opens_and_hashes_as_the_older_version(self):
+        document = self.upload()
+        self.rotate_in_place(document, '1')
+        self.rotate_in_place(document, '2')
+        _, original, rotated = document.versions.order_by('number')
+        path = local_path(rotated.file.name)
+        with open(path, 'rb') as f:
+            data = f.read()
+
+        self.assertEqual(rotated.file.name, original.file.name)
+        self.assertEqual(rotations(path, original.size), [90, 0, 0])
+        self.assertEqual(rotations(path), [90, 90, 0])
+        self.assertEqual(file_sha256(path, original.size), hashlib.sha256(data[:original.size]).hexdigest())
+        self.assertEqual(file_sha256(path), hashlib.sha256(data).hexdigest())
+
+    def test_split_and_merge_return_bytes_without_writing_files(self):
+        document = self.upload(4)
+        path = local_path(document.original_file.name)
+        before = sorted(os.listdir(os.path.dirname(path)))
+
+        save = fitz.Document.save
+
+        def save_to_memory(pdf, filename, *args, **kwargs):
+            # tobytes() saves into a BytesIO
+            self.assertNotIsInstance(filename, (str, os.PathLike))
+            return save(pdf, filename, *args, **kwargs)
+
+        with mock.patch.object(fitz.Document, 'save', save_to_memory), \
+                mock.patch('tempfile.mkstemp', side_effect=AssertionError('temp file created')):
+            parts = SimplePDFEditor().split_pdf(path, mode='all')
+            merged = SimplePDFEditor().merge_pdfs([path, path])
+
+        self.assertEqual(len(parts), 4)
+        self.assertTrue(all(isinstance(data, bytes) for _, data in parts))
+        pdf = fitz.open(stream=merged, filetype='pdf')
+        self.assertEqual(len(pdf), 8)
+        pdf.close()
+        self.assertEqual(sorted(os.listdir(os.path.dirname(path))), before)
+
+    def test_split_outputs_do_not_overwrite_each_other(self):
+        document = self.upload()
+
+        urls = [
+            self.client.post(
+                f'/api/documents/{document.id}/split_range/', {'start_page': 1, 'end_page': start},
+                content_type='application/json'
+            ).data['split_file']
+            for start in (1, 1, 2)
+        ]
+
+        self.assertEqual(len(set(urls)), 3)
+        counts = []
+        for url in urls:
+            pdf = open_pdf(local_path(url[len(settings.MEDIA_URL):]))
+            counts.append(len(pdf))
+            pdf.close()
+        self.assertEqual(counts, [1, 1, 2])
+
+    def test_merge_stores_only_the_merged_document(self):
+        first = self.upload()
+        second = self.upload(2)
+
+        response = self.client.post(
+            '/api/documents/merge/', {'document_ids': [str(first.id), str(second.id)]},
+            content_type='application/json'
+        )
+
+        merged = PDFDocument.objects.get(id=response.data['document_id'])
+        self.assertEqual(merged.file_size, response.data['size'])
+        self.assertEqual(os.path.getsize(local_path(merged.original_file.name)), merged.file_size)
+        self.assertFalse(default_storage.exists('pdfs/edited'))
+
+
+@skipIf(mock_aws is None, 'moto is not installed')
+class S3StorageTests(StorageTestCase):
+    """Runs against an in-memory S3 bucket"""
+
+    BUCKET = 'pdf-editor-test'
+
+    def setUp(self):
+        super().setUp()
+        aws = mock_aws()
+        aws.start()
+        self.addCleanup(aws.stop)
+        self.client_s3 = boto3.client('s3', region_name='us-east-1')
+        self.client_s3.create_bucket(Bucket=self.BUCKET)
+
+        settings_override = override_settings(
+            STORAGES={
+                'default': {
+                    'BACKEND': 'pdf_editor.s3_storage.S3PDFStorage',
+                    'OPTIONS': {
+                        'bucket_name': self.BUCKET,
+                        'region_name': 'us-east-1',
+                        'access_key': 'testing',
+                        'secret_key': 'testing',
+                        'file_overwrite': False,
+                    },
+                },
+                'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'},
+            },
+            PDF_STORAGE_CACHE_DIR=os.path.join(self.root, 'cache'),
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        cache_patch = mock.patch('pdf_editor.storage._cache', None)
+        cache_patch.start()
+        self.addCleanup(cache_patch.stop)
+
+    def stored(self, name):
+        return self.client_s3.get_object(Bucket=self.BUCKET, Key=name)['Body'].read()
+
+    def test_edits_are_uploaded_and_downloads_redirect(self):
+        document = self.upload()
+
+        self.rotate_in_place(document, '1')
+        self.rotate_in_place(document, '2')
+
+        version = head_version(document)
+        self.assertEqual(version.number, 2)
+        data = self.stored(version.file.name)
+        self.assertEqual(len(data), version.size)
+        self.assertEqual(hashlib.sha256(data).hexdigest(), version.content_hash)
+        self.assertEqual(rotations(local_path(version.file.name), version.size), [90, 90, 0])
+
+        response = self.client.get(f'/api/documents/{document.id}/download/')
+        self.assertEqual(response.status_code, 302)
+        self.assertIn(self.BUCKET, response['Location'])
+
+    def test_cached_copy_is_fetched_again_when_the_object_changes(self):
+        document = self.upload()
+        name = document.original_file.name
+        path = local_path(name)
+        self.assertEqual(rotations(path), [0, 0, 0])
+
+        # Same size, different content: only the ETag tells them apart
+        data = b'%' * document.file_size
+        self.client_s3.put_object(Bucket=self.BUCKET, Key=name, Body=data)
+
+        with mock.patch.object(default_storage.__class__, 'download_to', autospec=True,
+                               side_effect=default_storage.__class__.download_to) as download:
+            self.assertEqual(local_path(name), path)
+            self.assertEqual(local_path(name), path)
+        self.assertEqual(download.call_count, 1)
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), data)
+
+    def test_media_files_are_served_from_storage(self):
+        document = self.upload()
+
+        response = self.client.get(f'/media/{document.original_file.name}')
+
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(self.client.get('/media/pdfs/original/missing.pdf').status_code, 404)
+
+
+class ExtractionTests(StorageTestCase):
+
+    def setUp(self):
+        super().setUp()
+        settings_override = override_settings(
+            CACHES={
+                'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+                'pdf_extraction': {
+                    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                    'LOCATION': self.root,
+                },
+            },
+            PDF_EXTRACTION_CHUNK_PAGES=2,
+            PDF_EXTRACTION_PARALLEL_MIN_PAGES=3,
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.document = self.upload(5)
+
+    def stream(self, mode, pages):
+        response = self.client.get(f'/api/documents/{self.document.id}/{mode}/', {'pages': pages})
+        if not response.streaming:
+            return response, None
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        return response, [json.loads(line) for line in lines]
+
+    def cached_chunk(self, chunk):
+        content_hash = head_version(self.document).content_hash
+        return caches['pdf_extraction'].get(cache_key(content_hash, 'text', chunk))
+
+    def extract_content(self, **kwargs):
+        return mock.patch.object(
+            SimplePDFEditor, 'extract_content', autospec=True,
+            side_effect=kwargs.pop('side_effect', SimplePDFEditor.extract_content), **kwargs
+        )
+
+    def test_text_is_streamed_in_selection_order(self):
+        response, records = self.stream('text', '3,1,1')
+
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        self.assertEqual([record['page'] for record in records], [3, 1, 1])
+        self.assertEqual([record['text'].strip() for record in records], ['Page 3', 'Page 1', 'Page 1'])
+
+    def test_blocks_carry_the_page_layout(self):
+        _, records = self.stream('blocks', '2')
+
+        self.assertEqual(records[0]['page'], 2)
+        self.assertEqual((records[0]['width'], records[0]['height']), (595, 842))
+        spans = [span['text'] for block in records[0]['blocks'] for line in block['lines'] for span in line['spans']]
+        self.assertEqual(spans, ['Page 2'])
+
+    def test_pages_are_cached_per_chunk(self):
+        with self.extract_content() as extract:
+            _, records = self.stream('text', 'all')
+        # Parallel path: one job per chunk of two pages
+        self.assertEqual([call_args.args[2] for call_args in extract.call_args_list], [[0, 1], [2, 3], [4]])
+        self.assertEqual([sorted(self.cached_chunk(chunk)) for chunk in range(3)], [[0, 1], [2, 3], [4]])
+
+        with self.extract_content(side_effect=AssertionError('not cached')):
+            _, cached = self.stream('text', '5,1-4')
+        self.assertEqual(cached, records[4:] + records[:4])
+
+    def test_partial_chunks_are_completed(self):
+        self.stream('text', '1')
+
+        with self.extract_content() as extract:
+            _, records = self.stream('text', '1,2')
+
+        self.assertEqual(extract.call_args.args[2], [1])
+        self.assertEqual([record['text'].strip() for record in records], ['Page 1', 'Page 2'])
+        self.assertEqual(sorted(self.cached_chunk(0)), [0, 1])
+
+    def test_worker_failures_are_json_errors(self):
+        with self.extract_content(side_effect=WorkerStopped('worker stopped')):
+            response, _ = self.stream('text', 'all')
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(response.json(), {'error': 'worker stopped'})
+
+        with mock.patch.object(SimplePDFEditor, 'page_count', side_effect=TimeoutError('timed out')):
+            response, _ = self.stream('blocks', 'all')
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(response.json(), {'error': 'timed out'})
+
+    def test_failure_after_the_first_lines_ends_the_stream(self):
+        real = SimplePDFEditor.extract_content
+
+        def fail_after_first_chunk(editor, path, pages, *args):
+            if pages[0]:
+                raise WorkerStopped('worker stopped')
+            return real(editor, path, pages, *args)
+
+        with self.extract_content(side_effect=fail_after_first_chunk):
+            response, records = self.stream('text', 'all')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([record.get('page') for record in records], [1, 2, None])
+        self.assertEqual(records[-1], {'error': 'worker stopped'})
+        self.assertEqual(self.stream('text', '9')[0].status_code, 400)
+
+
+class ReadinessTests(StorageTestCase):
+
+    def setUp(self):
+        super().setUp()
+        reset_pool()
+        self.addCleanup(reset_pool)
+
+    def test_ready_without_isolation(self):
+        response = self.client.get('/api/health/ready/')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['status'], 'ready')
+        self.assertTrue(response.json()['warm'])
+        self.assertEqual(response.json()['pool']['isolation'], False)
+        self.assertEqual(response.json()['database'], 'ok')
+
+    def test_ready_once_the_pool_is_primed(self):
+        with override_settings(PDF_WORKER_ISOLATION=True, PDF_WORKER_PROCESSES=1):
+            response = self.client.get('/api/health/ready/')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.json()['pool']['primed'])
+        self.assertIsNotNone(response.json()['pool']['seconds'])
+
+    def test_unavailable_while_the_pool_cannot_be_primed(self):
+        with override_settings(PDF_WORKER_ISOLATION=True, PDF_WORKER_PROCESSES=1), \
+                mock.patch('pdf_editor.worker_pool.result', side_effect=WorkerStopped('worker stopped')):
+            response = self.client.get('/api/health/ready/')
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.json()['status'], 'unavailable')
+        self.assertFalse(response.json()['pool']['primed'])
+
+    def test_unavailable_without_the_database(self):
+        with mock.patch('pdf_editor.views.connection.ensure_connection', side_effect=Exception('database down')):
+            response = self.client.get('/api/health/ready/')
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.json()['database'], 'database down')
+
+
+class RecordingHandler(logging.Handler):
+
+    def __init__(self):
+        super().__init__()
+        self.records = []
+        self.addFilter(ContextFilter())
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class LoggingTests(StorageTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.handler = RecordingHandler()
+        logger = logging.getLogger('pdf_editor')
+        logger.addHandler(self.handler)
+        self.addCleanup(logger.removeHandler, self.handler)
+
+    def test_json_lines_carry_context_extras_and_tracebacks(self):
+        stream = io.StringIO()
+        handler = QueuedStreamHandler(stream)
+        handler.setFormatter(JSONFormatter())
+        handler.addFilter(ContextFilter())
+        logger = logging.getLogger('pdf_editor.tests.json')
+        logger.addHandler(handler)
+        logger.propagate = False
+        self.addCleanup(setattr, logger, 'propagate', True)
+        self.addCleanup(logger.removeHandler, handler)
+
+        def log_request():
+            log.request_id.set('req-1')
+            log.operation.set('rotate')
+            try:
+                raise ValueError('bad page')
+            except ValueError:
+                logger.exception('Rotate of %s failed', 'doc.pdf', extra={'document_id': 'doc-1', 'pages': 3})
+
+        contextvars.copy_context().run(log_request)
+        handler.close()
+
+        entry = json.loads(stream.getvalue())
+        self.assertEqual(entry['level'], 'ERROR')
+        self.assertEqual(entry['logger'], 'pdf_editor.tests.json')
+        self.assertEqual(entry['message'], 'Rotate of doc.pdf failed')
+        self.assertEqual((entry['request_id'], entry['op'], entry['document_id']), ('req-1', 'rotate', 'doc-1'))
+        self.assertEqual(entry['pages'], 3)
+        self.assertIn('ValueError: bad page', entry['exception'])
+        self.assertRegex(entry['time'], r'^\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d\.\d{3}\+00:00$')
+
+    def test_requests_are_logged_with_their_id_document_and_operation(self):
+        document = self.upload()
+
+        response = self.client.get(f'/api/documents/{document.id}/page_count/', HTTP_X_REQUEST_ID='proxy-id')
+
+        self.assertEqual(response['X-Request-ID'], 'proxy-id')
+        finished = [record for record in self.handler.records if record.name == 'pdf_editor.requests'][-1]
+        self.assertEqual((finished.method, finished.status), ('GET', 200))
+        self.assertGreaterEqual(finished.duration_ms, 0)
+        for record in self.handler.records:
+            self.assertEqual(
+                (record.request_id, record.document_id, record.op), ('proxy-id', str(document.id), 'page_count')
+            )
+
+    def test_request_ids_are_generated(self):
+        first = self.client.get('/api/health/ready/')['X-Request-ID']
+        second = self.client.get('/api/health/ready/')['X-Request-ID']
+
+        self.assertRegex(first, r'^[0-9a-f]{32}$')
+        self.assertNotEqual(first, second)
+
+    def test_debug_records_are_sampled_per_request(self):
+        sampling = DebugSamplingFilter()
+        debug = logging.makeLogRecord({'levelno': logging.DEBUG})
+        info = logging.makeLogRecord({'levelno': logging.INFO})
+
+        def decide(rate):
+            log.sample_debug(rate)
+            return sampling.filter(debug), sampling.filter(info)
+
+        self.assertEqual(contextvars.copy_context().run(decide, 0), (False, True))
+        self.assertEqual(contextvars.copy_context().run(decide, 1), (True, True))
+
+    def test_context_is_handed_to_other_processes(self):
+        def capture():
+            log.request_id.set('req-2')
+            log.document_id.set('doc-2')
+            log.operation.set('text')
+            log.sample_debug(0)
+            return log.current_context()
+
+        context = contextvars.copy_context().run(capture)
+
+        def restore():
+            log.restore_context(context)
+            return log.request_id.get(), log.document_id.get(), log.operation.get(), log.debug_sampled.get()
+
+        self.assertEqual(contextvars.copy_context().run(restore), ('req-2', 'doc-2', 'text', False))
+
+
+class ReorderTests(StorageTestCase):
+
+    TOC = [[1, 'A', 1], [2, 'A.1', 2], [1, 'B', 3], [1, 'No destination', -1]]
+
+    def reorder(self, document, **params):
+        response = self.client.post(
+            f'/api/documents/{document.id}/reorder/', params, content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 200, response.content)
+        version = head_version(document)
+        pdf = open_pdf(local_path(version.file.name), version.size)
+        try:
+            return [page.get_text().strip() for page in pdf], pdf.get_toc(simple=True)
+        finally:
+            pdf.close()
+
+    def test_bookmarks_follow_their_pages(self):
+        document = self.upload(toc=self.TOC)
+
+        pages, toc = self.reorder(document, order='3,1,2')
+
+        self.assertEqual(pages, ['Page 3', 'Page 1', 'Page 2'])
+        self.assertEqual(toc, [[1, 'A', 2], [2, 'A.1', 3], [1, 'B', 1], [1, 'No destination', -1]])
+
+    def test_bookmarks_of_deleted_pages_are_dropped(self):
+        document = self.upload(toc=self.TOC)
+
+        pages, toc = self.reorder(document, delete='1')
+
+        self.assertEqual(pages, ['Page 2', 'Page 3'])
+        self.assertEqual(toc, [[1, 'A.1', 1], [1, 'B', 2], [1, 'No destination', -1]])
+
+    def test_bookmarks_point_at_the_first_copy_of_a_page(self):
+        document = self.upload(toc=self.TOC)
+
+        pages, toc = self.reorder(document, duplicate='1-2')
+
+        self.assertEqual(pages, ['Page 1', 'Page 1', 'Page 2', 'Page 2', 'Page 3'])
+        self.assertEqual(toc[:3], [[1, 'A', 1], [2, 'A.1', 3], [1, 'B', 5]])
+
+
+class MergeDedupTests(StorageTestCase):
+
+    def upload_with_image(self, title):
+        pixmap = fitz.Pixmap(fitz.csRGB, fitz.IRect(0, 0, 64, 64), False)
+        pixmap.set_rect(pixmap.irect, (200, 30, 30))
+        pdf = fitz.open()
+        for page_num in range(2):
+            page = pdf.new_page()
+            page.insert_image(fitz.Rect(72, 72, 272, 272), pixmap=pixmap)
+            page.insert_text((72, 300), f'{title} {page_num + 1}')
+        data = pdf.tobytes(garbage=3, deflate=True)
+        pdf.close()
+        return PDFDocument.objects.create(
+            title=title, original_file=ContentFile(data, name=f'{title}.pdf'), file_size=len(data)
+        )
+
+    def merge(self, documents, dedup):
+        response = self.client.post(
+            '/api/documents/merge/', {'document_ids': [str(d.id) for d in documents], 'dedup': dedup},
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.data, PDFDocument.objects.get(id=response.data['document_id'])
+
+    def test_shared_images_are_stored_once_and_still_render(self):
+        documents = [self.upload_with_image('first'), self.upload_with_image('second')]
+
+        plain, _ = self.merge(documents, False)
+        data, merged = self.merge(documents, True)
+
+        self.assertEqual(data['dedup']['duplicate_streams'], 1)
+        self.assertLess(data['size'], plain['size'])
+
+        pdf = open_pdf(merged.original_file)
+        try:
+            self.assertEqual(len(pdf), 4)
+            xrefs = {image[0] for page in pdf for image in page.get_images()}
+            self.assertEqual(len(xrefs), 1)
+            image = pdf.extract_image(xrefs.pop())
+            self.assertEqual((image['width'], image['height']), (64, 64))
+            for page in pdf:
+                self.assertEqual(len(page.get_image_info()), 1)
+            self.assertEqual(pdf[3].get_text().strip(), 'second 2')
+        finally:
+            pdf.close()
+
+
+class ExportImagesTests(StorageTestCase):
+
+    def export(self, document, **params):
+        return self.client.post(
+            f'/api/documents/{document.id}/export_images/', params, content_type='application/json'
+        )
+
+    def test_zip_is_streamed_with_one_image_per_page(self):
+        document = self.upload()
+
+        response = self.export(document, pages='3,1', dpi=30)
+
+        self.assertEqual(response['Content-Type'], 'application/zip')
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="doc-images.zip"')
+        archive = zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content)))
+        self.assertEqual(archive.namelist(), ['doc-page-3.png', 'doc-page-1.png'])
+        self.assertTrue(archive.read('doc-page-3.png').startswith(b'\x89PNG'))
+
+    def test_store_saves_images_and_returns_urls(self):
+        document = self.upload()
+
+        response = self.export(document, pages='2', dpi=30, format='jpg', colorspace='gray', output='store')
+
+        self.assertEqual(response.status_code, 200, response.content)
+        image, = response.data['images']
+        self.assertEqual(image['page'], 2)
+        name = image['url'][len(settings.MEDIA_URL):]
+        self.assertEqual(name, f'exports/{document.id}/v0/30dpi-gray/page-2.jpg')
+        with default_storage.open(name) as f:
+            self.assertTrue(f.read().startswith(b'\xff\xd8'))
+
+    def test_parameters_are_checked_before_the_document_is_read(self):
+        document = self.upload()
+
+        with mock.patch.object(SimplePDFEditor, 'page_count', side_effect=AssertionError('document read')):
+            for params in (
+                {'output': 'email'}, {'dpi': 601}, {'format': 'gif'}, {'format': 'webp', 'colorspace': 'gray'}
+            ):
+                self.assertEqual(self.export(document, **params).status_code, 400, params)
+
+        self.assertEqual(self.export(document, pages='7').status_code, 400)
+
+    def test_pages_over_the_memory_budget_are_rejected(self):
+        document = self.upload()
+
+        with override_settings(PDF_RASTER_MEMORY_LIMIT=2 ** 20):
+            response = self.export(document, dpi=300)
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('over the 1 MB limit', response.data['error'])
+
+    def test_worker_failures_are_json_errors(self):
+        document = self.upload()
+
+        with mock.patch.object(SimplePDFEditor, 'render_pages', side_effect=WorkerStopped('worker stopped')):
+            for output in ('zip', 'store'):
+                response = self.export(document, dpi=30, output=output)
+                self.assertEqual(response.status_code, 500, output)
+                self.assertEqual(response.json(), {'error': 'worker stopped'})
+
+    def test_jobs_in_flight_stay_within_the_memory_budget(self):
+        document = self.upload()
+        version = head_version(document)
+        options = render_options({'dpi': 30})
+        in_flight = []
+        running = [0]
+
+        def submit(method, path, pages, **kwargs):
+            running[0] += 1
+            in_flight.append(running[0])
+            future = Future()
+            future.set_result([b'image'] * len(pages))
+            return future
+
+        def result(future):
+            running[0] -= 1
+            return future.result()
+
+        jobs = [([0], 100), ([1], 100), ([2], 100), ([3], 300)]
+        with override_settings(PDF_RASTER_MEMORY_LIMIT=250), \
+                mock.patch('pdf_editor.rasterize.submit', submit), mock.patch('pdf_editor.rasterize.result', result):
+            rendered = list(iter_rendered(version, jobs, options))
+
+        self.assertEqual([page_num for page_num, _ in rendered], [0, 1, 2, 3])
+        # Two 100 byte jobs fit in 250; the 300 byte one runs alone
+        self.assertEqual(max(in_flight), 2)
+        self.assertEqual(in_flight[-1], 1)
+
+
+class LoadTestTests(SimpleTestCase):
+
+    def test_failing_requests_are_counted_as_errors(self):
+        calls = itertools.count()
+
+        def flaky(run, rng):
+            if next(calls) % 2:
+                raise http.client.IncompleteRead(b'')
+            return 200, b''
+
+        run = loadtest.LoadRun('http://localhost:1', samples=[], seed=1)
+        with mock.patch.dict(loadtest.OPERATIONS, {'page_count': flaky}):
+            elapsed = run.run({'page_count': 1, 'download': 1}, duration=0.05, concurrency=2)
+
+        report = loadtest.build_report(run.results, elapsed, None, {
+            'url': 'http://localhost:1', 'concurrency': 2, 'mix': 'page_count=1,download=1', 'pages': 1
+        })
+        # download fails too: there are no documents to pick from
+        statuses = report['statuses']
+        self.assertEqual(set(statuses), {'200', 'IncompleteRead', 'IndexError'})
+        self.assertEqual(report['requests'], sum(statuses.values()))
+        self.assertEqual(
+            report['operations']['page_count']['errors'] + report['operations']['download']['errors'],
+            statuses['IncompleteRead'] + statuses['IndexError']
+        )
+
+
+class ProfilingTests(StorageTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.profile_dir = os.path.join(self.root, 'profiles')
+        settings_override = override_settings(
+            PDF_PROFILE_TOKEN='secret', PDF_PROFILE_SAMPLE_RATE=0, PDF_PROFILE_DIR=self.profile_dir
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.document = self.upload()
+
+    def page_count(self, request_id='req-1', **headers):
+        return self.client.get(
+            f'/api/documents/{self.document.id}/page_count/', HTTP_X_REQUEST_ID=request_id, **headers
+        )
+
+    def profiles(self, path='', token='secret'):
+        headers = {'HTTP_X_PROFILE_TOKEN': token} if token else {}
+        return self.client.get(f'/api/profiles/{path}', **headers)
+
+    def test_requests_with_the_token_are_profiled(self):
+        response = self.page_count(HTTP_X_PROFILE_TOKEN='secret')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-Profile-ID'], 'req-1')
+        files = sorted(os.listdir(os.path.join(self.profile_dir, 'req-1')))
+        self.assertEqual(files, [f'web-{os.getpid()}.prof', f'web-{os.getpid()}.txt'])
+        with open(os.path.join(self.profile_dir, 'req-1', files[1])) as f:
+            summary = f.read()
+        self.assertIn(f'GET /api/documents/{self.document.id}/page_count/', summary)
+        self.assertIn('Python memory peak', summary)
+
+    def test_other_requests_are_not_profiled(self):
+        self.assertNotIn('X-Profile-ID', self.page_count(HTTP_X_PROFILE_TOKEN='wrong'))
+        self.assertNotIn('X-Profile-ID', self.page_count())
+        # Request ids that are not safe as a directory name
+        self.assertNotIn('X-Profile-ID', self.page_count('../req', HTTP_X_PROFILE_TOKEN='secret'))
+        # Only document API views
+        self.assertNotIn('X-Profile-ID', self.client.get('/api/health/ready/', HTTP_X_PROFILE_TOKEN='secret'))
+
+        self.assertFalse(os.path.exists(self.profile_dir))
+
+    def test_sampled_requests_are_stored_without_the_header(self):
+        with override_settings(PDF_PROFILE_SAMPLE_RATE=1):
+            response = self.page_count('sampled')
+
+        self.assertNotIn('X-Profile-ID', response)
+        self.assertEqual(len(os.listdir(os.path.join(self.profile_dir, 'sampled'))), 2)
+
+    def test_profiles_are_listed_and_downloaded_with_the_token(self):
+        self.page_count(HTTP_X_PROFILE_TOKEN='secret')
+
+        self.assertEqual(self.profiles(token=None).status_code, 403)
+        self.assertEqual(self.profiles('req-1/', token='wrong').status_code, 403)
+
+        listed = self.profiles().json()['profiles']
+        self.assertEqual([profile['id'] for profile in listed], ['req-1'])
+
+        response = self.profiles('req-1/')
+        self.assertEqual(response['Content-Type'], 'application/zip')
+        archive = zipfile.ZipFile(io.BytesIO(response.content))
+        self.assertEqual(archive.namelist(), listed[0]['files'])
+        self.assertEqual(self.profiles('req-2/').status_code, 404)
+
+
+class RedactionTests(StorageTestCase):
+
+    SECRET = '123-45-6789'
+
+    def upload_secret(self):
+        pdf = fitz.open()
+        for page_num in range(2):
+            page = pdf.new_page()
+            page.insert_text((72, 72), f'Page {page_num + 1}')
+            page.insert_text((72, 144), f'SSN {self.SECRET}')
+        data = pdf.tobytes()
+        pdf.close()
+        return PDFDocument.objects.create(
+            title='secret.pdf', original_file=ContentFile(data, name='secret.pdf'), file_size=len(data)
+        )
+
+    def redact(self, document, **params):
+        return self.client.post(
+            f'/api/documents/{document.id}/redact/', params, content_type='application/json'
+        )
+
+    def text(self, name, size=None):
+        pdf = open_pdf(local_path(name), size)
+        try:
+            return [page.get_text() for page in pdf]
+        finally:
+            pdf.close()
+
+    def test_patterns_are_removed_but_not_recorded(self):
+        document = self.upload_secret()
+
+        response = self.redact(document, patterns=[r'\d{3}-\d{2}-\d{4}'])
+
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual((response.data['redactions'], response.data['pages_redacted']), (2, 2))
+        head = head_version(document)
+        self.assertTrue(all(self.SECRET not in text and 'Page' in text for text in self.text(head.file.name)))
+
+        versions = self.client.get(f'/api/documents/{document.id}/versions/').json()['versions']
+        self.assertEqual(versions[0]['params'], {'pattern_count': 1})
+        self.assertNotIn(r'\d{3}', json.dumps(versions))
+
+    def test_regions_cover_the_given_pages(self):
+        document = self.upload_secret()
+
+        response = self.redact(document, regions=[{'page': '2', 'rect': [60, 120, 300, 160]}])
+
+        self.assertEqual(response.status_code, 200, response.content)
+        first, second = self.text(head_version(document).file.name)
+        self.assertIn(self.SECRET, first)
+        self.assertNotIn(self.SECRET, second)
+        self.assertIn('Page 2', second)
+
+    def test_invalid_requests_are_rejected(self):
+        document = self.upload_secret()
+
+        for params in (
+            {},
+            {'regions': [[60, 120, 300, 160]]},
+            {'regions': ['page 1']},
+            {'regions': {'rect': [60, 120, 300, 160]}},
+            {'regions': [{'page': '1'}]},
+            {'regions': [{'rect': [10, 10, 10, 10]}]},
+            {'regions': [{'page': '3', 'rect': [60, 120, 300, 160]}]},
+            {'patterns': r'\d+'},
+            {'patterns': ['(']},
+            {'patterns': ['x'], 'fill': [2, 0, 0]},
+        ):
+            response = self.redact(document, **params)
+            self.assertEqual(response.status_code, 400, params)
+            self.assertIn('error', response.json())
+        self.assertEqual(head_version(document).number, 0)
+
+    def test_earlier_versions_keep_the_content_until_purged(self):
+        document = self.upload_secret()
+        original_name = document.original_file.name
+        self.rotate_in_place(document, '1')
+        default_storage.save(f'exports/{document.id}/v0/150dpi-rgb/page-1.png', ContentFile(b'png'))
+
+        self.redact(document, patterns=[self.SECRET])
+        self.assertIn(self.SECRET, self.text(original_name)[0])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.redact(document, patterns=['SSN'], purge_history=True)
+
+        self.assertEqual(response.data['versions_purged'], 3)
+        document.refresh_from_db()
+        version, = document.versions.all()
+        self.assertEqual((version.number, version.depth, version.parent_id), (0, 0, None))
+        self.assertEqual(document.original_file.name, version.file.name)
+        self.assertEqual(document.file_size, version.size)
+        self.assertFalse(default_storage.exists(original_name))
+        self.assertEqual(default_storage.listdir(f'exports/{document.id}/v0/150dpi-rgb')[1], [])
+
+        download = self.client.get(f'/api/documents/{document.id}/download_original/')
+        pdf = fitz.open(stream=b''.join(download.streaming_content), filetype='pdf')
+        self.assertTrue(all('SSN' not in page.get_text() for page in pdf))
+        self.assertEqual([page.rotation for page in pdf], [90, 0])
+        pdf.close()
+        download.close()
+
+        # Later edits write new files instead of appending to the new original
+        self.rotate_in_place(document, '2')
+        self.assertNotEqual(head_version(document).file.name, document.original_file.name)
+
+    def test_bulk_redactions_record_the_pattern_count(self):
+        document = self.upload_secret()
+
+        response = self.client.post('/api/documents/bulk/', {
+            'document_ids': [str(document.id)], 'operation': {'type': 'redact', 'patterns': [self.SECRET]}
+        }, content_type='application/json')
+
+        self.assertEqual(response.data['results'][0]['status'], 'ok')
+        self.assertEqual(head_version(document).params, {'pattern_count': 1})
+
+
+class SplitTests(StorageTestCase):
+
+    TOC = [[1, 'Intro', 2], [2, 'Details', 3], [1, 'Part B', 4]]
+
+    def split(self, document, **params):
+        return self.client.post(f'/api/documents/{document.id}/split/', params, content_type='application/json')
+
+    def parts(self, response):
+        self.assertEqual(response.status_code, 200, response.content)
+        parts = []
+        for file in response.data['files']:
+            part = PDFDocument.objects.get(id=file['id'])
+            pdf = open_pdf(part.original_file)
+            parts.append((file, [page.get_text().strip() for page in pdf], pdf.get_toc(simple=True)))
+            pdf.close()
+        return parts
+
+    def test_outline_parts_carry_their_bookmarks(self):
+        document = self.upload(5, toc=self.TOC)
+
+        parts = self.parts(self.split(document, mode='outline'))
+
+        self.assertEqual([file['pages'] for file, _, _ in parts], ['1-1', '2-3', '4-5'])
+        self.assertEqual([file['title'].rsplit('_', 2)[0] for file, _, _ in parts],
+                         ['1_front_matter', '2_Intro', '3_Part_B'])
+        self.assertEqual(parts[1][1], ['Page 2', 'Page 3'])
+        self.assertEqual(parts[1][2], [[1, 'Intro', 1], [2, 'Details', 2]])
+
+        parts = self.parts(self.split(document, mode='outline', level=2))
+        self.assertEqual([file['pages'] for file, _, _ in parts], ['1-1', '2-2', '3-3', '4-5'])
+
+    def test_every_n_pages_across_workers(self):
+        document = self.upload(5)
+
+        with override_settings(PDF_WORKER_PROCESSES=2):
+            parts = self.parts(self.split(document, mode='every', every=2))
+
+        self.assertEqual([pages for _, pages, _ in parts], [['Page 1', 'Page 2'], ['Page 3', 'Page 4'], ['Page 5']])
+
+    def test_size_counts_shared_images_once_per_part(self):
+        noise = fitz.Pixmap(fitz.csRGB, fitz.IRect(0, 0, 128, 128), False)
+        noise.set_rect(noise.irect, (0, 0, 0))
+        for y in range(128):
+            for x in range(128):
+                noise.set_pixel(x, y, ((x * 7919 + y * 104729) % 251, (x * y) % 253, (x + y * 31) % 255))
+        pdf = fitz.open()
+        for page_num in range(4):
+            page = pdf.new_page()
+            page.insert_image(fitz.Rect(72, 72, 200, 200), pixmap=noise)
+            page.insert_text((72, 300), f'Page {page_num + 1}')
+        data = pdf.tobytes(garbage=3, deflate=True)
+        pdf.close()
+        document = PDFDocument.objects.create(
+            title='images.pdf', original_file=ContentFile(data, name='images.pdf'), file_size=len(data)
+        )
+
+        # The image alone is most of the file: one copy fits, two do not
+        parts = self.parts(self.split(document, mode='size', max_bytes=len(data) * 3 // 2))
+        self.assertEqual([file['pages'] for file, _, _ in parts], ['1-4'])
+
+        parts = self.parts(self.split(document, mode='size', max_bytes=1))
+        self.assertEqual([file['pages'] for file, _, _ in parts], ['1-1', '2-2', '3-3', '4-4'])
+        self.assertTrue(all(file['size'] < len(data) for file, _, _ in parts))
+
+    def test_range_extract_and_all(self):
+        document = self.upload(4)
+
+        parts = self.parts(self.split(document, mode='range', start_page=2, end_page=3))
+        self.assertEqual([pages for _, pages, _ in parts], [['Page 2', 'Page 3']])
+
+        parts = self.parts(self.split(document, mode='extract', pages='4,1-2'))
+        self.assertEqual([pages for _, pages, _ in parts], [['Page 4', 'Page 1', 'Page 2']])
+
+        parts = self.parts(self.split(document))
+        self.assertEqual([pages for _, pages, _ in parts], [[f'Page {n}'] for n in range(1, 5)])
+
+    def test_invalid_requests_are_rejected(self):
+        document = self.upload(4)
+
+        for params in (
+            {'mode': 'chapters'},
+            {'mode': 'outline'},
+            {'mode': 'every', 'every': 0},
+            {'mode': 'size', 'max_bytes': 'big'},
+            {'mode': 'range', 'start_page': 3, 'end_page': 5},
+            {'mode': 'range'},
+            {'mode': 'extract', 'pages': 'x'},
+        ):
+            response = self.split(document, **params)
+            self.assertEqual(response.status_code, 400, params)
+            self.assertIn('error', response.json())
+        self.assertEqual(PDFDocument.objects.count(), 1)
+
+
+class CheckStorageTests(StorageTestCase):
+
+    def check_storage(self, **options):
+        stdout = io.StringIO()
+        call_command(
+            'check_storage', checkpoint=os.path.join(self.root, 'checkpoint.json'), restart=True,
+            report=os.path.join(self.root, 'report.jsonl'), stdout=stdout, stderr=io.StringIO(), **options
+        )
+        return stdout.getvalue()
+
+    def findings(self):
+        with open(os.path.join(self.root, 'report.jsonl')) as f:
+            return [json.loads(line) for line in f]
+
+    def test_intact_documents_have_no_findings(self):
+        document = self.upload()
+        self.rotate_in_place(document, '1')
+        self.rotate_in_place(document, '2')
+
+        output = self.check_storage(open=True)
+
+        self.assertIn('Checked 1 document(s) and 3 file(s)', output)
+        self.assertIn('0 damaged', output)
+        self.assertFalse(os.path.exists(os.path.join(self.root, 'report.jsonl')))
+
+    def test_damaged_increment_is_rolled_back_to_a_copy(self):
+        document = self.upload()
+        self.rotate_in_place(document, '1')
+        self.rotate_in_place(document, '2')
+        v1, v2 = document.versions.filter(number__gt=0).order_by('number')
+        path = local_path(v2.file.name)
+        with open(path, 'r+b') as f:
+            f.seek(v1.size + 10)
+            f.write(b'\x00' * 8)
+
+        self.check_storage()
+        finding, = self.findings()
+        self.assertEqual(finding['problems'], [
+            {'file': v2.file.name, 'what': 'v2', 'problem': 'content hash mismatch'}
+        ])
+        self.assertEqual(finding['repair'], {'roll_back_to': 1})
+        self.assertEqual(document.versions.count(), 3)
+
+        output = self.check_storage(repair=True)
+
+        self.assertIn('rolled back to v1, 1 version(s) removed', output)
+        document.refresh_from_db()
+        head = head_version(document)
+        self.assertEqual(head.number, 1)
+        # The damaged increment shares v1's file, so v1 moved to a copy
+        self.assertNotEqual(head.file.name, v2.file.name)
+        self.assertEqual(document.edited_file.name, head.file.name)
+        self.assertEqual(os.path.getsize(local_path(head.file.name)), v1.size)
+        self.assertEqual(rotations(local_path(head.file.name)), [90, 0, 0])
+        self.assertIn('0 damaged', self.check_storage(skip_orphans=True))
+
+    def test_missing_edited_file_rolls_back_to_the_upload(self):
+        document = self.upload()
+        self.rotate_in_place(document, '1')
+        default_storage.delete(head_version(document).file.name)
+
+        self.check_storage(repair=True)
+
+        finding, = self.findings()
+        self.assertEqual(finding['problems'][0]['problem'], 'missing')
+        self.assertEqual(finding['repaired'], 'rolled back to v0, 1 version(s) removed')
+        document.refresh_from_db()
+        self.assertFalse(document.edited_file)
+        self.assertEqual(head_version(document).number, 0)
+
+    def test_documents_without_versions(self):
+        wrong_size = self.upload()
+        wrong_size.file_size += 1
+        wrong_size.save(update_fields=['file_size'])
+        lost = self.upload()
+        default_storage.delete(lost.original_file.name)
+
+        output = self.check_storage(repair=True)
+
+        self.assertIn('2 damaged, 1 unrecoverable, 1 repaired', output)
+        findings = {finding['document_id']: finding for finding in self.findings()}
+        self.assertTrue(findings[str(lost.id)]['unrecoverable'])
+        wrong_size.refresh_from_db()
+        self.assertEqual(wrong_size.file_size, default_storage.size(wrong_size.original_file.name))
+
+    def test_orphans_are_deleted_but_split_outputs_and_live_exports_kept(self):
+        document = self.upload()
+        self.rotate_in_place(document, '1')
+        response = self.client.post(f'/api/documents/{document.id}/split_all/')
+        self.assertEqual(response.status_code, 200, response.content)
+        split = sorted(f'pdfs/split/{name}' for name in default_storage.listdir('pdfs/split')[1])
+        self.assertTrue(split)
+        stray = default_storage.save('pdfs/edited/stray.pdf', ContentFile(b'%PDF-1.7'))
+        live_export = default_storage.save(f'exports/{document.id}/v1/150dpi-rgb/page-1.png', ContentFile(b'png'))
+        dead_export = default_storage.save(
+            f'exports/{PDFDocument._meta.pk.default()}/v0/150dpi-rgb/page-1.png', ContentFile(b'png')
+        )
+        kept = [document.original_file.name, head_version(document).file.name, live_export, *split]
+
+        output = self.check_storage(delete_orphans=True)
+        self.assertIn('2 of', output)
+        self.assertIn('0 deleted', output)
+        self.assertTrue(default_storage.exists(stray))
+
+        self.check_storage(delete_orphans=True, orphan_min_age=0)
+
+        self.assertEqual(sorted(finding['orphan'] for finding in self.findings() if finding['deleted']),
+                         sorted([stray, dead_export]))
+        self.assertFalse(default_storage.exists(stray))
+        self.assertFalse(default_storage.exists(dead_export))
+        for name in kept:
+            self.assertTrue(default_storage.exists(name), name)
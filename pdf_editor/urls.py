@@ -1,10 +1,13 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import PDFDocumentViewSet
+from .views import PDFDocumentViewSet, readiness, profiles, profile_download
 
 router = DefaultRouter()
 router.register(r'documents', PDFDocumentViewSet, basename='pdfdocument')
 
 urlpatterns = [
+    path('health/ready/', readiness, name='readiness'),
+    path('profiles/', profiles, name='profiles'),
+    path('profiles/<str:profile_id>/', profile_download, name='profile-download'),
     path('', include(router.urls)),
 ]
\ No newline at end of file
@@ -0,0 +1,308 @@
+import logging
+import os
+import uuid
+from contextlib import ExitStack, contextmanager
+from functools import partial
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import IntegrityError, connection, transaction
+from .document_access import file_sha256
+from .storage import local_path, staging_path, storage_directories, commit
+from .models import PDFDocument, DocumentVersion
+from .worker_pool import call
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows
+    fcntl = None
+
+
+logger = logging.getLogger(__name__)
+
+
+class VersionConflict(Exception):
+    """The document gained a newer version while an edit was running"""
+
+
+def head_version(document):
+    """
+    Latest version of a document
+
+    Documents without history get their upload recorded as version 0, and
+    an edited file written before versions existed as version 1.
+    """
+    version = document.versions.order_by('-number').first()
+    if version is None:
+        files = [document.original_file.name]
+        if document.edited_file and document.edited_file.name != document.original_file.name:
+            files.append(document.edited_file.name)
+        facts = [_file_facts(name) for name in files]
+        try:
+            with transaction.atomic():
+                version = _create_version(document, None, 'upload', {}, files[0], *facts[0])
+                if len(files) > 1:
+                    version = _create_version(document, version, 'edit', {}, files[1], *facts[1])
+        except IntegrityError:
+            # Another request recorded the history first
+            version = document.versions.order_by('-number').first()
+    return version
+
+
+def _file_facts(file_name, size=None):
+    """Size and hash of a stored file, or of its first `size` bytes"""
+    path = local_path(file_name)
+    if size is None:
+        size = os.path.getsize(path)
+    return size, file_sha256(path, size)
+
+
+def _create_version(document, parent, operation, params, file_name, size, content_hash):
+    return DocumentVersion.objects.create(
+        document=document,
+        parent=parent,
+        number=parent.number + 1 if parent else 0,
+        depth=parent.depth + 1 if parent else 0,
+        operation=operation,
+        params=params,
+        file=file_name,
+        content_hash=content_hash,
+        size=size
+    )
+
+
+def version_file_name(document, number):
+    """
+    Relative path for the file of a new version
+
+    The random suffix keeps concurrent edits building on the same parent
+    from writing to the same file before one of them loses the conflict.
+    """
+    original_name = os.path.basename(document.original_file.name)
+    name_without_ext = os.path.splitext(original_name)[0]
+    token = uuid.uuid4().hex[:8]
+    return os.path.join('pdfs', 'edited', f"{name_without_ext}_v{number}_{token}.pdf")
+
+
+def can_append(document, version):
+    """Whether incremental updates may be written to the file of `version`"""
+    return version.file.name != document.original_file.name
+
+
+@contextmanager
+def document_lock(*documents):
+    """
+    Hold off other edits of the documents while one appends to their files
+
+    Read the head version inside the block: an edit appending to the
+    head's file must not interleave its bytes with another one's. Uses
+    SELECT ... FOR UPDATE on the document rows where the database has
+    it, otherwise a lock file per document in PDF_LOCK_DIR. Documents are
+    locked in id order so overlapping bulk requests cannot deadlock.
+    """
+    ids = sorted(str(document.id) for document in documents)
+    if not ids:
+        yield
+        return
+
+    if connection.features.has_select_for_update:
+        with transaction.atomic():
+            list(PDFDocument.objects.select_for_update().filter(id__in=ids).order_by('id'))
+            yield
+        return
+
+    with ExitStack() as stack:
+        if fcntl is not None:
+            os.makedirs(settings.PDF_LOCK_DIR, exist_ok=True)
+            for document_id in ids:
+                lock_path = os.path.join(settings.PDF_LOCK_DIR, f'{document_id}.lock')
+                lock_file = stack.enter_context(open(lock_path, 'a'))
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+
+def discard_append(version, path):
+    """
+    Cut whatever an unrecorded edit appended to the file of `version`
+
+    Args:
+        version: DocumentVersion whose file was appended to
+        path: Local path the append was written at
+    """
+    with open(path, 'r+b') as f:
+        f.truncate(version.size)
+    commit(version.file.name, path)
+
+
+def record_version(document, parent, operation, params, file_name, size=None):
+    """
+    Add a version on top of `parent` and make it the document's current file
+
+    The file is hashed before the transaction starts, so the database is
+    only locked for the head check and the row updates.
+
+    Args:
+        document: PDFDocument being edited
+        parent: DocumentVersion the edit was applied to
+        operation: Name of the operation
+        params: JSON-serializable operation parameters
+        file_name: Storage name of the file holding the new version
+        size: Bytes of the file that make up the new version, when the
+            edit was appended to a file that may grow further
+
+    Raises:
+        VersionConflict: `parent` is no longer the head version; the file
+            written for this edit is discarded unless it is the parent's,
+            which the caller truncates with discard_append()
+
+    Chains deeper than PDF_VERSION_MAX_DEPTH are compacted once the
+    version is recorded. Inside a transaction, e.g. document_lock()'s
+    SELECT ... FOR UPDATE, that waits until the transaction commits, so
+    the rewrite never runs while the document rows are locked.
+
+    Returns:
+        DocumentVersion: The new head version; the version recorded here
+            when its compaction waits for the transaction to commit
+    """
+    size, content_hash = _file_facts(file_name, size)
+    try:
+        with transaction.atomic():
+            if document.versions.filter(number__gt=parent.number).exists():
+                raise VersionConflict
+            version = _create_version(document, parent, operation, params, file_name, size, content_hash)
+            document.edited_file.name = file_name
+            document.save(update_fields=['edited_file'])
+    except (VersionConflict, IntegrityError):
+        if file_name != parent.file.name:
+            default_storage.delete(file_name)
+        logger.warning('Concurrent edit of %s v%d rejected', document.title, parent.number)
+        raise VersionConflict(
+            f'Version {parent.number} was edited concurrently; reload the document and retry'
+        )
+
+    if version.depth > settings.PDF_VERSION_MAX_DEPTH:
+        if connection.in_atomic_block:
+            # A failed compaction leaves the chain deep; the edit stands
+            transaction.on_commit(partial(compact_versions, document), robust=True)
+        else:
+            version = compact_versions(document)
+    return version
+
+
+def compact_versions(document):
+    """
+    Flatten a document's version chain
+
+    The head version is rewritten into a single file without incremental
+    updates or unused objects, attached directly to the upload, and all
+    intermediate versions and files they no longer share are removed.
+    The rewrite runs in the worker pool outside any transaction; if the
+    document gained a version meanwhile, it is discarded.
+
+    Returns:
+        DocumentVersion: The compacted head version, or the current head
+            if there was nothing to compact or an edit got in first
+    """
+    head = head_version(document)
+    root = document.versions.get(number=0)
+    if head.parent_id == root.id or head.id == root.id:
+        return head
+
+    number = head.number + 1
+    file_name = version_file_name(document, number)
+    output_path = staging_path(file_name)
+    call('save_compacted', local_path(head.file.name), head.size, output_path)
+    commit(file_name, output_path)
+    size, content_hash = _file_facts(file_name)
+
+    with transaction.atomic():
+        if document.versions.filter(number__gt=head.number).exists():
+            compacted = None
+        else:
+            stale = list(document.versions.exclude(id=root.id))
+            compacted = DocumentVersion.objects.create(
+                document=document,
+                parent=root,
+                number=number,
+                depth=1,
+                operation='compact',
+                params={'compacted_from': head.number, 'versions_removed': len(stale)},
+                file=file_name,
+                content_hash=content_hash,
+                size=size
+            )
+
+            document.versions.filter(id__in=[v.id for v in stale]).delete()
+
+            keep = {document.original_file.name, file_name}
+            stale_files = {v.file.name for v in stale} - keep
+
+            def delete_stale_files():
+                for name in stale_files:
+                    default_storage.delete(name)
+
+            transaction.on_commit(delete_stale_files)
+
+            document.edited_file.name = file_name
+            document.save(update_fields=['edited_file'])
+
+    if compacted is None:
+        default_storage.delete(file_name)
+        logger.info('Compaction of %s skipped, v%d is no longer the head', document.title, head.number)
+        return head_version(document)
+
+    logger.info('Compacted %d version(s) of %s into v%d', len(stale), document.title, number)
+    return compacted
+
+
+def purge_history(document, version):
+    """
+    Make `version` the only version of a document
+
+    Every earlier version, the upload included, still holds whatever a
+    redaction removed and stays downloadable until it is purged. The
+    version becomes version 0 and the document's original file; all
+    other versions are deleted, and once the transaction commits so are
+    their files and the document's image exports.
+
+    Raises:
+        VersionConflict: `version` is no longer the head version
+
+    Returns:
+        int: Number of versions removed
+    """
+    with transaction.atomic():
+        if document.versions.filter(number__gt=version.number).exists():
+            raise VersionConflict(f'v{version.number} is no longer the head version, history not purged')
+
+        stale = list(document.versions.exclude(id=version.id))
+        stale_files = {v.file.name for v in stale} | {document.original_file.name}
+        stale_files.discard(version.file.name)
+        document.versions.filter(id__in=[v.id for v in stale]).delete()
+
+        version.parent = None
+        version.number = 0
+        version.depth = 0
+        version.save(update_fields=['parent', 'number', 'depth'])
+
+        document.original_file.name = version.file.name
+        document.edited_file.name = version.file.name
+        document.file_size = version.size
+        document.save(update_fields=['original_file', 'edited_file', 'file_size'])
+
+        exports = f'exports/{document.id}'
+
+        def delete_stale_files():
+            for name in stale_files:
+                default_storage.delete(name)
+            for directory in storage_directories(exports):
+                try:
+                    _, names = default_storage.listdir(directory)
+                except FileNotFoundError:
+                    continue
+                for name in names:
+                    default_storage.delete(f'{directory}/{name}')
+
+        transaction.on_commit(delete_stale_files)
+
+    logger.info('Purged %d earlier version(s) of %s', len(stale), document.title)
+    return len(stale)
@@ -1,16 +1,37 @@
 from rest_framework import viewsets, status
 from rest_framework.decorators import action, api_view
 from rest_framework.response import Response
-from django.http import FileResponse
-from django.http import HttpResponse
+from django.http import Http404, HttpResponse, StreamingHttpResponse
 from django.conf import settings
+from django.db import connection
 from .models import PDFDocument
-from .serializers import PDFDocumentSerializer
-from .simple_operations import SimplePDFEditor
+from .serializers import PDFDocumentSerializer, DocumentVersionSerializer
+from .simple_operations import SimplePDFEditor, IncrementalUpdateError
+from .versioning import (
+    head_version, record_version, compact_versions, version_file_name, can_append,
+    document_lock, discard_append, purge_history, VersionConflict
+)
+from .worker_pool import run_many, call, prime_pool
+from .delivery import serve_stored
+from .storage import is_local, local_path, staging_path, commit
+from .extraction import iter_ndjson
+from .splitting import split_planned
+from .rasterize import render_options, plan_jobs, iter_rendered, iter_zip, store_images
+from .page_selection import PageSet, PageSelectionError
+from .warmup import warm_up, is_warm
+from . import profiling
+import logging
 import os
-import fitz  
+import uuid
+from contextlib import nullcontext
+from itertools import chain
 from datetime import datetime
-from django.core.files import File
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+
+
+logger = logging.getLogger(__name__)
 
 
 class PDFDocumentViewSet(viewsets.ModelViewSet):
@@ -23,11 +44,12 @@ class PDFDocumentViewSet(viewsets.ModelViewSet):
         if not file:
             return Response({'error': 'No file provided'}, status=400)
         
-        print(f"📤 Uploading: {file.name}")
+        logger.info('Uploading %s', file.name, extra={'size': file.size})
         
         document = PDFDocument.objects.create(
             title=file.name,
-            original_file=file
+            original_file=file,
+            file_size=file.size
         )
         
         serializer = self.get_serializer(document, context={'request': request})
@@ -38,18 +60,144 @@ class PDFDocumentViewSet(viewsets.ModelViewSet):
         """Get the number of pages in a PDF"""
         try:
             document = self.get_object()
-            pdf_path = document.original_file.path
+            version = head_version(document)
+            count = call('page_count', local_path(version.file.name), version.size)
             
-            pdf_doc = fitz.open(pdf_path)
-            count = len(pdf_doc)
-            pdf_doc.close()
-            
-            print(f"📄 Page count: {count}")
+            logger.debug('Page count: %d', count)
             
             return Response({'page_count': count}, status=200)
             
         except Exception as e:
-            print(f"❌ Error getting page count: {str(e)}")
+            logger.exception('Error getting page count')
+            return Response({'error': str(e)}, status=500)
+    
+    @action(detail=True, methods=['get'])
+    def text(self, request, pk=None):
+        """
+        Stream page text as NDJSON: one {"page": 1, "text": "..."} per line
+        Query: ?pages=all or 1,3,5-9
+        """
+        return self._stream_content(request, 'text')
+    
+    @action(detail=True, methods=['get'])
+    def blocks(self, request, pk=None):
+        """
+        Stream page layout as NDJSON: one {"page": 1, "width": ..., "height": ...,
+        "blocks": [...]} per line, as returned by get_text('dict')
+        Query: ?pages=all or 1,3,5-9
+        """
+        return self._stream_content(request, 'blocks')
+    
+    def _stream_content(self, request, mode):
+        document = self.get_object()
+        pages_input = request.query_params.get('pages', 'all')
+        
+        try:
+            version = head_version(document)
+            total_pages = call('page_count', local_path(version.file.name), version.size)
+            
+            pages = PageSet.parse(pages_input, total_pages)
+        except PageSelectionError as e:
+            return Response({'error': str(e)}, status=400)
+        except Exception as e:
+            logger.exception('Extraction error')
+            return Response({'error': str(e)}, status=500)
+        
+        if not pages:
+            return Response({'error': f'No pages selected. Document has {total_pages} pages.'}, status=400)
+        
+        logger.info('Extracting %s from %d page(s) of %s', mode, len(pages), document.title)
+        
+        # Extract the first page before any bytes are sent, so a failing
+        # document or worker still gets a JSON error response
+        lines = iter_ndjson(version, pages, mode)
+        try:
+            first_line = next(lines)
+        except Exception as e:
+            logger.exception('Extraction error')
+            return Response({'error': str(e)}, status=500)
+        
+        return StreamingHttpResponse(
+            chain([first_line], lines),
+            content_type='application/x-ndjson'
+        )
+    
+    @action(detail=True, methods=['post'])
+    def export_images(self, request, pk=None):
+        """
+        Render pages to images
+        Body: {
+            "pages": "all" or "1,3,5-9",
+            "dpi": 150,
+            "format": "png", "jpeg" or "webp",
+            "colorspace": "rgb", "gray" or "cmyk" (jpeg only),
+            "quality": 85,  # jpeg/webp
+            "output": "zip" (streamed download) or "store" (saved, URLs returned)
+        }
+        """
+        document = self.get_object()
+        output = request.data.get('output', 'zip')
+        
+        # Check everything the request says before touching the document
+        if output not in ('zip', 'store'):
+            return Response({'error': 'output must be zip or store'}, status=400)
+        
+        try:
+            options = render_options(request.data)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=400)
+        
+        try:
+            version = head_version(document)
+            total_pages = call('page_count', local_path(version.file.name), version.size)
+            
+            pages = PageSet.parse(request.data.get('pages', 'all'), total_pages)
+            if not pages:
+                return Response({'error': f'No pages selected. Document has {total_pages} pages.'}, status=400)
+            jobs = plan_jobs(version, pages, options)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=400)
+        except Exception as e:
+            logger.exception('Image export error')
+            return Response({'error': str(e)}, status=500)
+        
+        logger.info('Exporting %d page(s) as %s at %d dpi', len(pages), options['extension'], options['dpi'])
+        
+        rendered = iter_rendered(version, jobs, options)
+        name = os.path.splitext(os.path.basename(document.title))[0] or 'document'
+        
+        if output == 'zip':
+            # Render the first page before any bytes are sent, so a failing
+            # document or worker still gets a JSON error response
+            try:
+                first_image = next(rendered)
+            except Exception as e:
+                logger.exception('Image export error')
+                return Response({'error': str(e)}, status=500)
+            
+            response = StreamingHttpResponse(
+                iter_zip(chain([first_image], rendered), name, options['extension']),
+                content_type='application/zip'
+            )
+            response['Content-Disposition'] = f'attachment; filename="{name}-images.zip"'
+            return response
+        
+        try:
+            prefix = os.path.join(
+                'exports', str(document.id), f"v{version.number}",
+                f"{options['dpi']}dpi-{options['colorspace']}"
+            )
+            stored = store_images(rendered, prefix, options['extension'])
+            for image in stored:
+                image['url'] = default_storage.url(image.pop('file'))
+            
+            return Response({
+                'message': f'Exported {len(stored)} page(s)',
+                'images': stored
+            }, status=200)
+            
+        except Exception as e:
+            logger.exception('Image export error')
             return Response({'error': str(e)}, status=500)
     
     @action(detail=True, methods=['post'])
@@ -60,44 +208,42 @@ class PDFDocumentViewSet(viewsets.ModelViewSet):
             start_page = int(request.data.get('start_page', 1))
             end_page = int(request.data.get('end_page', 1))
             
-            print(f"✂️ Splitting pages {start_page}-{end_page}")
+            logger.info('Splitting pages %s-%s', start_page, end_page)
             
-            input_path = document.original_file.path
-            pdf_doc = fitz.open(input_path)
+            version = head_version(document)
+            input_path = local_path(version.file.name)
             
             # Validate page range
-            if start_page < 1 or end_page > len(pdf_doc) or start_page > end_page:
-                pdf_doc.close()
+            total_pages = call('page_count', input_path, version.size)
+            try:
+                PageSet.from_range(start_page, end_page, total_pages)
+            except PageSelectionError:
                 return Response({
-                    'error': f'Invalid page range. Document has {len(pdf_doc)} pages.'
+                    'error': f'Invalid page range. Document has {total_pages} pages.'
                 }, status=400)
             
-            # Create new PDF with selected pages (pages are 0-indexed)
-            new_pdf = fitz.open()
-            new_pdf.insert_pdf(pdf_doc, from_page=start_page-1, to_page=end_page-1)
+            # Create new PDF with selected pages
+            output_files = call(
+                'split_pdf', input_path, mode='range', start_page=start_page, end_page=end_page, size=version.size
+            )
+            if not output_files:
+                return Response({'error': 'Failed to split PDF'}, status=500)
             
             # Save
             output_filename = f"pages_{start_page}-{end_page}.pdf"
-            output_relative_path = os.path.join('pdfs', 'split', output_filename)
-            output_absolute_path = os.path.join(settings.MEDIA_ROOT, output_relative_path)
-            
-            os.makedirs(os.path.dirname(output_absolute_path), exist_ok=True)
-            
-            new_pdf.save(output_absolute_path)
-            new_pdf.close()
-            pdf_doc.close()
+            output_relative_path = default_storage.save(
+                os.path.join('pdfs', 'split', output_filename), ContentFile(output_files[0][1])
+            )
             
-            print(f"✅ Split file saved")
+            logger.info('Split file saved: %s', output_relative_path)
             
             return Response({
                 'message': f'Extracted pages {start_page}-{end_page}',
-                'split_file': f'/media/{output_relative_path}'
+                'split_file': default_storage.url(output_relative_path)
             }, status=200)
             
         except Exception as e:
-            import traceback
-            print(f"❌ Error: {str(e)}")
-            print(traceback.format_exc())
+            logger.exception('Error')
             return Response({'error': str(e)}, status=500)
     
     @action(detail=True, methods=['post'])
@@ -110,47 +256,37 @@ class PDFDocumentViewSet(viewsets.ModelViewSet):
             if not pages:
                 return Response({'error': 'Please provide page numbers'}, status=400)
             
-            print(f"✂️ Extracting pages: {pages}")
+            logger.info('Extracting pages: %s', pages)
             
-            input_path = document.original_file.path
-            pdf_doc = fitz.open(input_path)
+            version = head_version(document)
+            input_path = local_path(version.file.name)
             
             # Validate pages
-            max_pages = len(pdf_doc)
-            invalid_pages = [p for p in pages if p < 1 or p > max_pages]
-            if invalid_pages:
-                pdf_doc.close()
-                return Response({
-                    'error': f'Invalid pages: {invalid_pages}. Document has {max_pages} pages.'
-                }, status=400)
+            try:
+                pages = PageSet.parse(pages, call('page_count', input_path, version.size))
+            except PageSelectionError as e:
+                return Response({'error': str(e)}, status=400)
             
-            # Create new PDF with selected pages
-            new_pdf = fitz.open()
-            for page_num in pages:
-                new_pdf.insert_pdf(pdf_doc, from_page=page_num-1, to_page=page_num-1)
+            # Create new PDF with selected pages, one insert per contiguous run
+            output_files = call('split_pdf', input_path, mode='extract', pages=pages, size=version.size)
+            if not output_files:
+                return Response({'error': 'Failed to extract pages'}, status=500)
             
             # Save
-            output_filename = f"extracted_pages.pdf"
-            output_relative_path = os.path.join('pdfs', 'split', output_filename)
-            output_absolute_path = os.path.join(settings.MEDIA_ROOT, output_relative_path)
-            
-            os.makedirs(os.path.dirname(output_absolute_path), exist_ok=True)
-            
-            new_pdf.save(output_absolute_path)
-            new_pdf.close()
-            pdf_doc.close()
+            output_filename = "extracted_pages.pdf"
+            output_relative_path = default_storage.save(
+                os.path.join('pdfs', 'split', output_filename), ContentFile(output_files[0][1])
+            )
             
-            print(f"✅ Extracted {len(pages)} pages")
+            logger.info('Extracted %d pages', len(pages))
             
             return Response({
                 'message': f'Extracted {len(pages)} pages',
-                'extracted_file': f'/media/{output_relative_path}'
+                'extracted_file': default_storage.url(output_relative_path)
             }, status=200)
             
         except Exception as e:
-            import traceback
-            print(f"❌ Error: {str(e)}")
-            print(traceback.format_exc())
+            logger.exception('Error')
             return Response({'error': str(e)}, status=500)
     
     @action(detail=True, methods=['post'])
@@ -159,32 +295,23 @@ class PDFDocumentViewSet(viewsets.ModelViewSet):
         try:
             document = self.get_object()
             
-            print(f"✂️ Splitting into individual pages")
+            logger.info('Splitting into individual pages')
             
-            input_path = document.original_file.path
-            pdf_doc = fitz.open(input_path)
+            version = head_version(document)
+            output_files = call('split_pdf', local_path(version.file.name), mode='all', size=version.size)
             
             file_paths = []
             
-            # Create separate PDF for each page
-            for page_num in range(len(pdf_doc)):
-                new_pdf = fitz.open()
-                new_pdf.insert_pdf(pdf_doc, from_page=page_num, to_page=page_num)
-                
+            # Store a separate PDF for each page
+            for page_num, (_, data) in enumerate(output_files):
                 output_filename = f"page_{page_num + 1}.pdf"
-                output_relative_path = os.path.join('pdfs', 'split', output_filename)
-                output_absolute_path = os.path.join(settings.MEDIA_ROOT, output_relative_path)
-                
-                os.makedirs(os.path.dirname(output_absolute_path), exist_ok=True)
-                
-                new_pdf.save(output_absolute_path)
-                new_pdf.close()
+                output_relative_path = default_storage.save(
+                    os.path.join('pdfs', 'split', output_filename), ContentFile(data)
+                )
                 
-                file_paths.append(f'/media/{output_relative_path}')
-            
-            pdf_doc.close()
+                file_paths.append(default_storage.url(output_relative_path))
             
-            print(f"✅ Split into {len(file_paths)} files")
+            logger.info('Split into %d files', len(file_paths))
             
             return Response({
                 'message': f'Split into {len(file_paths)} files',
@@ -193,9 +320,7 @@ class PDFDocumentViewSet(viewsets.ModelViewSet):
             }, status=200)
             
         except Exception as e:
-            import traceback
-            print(f"❌ Error: {str(e)}")
-            print(traceback.format_exc())
+            logger.exception('Error')
             return Response({'error': str(e)}, status=500)
     
     @action(detail=True, methods=['post'], url_path='find_replace')
@@ -209,37 +334,25 @@ class PDFDocumentViewSet(viewsets.ModelViewSet):
             return Response({'error': 'Please provide text to find'}, status=400)
         
         try:
-            input_path = document.original_file.path
-            original_name = os.path.basename(input_path)
-            name_without_ext = os.path.splitext(original_name)[0]
-            output_filename = f"{name_without_ext}_edited.pdf"
-            
-            output_relative_path = os.path.join('pdfs', 'edited', output_filename)
-            output_absolute_path = os.path.join(settings.MEDIA_ROOT, output_relative_path)
-            os.makedirs(os.path.dirname(output_absolute_path), exist_ok=True)
-            
-            print(f"🔍 Find: '{find_text}' | Replace: '{replace_text}'")
+            parent = head_version(document)
+            input_path = local_path(parent.file.name)
+            output_relative_path = version_file_name(document, parent.number + 1)
+            output_absolute_path = staging_path(output_relative_path)
             
-            pdf_document = fitz.open(input_path)
-            replacements_made = 0
+            logger.info('Find %r, replace with %r', find_text, replace_text)
             
-            for page_num in range(len(pdf_document)):
-                page = pdf_document[page_num]
-                text_instances = page.search_for(find_text)
-                
-                if text_instances:
-                    for inst in text_instances:
-                        page.add_redact_annot(inst, text=replace_text, fill=(1, 1, 1))
-                        replacements_made += 1
-                    page.apply_redactions()
-            
-            pdf_document.save(output_absolute_path)
-            pdf_document.close()
+            replacements_made = call(
+                'replace_text', input_path, output_absolute_path, find_text, replace_text, parent.size
+            )
             
-            document.edited_file.name = output_relative_path
-            document.save()
+            if replacements_made > 0:
+                commit(output_relative_path, output_absolute_path)
+                record_version(document, parent, 'find_replace', {
+                    'find_text': find_text,
+                    'replace_text': replace_text
+                }, output_relative_path)
             
-            print(f"✅ Replaced {replacements_made} instance(s)")
+            logger.info('Replaced %d instance(s)', replacements_made)
             
             serializer = self.get_serializer(document)
             return Response({
@@ -248,110 +361,214 @@ class PDFDocumentViewSet(viewsets.ModelViewSet):
                 **serializer.data
             }, status=200)
             
+        except VersionConflict as e:
+            return Response({'error': str(e)}, status=409)
         except Exception as e:
-            import traceback
-            print(f"❌ Error: {str(e)}")
-            print(traceback.format_exc())
+            logger.exception('Error')
             return Response({'error': str(e)}, status=500)
     
-    @action(detail=True, methods=['get'], url_path='download')
-    def download(self, request, pk=None):
-        """Download PDF"""
+    @action(detail=True, methods=['post'])
+    def reorder(self, request, pk=None):
+        """
+        Reorder, delete or duplicate pages, saved as a new version
+        Body, one of: {
+            "order": "3,1,2,4-"  # new sequence; pages may repeat or be left out
+            "delete": "2,5-6"
+            "duplicate": "1"     # each page is repeated right after itself
+        }
+        """
+        document = self.get_object()
+        params = {key: request.data[key] for key in ('order', 'delete', 'duplicate') if key in request.data}
+        
         try:
-            document = self.get_object()
+            parent = head_version(document)
+            output_relative_path = version_file_name(document, parent.number + 1)
+            output_absolute_path = staging_path(output_relative_path)
             
-            if document.edited_file and document.edited_file.name:
-                file_to_download = document.edited_file
-            else:
-                file_to_download = document.original_file
+            logger.info('Reordering pages: %s', params)
             
-            file_path = file_to_download.path
+            try:
+                summary = call(
+                    'apply_operation', 'reorder', local_path(parent.file.name), output_absolute_path, params,
+                    parent.size
+                )
+            except ValueError as e:
+                return Response({'error': str(e)}, status=400)
             
-            if not os.path.exists(file_path):
-                return Response({'error': 'File not found'}, status=404)
+            commit(output_relative_path, output_absolute_path)
+            version = record_version(document, parent, 'reorder', {'order': summary['order']}, output_relative_path)
             
-            print(f"📥 Downloading: {file_path}")
+            logger.info('Reordered into %d page(s)', summary['page_count'])
             
-            file_handle = open(file_path, 'rb')
-            response = FileResponse(file_handle, as_attachment=True)
-            response['Content-Disposition'] = f'attachment; filename="{os.path.basename(file_path)}"'
+            serializer = self.get_serializer(document)
+            return Response({
+                'message': f"Document now has {summary['page_count']} page(s)",
+                'page_count': summary['page_count'],
+                'order': summary['order'],
+                'version': version.number,
+                **serializer.data
+            }, status=200)
+        
+        except VersionConflict as e:
+            return Response({'error': str(e)}, status=409)
+        except Exception as e:
+            logger.exception('Reorder error')
+            return Response({'error': str(e)}, status=500)
+
+    @action(detail=True, methods=['post'])
+    def redact(self, request, pk=None):
+        """
+        Permanently remove areas and text matching patterns, saved as a new version
+        Body: {
+            "regions": [{"page": "1-2", "rect": [x0, y0, x1, y1]}],  # points from top-left
+            "patterns": ["[0-9]{3}-[0-9]{2}-[0-9]{4}"],  # regular expressions
+            "pages": "all",             # pages searched for patterns
+            "fill": [0, 0, 0],          # RGB from 0 to 1
+            "strip_metadata": false,    # also clear title, author, XMP, ...
+            "purge_history": false      # delete all earlier versions
+        }
+        Earlier versions, the upload included, keep the redacted content and
+        stay downloadable unless purge_history is set; the version history
+        records the number of patterns, not the patterns.
+        """
+        document = self.get_object()
+        params = {
+            key: request.data[key]
+            for key in ('regions', 'patterns', 'pages', 'fill', 'strip_metadata') if key in request.data
+        }
+        purge = str(request.data.get('purge_history', 'false')).lower() in ('1', 'true', 'yes')
+        
+        try:
+            parent = head_version(document)
+            output_relative_path = version_file_name(document, parent.number + 1)
+            output_absolute_path = staging_path(output_relative_path)
             
-            return response
+            logger.info('Redacting %d region(s), %d pattern(s)',
+                        len(params.get('regions') or []), len(params.get('patterns') or []))
             
+            try:
+                summary = call(
+                    'apply_operation', 'redact', local_path(parent.file.name), output_absolute_path, params,
+                    parent.size
+                )
+            except ValueError as e:
+                return Response({'error': str(e)}, status=400)
+            
+            changed = summary.pop('changed')
+            version = parent
+            if changed:
+                commit(output_relative_path, output_absolute_path)
+                version = record_version(
+                    document, parent, 'redact', SimplePDFEditor.redaction_record(params), output_relative_path
+                )
+            
+            logger.info('Redacted %d area(s) on %d page(s)', summary['redactions'], summary['pages_redacted'])
+            
+            if purge:
+                summary['versions_purged'] = purge_history(document, version)
+            
+            serializer = self.get_serializer(document)
+            return Response({
+                'message': f"Redacted {summary['redactions']} area(s) on {summary['pages_redacted']} page(s)",
+                **summary,
+                **serializer.data
+            }, status=200)
+        
+        except VersionConflict as e:
+            return Response({'error': str(e)}, status=409)
         except Exception as e:
-            import traceback
-            print(f"❌ Download error: {str(e)}")
-            print(traceback.format_exc())
+            logger.exception('Redact error')
             return Response({'error': str(e)}, status=500)
-    
-    # Add this import at the top if not already there
-
 
-# Add this new viewset method to your PDFDocumentViewSet class
     @action(detail=True, methods=['post'])
     def rotate(self, request, pk=None):
         """
         Rotate PDF pages
         Body: {
             "angle": 90,  # 90, 180, 270, or -90
-            "pages": "all" or "1,3,5" or "1-5"
+            "pages": "all" or "1,3,5" or "1-5",
+            "in_place": false  # true = append to this document's edited file
         }
         """
         document = self.get_object()
         angle = int(request.data.get('angle', 90))
         pages_input = request.data.get('pages', 'all')
+        in_place = str(request.data.get('in_place', 'false')).lower() in ('1', 'true', 'yes')
         
-        print(f"🔄 Rotating pages by {angle}° for document: {document.title}")
+        logger.info('Rotating pages by %d° for document: %s', angle, document.title)
         
         try:
-            # Open the PDF
-            pdf = fitz.open(document.original_file.path)
-            total_pages = len(pdf)
+            # Count pages
+            head = head_version(document)
+            total_pages = call('page_count', local_path(head.file.name), head.size)
             
             # Determine which pages to rotate
-            if pages_input.lower() == 'all':
-                pages_to_rotate = list(range(total_pages))
-                print(f"🔄 Rotating ALL {total_pages} pages")
-            else:
-                pages_to_rotate = []
+            try:
+                pages_to_rotate = PageSet.parse(pages_input, total_pages, strict=False).unique()
+            except PageSelectionError as e:
+                return Response({'error': str(e)}, status=400)
+            logger.debug('Rotating pages: %s', pages_to_rotate.to_spec())
+            
+            if in_place:
+                # Lightweight edit: only the changed /Rotate entries are
+                # appended to the edited file, earlier revisions stay intact.
+                with document_lock(document):
+                    parent = head_version(document)
+                    appending = can_append(document, parent)
+                    if appending:
+                        edited_relative_path = parent.file.name
+                        edited_path = staging_path(edited_relative_path, fetch=True)
+                        try:
+                            bytes_written = call('rotate_pages', edited_path, angle, pages_to_rotate, parent.size)
+                        except IncrementalUpdateError:
+                            # The file is shared with earlier versions, so
+                            # the rewrite goes to a file of its own
+                            appending = False
+                    if not appending:
+                        edited_relative_path = version_file_name(document, parent.number + 1)
+                        edited_path = staging_path(edited_relative_path)
+                        bytes_written = call(
+                            'rotate_into', local_path(parent.file.name), edited_path, angle, pages_to_rotate,
+                            parent.size
+                        )
+                    try:
+                        commit(edited_relative_path, edited_path)
+                        record_version(document, parent, 'rotate', {
+                            'angle': angle,
+                            'pages': pages_to_rotate.to_spec()
+                        }, edited_relative_path, os.path.getsize(edited_path))
+                    except Exception:
+                        if appending:
+                            discard_append(parent, edited_path)
+                        raise
                 
-                # Parse page numbers (e.g., "1,3,5" or "1-5")
-                for part in pages_input.split(','):
-                    part = part.strip()
-                    if '-' in part:
-                        # Handle range (e.g., "1-5")
-                        start, end = map(int, part.split('-'))
-                        pages_to_rotate.extend(range(start - 1, end))
-                    else:
-                        # Handle single page
-                        pages_to_rotate.append(int(part) - 1)
+                logger.info('Rotation appended to %s (%d bytes)', document.edited_file.name, bytes_written)
                 
-                print(f"🔄 Rotating pages: {[p + 1 for p in pages_to_rotate]}")
-            
-            # Rotate the specified pages
-            for page_num in pages_to_rotate:
-                if 0 <= page_num < total_pages:
-                    page = pdf[page_num]
-                    page.set_rotation(angle)
-                    print(f"  ✓ Rotated page {page_num + 1} by {angle}°")
+                download_url = request.build_absolute_uri(
+                    f'/api/documents/{document.id}/download/'
+                )
+                
+                return Response({
+                    'message': f'Successfully rotated pages by {angle}°',
+                    'edited_file': download_url,
+                    'pages_rotated': len(pages_to_rotate),
+                    'document_id': str(document.id),
+                    'bytes_written': bytes_written
+                })
             
             # Save the rotated PDF
             timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
             output_filename = f"rotated_{timestamp}.pdf"
-            output_path = os.path.join(settings.MEDIA_ROOT, 'pdfs', 'edited', output_filename)
-            
-            os.makedirs(os.path.dirname(output_path), exist_ok=True)
-            pdf.save(output_path)
-            pdf.close()
+            data = call('rotated_copy', local_path(head.file.name), angle, pages_to_rotate, head.size)
             
             # Create new document for rotated file
-            with open(output_path, 'rb') as f:
-                rotated_doc = PDFDocument.objects.create(
-                    title=output_filename,
-                    original_file=File(f, name=output_filename)
-                )
+            rotated_doc = PDFDocument.objects.create(
+                title=output_filename,
+                original_file=ContentFile(data, name=output_filename),
+                file_size=len(data)
+            )
             
-            print(f"✅ Rotated PDF saved: {output_filename}")
+            logger.info('Rotated PDF saved: %s', output_filename)
             
             # Return download URL instead of media URL
             download_url = request.build_absolute_uri(
@@ -365,58 +582,91 @@ class PDFDocumentViewSet(viewsets.ModelViewSet):
                 'document_id': str(rotated_doc.id)
             })
             
+        except VersionConflict as e:
+            return Response({'error': str(e)}, status=status.HTTP_409_CONFLICT)
         except Exception as e:
-            print(f"❌ Error rotating PDF: {str(e)}")
-            import traceback
-            traceback.print_exc()
+            logger.exception('Error rotating PDF')
             return Response(
                 {'error': f'Failed to rotate PDF: {str(e)}'}, 
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
 
+    @action(detail=True, methods=['get'])
+    def versions(self, request, pk=None):
+        """List the version chain of a document, newest first"""
+        document = self.get_object()
+        
+        try:
+            head_version(document)
+            
+            serializer = DocumentVersionSerializer(document.versions.all(), many=True)
+            return Response({
+                'document_id': str(document.id),
+                'versions': serializer.data
+            })
+            
+        except Exception as e:
+            logger.exception('Error listing versions')
+            return Response({'error': str(e)}, status=500)
+    
+    @action(detail=True, methods=['post'])
+    def compact(self, request, pk=None):
+        """Flatten the version chain into a single file"""
+        document = self.get_object()
+        
+        try:
+            version = compact_versions(document)
+            serializer = DocumentVersionSerializer(version)
+            return Response({
+                'message': f'Document is at version {version.number}',
+                'version': serializer.data
+            })
+            
+        except Exception as e:
+            logger.exception('Compaction error')
+            return Response({'error': str(e)}, status=500)
+
     @action(detail=False, methods=['get'])
     def debug_media(self, request):
         """Debug endpoint to check media configuration"""
         media_root = settings.MEDIA_ROOT
         media_url = settings.MEDIA_URL
         debug = settings.DEBUG
+        local = is_local()
         
-        # Check if media folder exists
-        media_exists = os.path.exists(media_root)
+        # Check if media folder exists; remote stores have no folder
+        media_exists = os.path.exists(default_storage.path('')) if local else None
         
-        # List files in media/pdfs/edited if exists
-        edited_path = os.path.join(media_root, 'pdfs', 'edited')
-        files = []
-        if os.path.exists(edited_path):
-            files = os.listdir(edited_path)
+        # List files in pdfs/edited if it exists
+        edited_path = 'pdfs/edited'
+        try:
+            _, files = default_storage.listdir(edited_path)
+        except FileNotFoundError:
+            files = []
         
         return Response({
             'MEDIA_ROOT': media_root,
             'MEDIA_URL': media_url,
             'DEBUG': debug,
+            'storage': default_storage.__class__.__name__,
+            'storage_is_local': local,
             'media_folder_exists': media_exists,
             'edited_files': files,
-            'edited_path': edited_path,
+            'edited_path': default_storage.path(edited_path) if local else edited_path,
         })
 
     @action(detail=True, methods=['get'], url_path='download_original')
     def download_original(self, request, pk=None):
         """Download the original PDF file"""
         document = self.get_object()
-        file_path = document.original_file.path
+        file_name = document.original_file.name
         
-        print(f"📥 Downloading original: {file_path}")
+        logger.info('Downloading original: %s', file_name)
         
-        if os.path.exists(file_path):
-            response = FileResponse(
-                open(file_path, 'rb'),
-                content_type='application/pdf'
-            )
-            filename = os.path.basename(file_path)
-            response['Content-Disposition'] = f'inline; filename="{filename}"'
-            return response
+        if default_storage.exists(file_name):
+            return serve_stored(file_name)
         else:
-            print(f"❌ File not found: {file_path}")
+            logger.warning('File not found: %s', file_name)
             return Response({'error': 'File not found'}, status=404)
 
     @action(detail=True, methods=['get'])
@@ -424,37 +674,39 @@ class PDFDocumentViewSet(viewsets.ModelViewSet):
         """Download the edited PDF file"""
         document = self.get_object()
         
-        # Use edited file if exists, otherwise original
-        if document.edited_file:
-            file_path = document.edited_file.path
-        else:
-            file_path = document.original_file.path
+        # The head version's bytes: the edited file if any, otherwise original
+        try:
+            version = head_version(document)
+        except FileNotFoundError:
+            version = None
+        file_name = version.file.name if version else document.current_file.name
         
-        print(f"📥 Downloading edited: {file_path}")
+        logger.info('Downloading edited: %s', file_name)
         
-        if os.path.exists(file_path):
-            response = FileResponse(
-                open(file_path, 'rb'),
-                content_type='application/pdf'
-            )
-            filename = os.path.basename(file_path)
-            response['Content-Disposition'] = f'inline; filename="{filename}"'
-            return response
+        if default_storage.exists(file_name):
+            return serve_stored(file_name, size=version.size if version else None)
         else:
-            print(f"❌ File not found: {file_path}")
+            logger.warning('File not found: %s', file_name)
             return Response({'error': 'File not found'}, status=404)
 
     @action(detail=False, methods=['post'])
     def merge(self, request):
-        """Merge multiple PDF files"""
+        """
+        Merge multiple PDF files
+        Body: {
+            "document_ids": ["...", "..."],
+            "dedup": true  # store shared fonts/images once; default PDF_MERGE_DEDUP
+        }
+        """
         document_ids = request.data.get('document_ids', [])
+        dedup = str(request.data.get('dedup', settings.PDF_MERGE_DEDUP)).lower() in ('1', 'true', 'yes')
         
         if not document_ids or len(document_ids) < 2:
             return Response({
                 'error': 'Please provide at least 2 documents to merge'
             }, status=400)
         
-        print(f"🔗 Merging {len(document_ids)} PDFs")
+        logger.info('Merging %d PDFs', len(document_ids))
         
         try:
             # Get all documents
@@ -465,103 +717,277 @@ class PDFDocumentViewSet(viewsets.ModelViewSet):
                     'error': 'Some documents not found'
                 }, status=404)
             
-            # Get file paths in the order provided
+            # Get the head version of each document in the order provided
             pdf_paths = []
+            sizes = []
             for doc_id in document_ids:
                 doc = documents.get(id=doc_id)
-                pdf_paths.append(doc.original_file.path)
-                print(f"  📄 Adding: {doc.title}")
+                version = head_version(doc)
+                pdf_paths.append(local_path(version.file.name))
+                sizes.append(version.size)
+                logger.debug('Adding: %s', doc.title)
             
             # Use SimplePDFEditor to merge
-            editor = SimplePDFEditor()
-            output_path = editor.merge_pdfs(pdf_paths)
+            dedup_stats = None
+            if dedup:
+                merged = call('merge_dedup', pdf_paths, sizes)
+                data, dedup_stats = merged['data'], merged['dedup']
+            else:
+                data = call('merge_pdfs', pdf_paths, sizes)
             
-            if output_path:
+            if data:
                 # Create new document for merged PDF
-                with open(output_path, 'rb') as f:
-                    merged_doc = PDFDocument.objects.create(
-                        title=f"merged_{datetime.now().strftime('%Y%m%d_%H%M%S')}.pdf",
-                        original_file=File(f, name=os.path.basename(output_path))
-                    )
+                output_filename = f"merged_{datetime.now().strftime('%Y%m%d_%H%M%S')}.pdf"
+                merged_doc = PDFDocument.objects.create(
+                    title=output_filename,
+                    original_file=ContentFile(data, name=output_filename),
+                    file_size=len(data)
+                )
                 
-                print(f"✅ Merged PDF created: {merged_doc.title}")
+                logger.info('Merged PDF created: %s', merged_doc.title)
                 
                 # Return download URL
                 download_url = request.build_absolute_uri(
                     f'/api/documents/{merged_doc.id}/download/'
                 )
                 
-                return Response({
+                response = {
                     'message': f'Successfully merged {len(document_ids)} PDFs',
                     'merged_file': download_url,
-                    'document_id': str(merged_doc.id)
-                })
+                    'document_id': str(merged_doc.id),
+                    'size': len(data)
+                }
+                if dedup_stats is not None:
+                    response['dedup'] = dedup_stats
+                return Response(response)
             else:
                 return Response({
                     'error': 'Failed to merge PDFs'
                 }, status=500)
                 
         except Exception as e:
-            print(f"❌ Merge error: {str(e)}")
-            import traceback
-            traceback.print_exc()
+            logger.exception('Merge error')
             return Response({'error': str(e)}, status=500)
 
+    @action(detail=False, methods=['post'])
+    def bulk(self, request):
+        """
+        Apply one operation to many documents in parallel
+        Body: {
+            "document_ids": ["...", "..."],
+            "operation": {"type": "rotate", "angle": 90, "pages": "all"}
+                      or {"type": "find_replace", "find_text": "...", "replace_text": "..."}
+                      or {"type": "reorder", "delete": "1"}  # see reorder
+                      or {"type": "redact", "patterns": ["..."]}  # see redact
+        }
+        Each document gets a new version; failures are reported per document.
+        """
+        document_ids = [str(doc_id) for doc_id in dict.fromkeys(request.data.get('document_ids', []))]
+        operation = dict(request.data.get('operation') or {})
+        op_type = operation.pop('type', None)
+        
+        if not document_ids:
+            return Response({'error': 'Please provide document_ids'}, status=400)
+        
+        if len(document_ids) > settings.PDF_BULK_MAX_DOCUMENTS:
+            return Response({
+                'error': f'At most {settings.PDF_BULK_MAX_DOCUMENTS} documents per request'
+            }, status=400)
+        
+        if op_type not in SimplePDFEditor.BULK_OPERATIONS:
+            return Response({
+                'error': f'Unsupported operation. Use one of: {", ".join(SimplePDFEditor.BULK_OPERATIONS)}'
+            }, status=400)
+        
+        logger.info('Bulk %s on %d document(s)', op_type, len(document_ids))
+        
+        results = {}
+        valid_ids = []
+        for doc_id in document_ids:
+            try:
+                uuid.UUID(doc_id)
+                valid_ids.append(doc_id)
+            except ValueError:
+                results[doc_id] = {'document_id': doc_id, 'status': 'error', 'error': 'Invalid document id'}
+        
+        documents = {str(doc.id): doc for doc in PDFDocument.objects.filter(id__in=valid_ids)}
+        
+        # Rotations append to the head file, so no other edit may run on
+        # those documents until the new versions are recorded
+        lock = document_lock(*documents.values()) if op_type == 'rotate' else nullcontext()
+        with lock:
+            jobs = {}
+            targets = {}
+            for doc_id in valid_ids:
+                document = documents.get(doc_id)
+                if document is None:
+                    results[doc_id] = {'document_id': doc_id, 'status': 'error', 'error': 'Document not found'}
+                    continue
+                
+                try:
+                    parent = head_version(document)
+                    appending = op_type == 'rotate' and can_append(document, parent)
+                    if appending:
+                        output_name = parent.file.name
+                        output_path = staging_path(output_name, fetch=True)
+                    else:
+                        output_name = version_file_name(document, parent.number + 1)
+                        output_path = staging_path(output_name)
+                    
+                    targets[doc_id] = (document, parent, output_name, output_path, appending)
+                    jobs[doc_id] = ('apply_operation', (
+                        op_type, local_path(parent.file.name), output_path, operation, parent.size
+                    ), {})
+                except Exception as e:
+                    results[doc_id] = {'document_id': doc_id, 'status': 'error', 'error': str(e)}
+            
+            # Appends are not run again when a worker dies: the file may hold
+            # part of the increment until discard_append() cuts it off
+            once = [doc_id for doc_id, target in targets.items() if target[4]]
+            for doc_id, (summary, error) in run_many(jobs, once=once).items():
+                document, parent, output_name, output_path, appending = targets[doc_id]
+                
+                if isinstance(error, IncrementalUpdateError):
+                    # Write the rotation to a new file instead of the shared one
+                    appending = False
+                    output_name = version_file_name(document, parent.number + 1)
+                    output_path = staging_path(output_name)
+                    try:
+                        summary, error = call(
+                            'apply_operation', op_type, local_path(parent.file.name), output_path, operation,
+                            parent.size
+                        ), None
+                    except Exception as e:
+                        error = e
+                
+                if error is not None:
+                    logger.warning('Bulk %s failed for %s: %s', op_type, doc_id, error, extra={'document_id': doc_id})
+                    if appending:
+                        discard_append(parent, output_path)
+                    results[doc_id] = {'document_id': doc_id, 'status': 'error', 'error': str(error)}
+                    continue
+                
+                try:
+                    changed = summary.pop('changed')
+                    result = {'document_id': doc_id, 'status': 'ok' if changed else 'unchanged', **summary}
+                    if changed:
+                        commit(output_name, output_path)
+                        recorded = SimplePDFEditor.redaction_record(operation) if op_type == 'redact' else operation
+                        version = record_version(
+                            document, parent, op_type, recorded, output_name, os.path.getsize(output_path)
+                        )
+                        result['version'] = version.number
+                    results[doc_id] = result
+                except Exception as e:
+                    if appending:
+                        discard_append(parent, output_path)
+                    results[doc_id] = {'document_id': doc_id, 'status': 'error', 'error': str(e)}
+        
+        ordered = [results[doc_id] for doc_id in document_ids]
+        failed = sum(1 for result in ordered if result['status'] == 'error')
+        
+        logger.info('Bulk %s done: %d ok, %d failed', op_type, len(ordered) - failed, failed)
+        
+        return Response({
+            'message': f'Processed {len(ordered)} document(s), {failed} failed',
+            'operation': op_type,
+            'succeeded': len(ordered) - failed,
+            'failed': failed,
+            'results': ordered
+        })
+
     @action(detail=True, methods=['post'])
     def split(self, request, pk=None):
-        """Split PDF into multiple files or extract pages"""
+        """
+        Split PDF into multiple files or extract pages
+        Body: {
+            "mode": "all"                          # one file per page
+                 or "range", "start_page": 1, "end_page": 5
+                 or "extract", "pages": "1,3,5-7"
+                 or "outline", "level": 1          # one file per bookmark, e.g. chapters
+                 or "every", "every": 10           # files of 10 pages
+                 or "size", "max_bytes": 5000000   # files of at most about 5 MB
+        }
+        """
         document = self.get_object()
         mode = request.data.get('mode', 'all')
         start_page = request.data.get('start_page')
         end_page = request.data.get('end_page')
         pages_str = request.data.get('pages', '')
         
-        print(f"✂️ Split mode: {mode}")
+        modes = ('all', 'range', 'extract') + SimplePDFEditor.SPLIT_PLAN_MODES
+        if mode not in modes:
+            return Response({'error': f'Unsupported mode. Use one of: {", ".join(modes)}'}, status=400)
+        
+        logger.info('Split mode: %s', mode)
         
         try:
-            editor = SimplePDFEditor()
-            
-            if mode == 'range':
+            version = head_version(document)
+            input_path = local_path(version.file.name)
+            parts = None
+            if mode in ('range', 'extract'):
+                total_pages = call('page_count', input_path, version.size)
+                try:
+                    if mode == 'range':
+                        pages = PageSet.from_range(start_page, end_page, total_pages)
+                    else:
+                        pages = PageSet.parse(pages_str, total_pages)
+                except (TypeError, ValueError) as e:
+                    return Response({'error': str(e)}, status=400)
+            
+            if mode in SimplePDFEditor.SPLIT_PLAN_MODES:
+                # Outline, page count or size: planned once, written in parallel
+                options = {key: request.data[key] for key in ('level', 'every', 'max_bytes') if key in request.data}
+                try:
+                    parts, output_files = split_planned(input_path, mode, options, version.size)
+                except ValueError as e:
+                    return Response({'error': str(e)}, status=400)
+            elif mode == 'range':
                 # Page range mode
-                output_files = editor.split_pdf(
-                    document.original_file.path,
+                output_files = call(
+                    'split_pdf', input_path,
                     mode='range',
                     start_page=int(start_page),
-                    end_page=int(end_page)
+                    end_page=int(end_page),
+                    size=version.size
                 )
             elif mode == 'extract':
                 # Extract specific pages
-                pages_list = [int(p.strip()) for p in pages_str.split(',') if p.strip()]
-                output_files = editor.split_pdf(
-                    document.original_file.path,
+                output_files = call(
+                    'split_pdf', input_path,
                     mode='extract',
-                    pages_list=pages_list
+                    pages=pages,
+                    size=version.size
                 )
             else:
                 # Split all pages
-                output_files = editor.split_pdf(
-                    document.original_file.path,
-                    mode='all'
+                output_files = call(
+                    'split_pdf', input_path,
+                    mode='all',
+                    size=version.size
                 )
             
             if output_files:
                 # Create document records for each split file
                 split_docs = []
-                for file_path in output_files:
-                    with open(file_path, 'rb') as f:
-                        split_doc = PDFDocument.objects.create(
-                            title=os.path.basename(file_path),
-                            original_file=File(f, name=os.path.basename(file_path))
+                for index, (output_filename, data) in enumerate(output_files):
+                    split_doc = PDFDocument.objects.create(
+                        title=output_filename,
+                        original_file=ContentFile(data, name=output_filename),
+                        file_size=len(data)
+                    )
+                    split_docs.append({
+                        'id': str(split_doc.id),
+                        'title': split_doc.title,
+                        'download_url': request.build_absolute_uri(
+                            f'/api/documents/{split_doc.id}/download/'
                         )
-                        split_docs.append({
-                            'id': str(split_doc.id),
-                            'title': split_doc.title,
-                            'download_url': request.build_absolute_uri(
-                                f'/api/documents/{split_doc.id}/download/'
-                            )
-                        })
+                    })
+                    if parts is not None:
+                        split_docs[-1]['pages'] = f"{parts[index]['first'] + 1}-{parts[index]['last'] + 1}"
+                        split_docs[-1]['size'] = len(data)
                 
-                print(f"✅ Split complete! Created {len(split_docs)} file(s)")
+                logger.info('Split complete, created %d file(s)', len(split_docs))
                 
                 return Response({
                     'message': f'Successfully split into {len(split_docs)} file(s)',
@@ -573,7 +999,77 @@ class PDFDocumentViewSet(viewsets.ModelViewSet):
                 }, status=500)
                 
         except Exception as e:
-            print(f"❌ Split error: {str(e)}")
-            import traceback
-            traceback.print_exc()
-            return Response({'error': str(e)}, status=500)
\ No newline at end of file
+            logger.exception('Split error')
+            return Response({'error': str(e)}, status=500)
+
+
+def media_file(request, path):
+    """Serve stored files through the configured delivery backend"""
+    try:
+        found = default_storage.exists(path) and not (is_local() and os.path.isdir(default_storage.path(path)))
+    except SuspiciousFileOperation:
+        found = False
+    
+    if not found:
+        raise Http404('File not found')
+    
+    content_type = 'application/pdf' if path.lower().endswith('.pdf') else 'application/octet-stream'
+    return serve_stored(path, content_type=content_type)
+
+
+@api_view(['GET'])
+def readiness(request):
+    """
+    Readiness probe: 200 once the process and its PDF worker pool are
+    warmed up and the database answers, 503 otherwise
+
+    Processes started without the preloaded WSGI warm-up are warmed on
+    their first probe; a pool that was not primed at fork, or was replaced
+    after a worker died, is primed on the next probe.
+    """
+    was_warm = is_warm()
+    state = warm_up()
+    pool = prime_pool()
+    
+    try:
+        connection.ensure_connection()
+        database = 'ok'
+    except Exception as e:
+        database = str(e)
+    
+    ready = database == 'ok' and (pool['primed'] or not pool['isolation'])
+    return Response({
+        'status': 'ready' if ready else 'unavailable',
+        'warm': state['warm'],
+        'warmed_on_probe': not was_warm,
+        'warmup_seconds': state['seconds'],
+        'pool': pool,
+        'database': database
+    }, status=200 if ready else 503)
+
+
+@api_view(['GET'])
+def profiles(request):
+    """List stored request profiles, newest first; requires X-Profile-Token"""
+    if not profiling.token_matches(request.headers.get('X-Profile-Token')):
+        return Response({'error': 'Missing or invalid X-Profile-Token'}, status=403)
+    
+    return Response({'profiles': profiling.list_profiles()})
+
+
+@api_view(['GET'])
+def profile_download(request, profile_id):
+    """
+    Download the captures of one profiled request as a ZIP archive: a
+    .prof (pstats) and .txt summary for the web process and each pool job
+    """
+    if not profiling.token_matches(request.headers.get('X-Profile-Token')):
+        return Response({'error': 'Missing or invalid X-Profile-Token'}, status=403)
+    
+    data = profiling.bundle(profile_id)
+    if data is None:
+        return Response({'error': 'Profile not found'}, status=404)
+    
+    response = HttpResponse(data, content_type='application/zip')
+    response['Content-Disposition'] = f'attachment; filename="profile-{profile_id}.zip"'
+    return response
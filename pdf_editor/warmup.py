@@ -0,0 +1,60 @@
+import time
+import threading
+import fitz  # PyMuPDF
+from django.urls import get_resolver
+
+
+_state = {'warm': False, 'seconds': None}
+_lock = threading.Lock()
+
+
+def warm_up():
+    """
+    Prime the process before it serves requests
+
+    Imports every view through the URL resolver and runs a one-page PDF
+    through create/save/open/extract so MuPDF has loaded its fonts and
+    allocated its context. Under gunicorn this runs once in the master
+    with preload_app, and forked workers inherit the warm state. The
+    spawned PDF worker processes start fresh; see worker_pool.prime_pool().
+
+    Returns:
+        dict: {'warm': True, 'seconds': time spent}
+    """
+    with _lock:
+        if _state['warm']:
+            return dict(_state)
+
+        started = time.monotonic()
+
+        # Resolving the URLconf imports all views and their dependencies
+        get_resolver().url_patterns
+
+        warm_up_mupdf()
+
+        _state['warm'] = True
+        _state['seconds'] = round(time.monotonic() - started, 3)
+        return dict(_state)
+
+
+def warm_up_mupdf():
+    """Run a one-page PDF through create/save/open/extract"""
+    pdf = fitz.open()
+    page = pdf.new_page()
+    page.insert_text((72, 72), 'warm-up')
+    data = pdf.tobytes(garbage=3, deflate=True)
+    pdf.close()
+
+    pdf = fitz.open(stream=data, filetype='pdf')
+    pdf[0].set_rotation(90)
+    pdf[0].get_text()
+    pdf.tobytes()
+    pdf.close()
+
+
+def is_warm():
+    return _state['warm']
+
+
+def warm_state():
+    return dict(_state)
@@ -0,0 +1,311 @@
+import logging
+import multiprocessing
+import signal
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from django.conf import settings
+from django.utils.log import configure_logging
+from . import log, profiling
+from .simple_operations import SimplePDFEditor
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+
+logger = logging.getLogger(__name__)
+
+
+class WorkerStopped(Exception):
+    """A pool worker died while running a job, e.g. on one of its limits"""
+
+
+_pool = None
+_pool_lock = threading.Lock()
+_pool_state = {'primed': False, 'seconds': None}
+_limits = {}
+
+
+def _new_executor(max_workers, max_tasks_per_child=None):
+    return ProcessPoolExecutor(
+        max_workers=max_workers,
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=init_worker,
+        initargs=(
+            settings.PDF_WORKER_MEMORY_LIMIT,
+            settings.PDF_WORKER_CPU_LIMIT,
+            settings.PDF_WORKER_JOB_TIMEOUT
+        ),
+        max_tasks_per_child=max_tasks_per_child
+    )
+
+
+def get_pool():
+    """
+    Shared process pool for PDF work
+
+    Workers are spawned rather than forked so they never inherit the web
+    worker's database connections or threads. They run under the
+    PDF_WORKER_* resource limits and are replaced after
+    PDF_WORKER_MAX_TASKS jobs.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = _new_executor(
+                settings.PDF_WORKER_PROCESSES,
+                settings.PDF_WORKER_MAX_TASKS or None
+            )
+        return _pool
+
+
+def reset_pool(pool=None):
+    """
+    Drop the shared pool, e.g. after a worker died
+
+    Args:
+        pool: Only drop the shared pool if it is still this one
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None or (pool is not None and _pool is not pool):
+            return
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+        _pool_state.update(primed=False, seconds=None)
+
+
+def prime_pool():
+    """
+    Start the pool's worker processes and warm them up
+
+    Spawning a worker imports Django and PyMuPDF from scratch, so without
+    this the first requests of every web worker pay for it. One warm-up
+    job per worker process is submitted; workers replacing ones that
+    reached PDF_WORKER_MAX_TASKS are started by the pool right away.
+
+    Returns:
+        dict: pool_state()
+    """
+    if not settings.PDF_WORKER_ISOLATION or _pool_state['primed']:
+        return pool_state()
+
+    started = time.monotonic()
+    pool = get_pool()
+    futures = [submit('warm_up') for _ in range(settings.PDF_WORKER_PROCESSES)]
+    try:
+        for future in futures:
+            result(future)
+    except Exception:
+        logger.exception('Could not prime the PDF worker pool')
+        return pool_state()
+
+    with _pool_lock:
+        if _pool is pool:
+            _pool_state.update(primed=True, seconds=round(time.monotonic() - started, 3))
+    logger.info('PDF worker pool primed', extra={'workers': settings.PDF_WORKER_PROCESSES})
+    return pool_state()
+
+
+def pool_state():
+    """
+    State of this process's worker pool for the readiness probe
+
+    Returns:
+        dict: isolation, workers, primed and seconds the priming took
+    """
+    return {
+        'isolation': settings.PDF_WORKER_ISOLATION,
+        'workers': settings.PDF_WORKER_PROCESSES,
+        **_pool_state
+    }
+
+
+def init_worker(memory_limit, cpu_limit, job_timeout):
+    """Apply resource limits inside a freshly spawned worker"""
+    # Spawned workers do not run django.setup(), so set up logging here
+    configure_logging(settings.LOGGING_CONFIG, settings.LOGGING)
+    _limits.update(cpu=cpu_limit, timeout=job_timeout)
+    if resource is not None and memory_limit:
+        # MuPDF allocations past the limit fail inside that job instead of
+        # pushing the node into swap or the OOM killer
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+
+
+def _start_job_limits():
+    """
+    Limit the next job's CPU and wall-clock time
+
+    Both end the worker process when exceeded (SIGXCPU, SIGALRM), which
+    also stops MuPDF while it is stuck in C code.
+    """
+    if resource is not None and _limits.get('cpu'):
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        soft = int(usage.ru_utime + usage.ru_stime) + _limits['cpu']
+        _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+        if hard != resource.RLIM_INFINITY:
+            soft = min(soft, hard)
+        resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
+
+    if hasattr(signal, 'setitimer') and _limits.get('timeout'):
+        signal.setitimer(signal.ITIMER_REAL, _limits['timeout'])
+
+
+def _end_job_limits():
+    if hasattr(signal, 'setitimer') and _limits.get('timeout'):
+        signal.setitimer(signal.ITIMER_REAL, 0)
+
+
+def run_editor_method(method, *args, **kwargs):
+    """Entry point executed inside pool workers"""
+    _start_job_limits()
+    try:
+        editor = SimplePDFEditor()
+        return getattr(editor, method)(*args, **kwargs)
+    finally:
+        _end_job_limits()
+
+
+def run_job(context, method, args, kwargs):
+    """Run a job under the log context of the request that submitted it"""
+    log.restore_context(context)
+    if not log.profiled.get():
+        return run_editor_method(method, *args, **kwargs)
+    with profiling.capture(f'worker-{method}', method):
+        return run_editor_method(method, *args, **kwargs)
+
+
+def _stopped_error():
+    return WorkerStopped(
+        'PDF worker stopped while processing the document '
+        '(time, CPU or memory limit exceeded, or MuPDF crashed)'
+    )
+
+
+def submit(method, *args, **kwargs):
+    """
+    Run one SimplePDFEditor method in the pool and return its future
+
+    With PDF_WORKER_ISOLATION off the method runs inline, like call(),
+    and the future returned is already done.
+    """
+    if not settings.PDF_WORKER_ISOLATION:
+        future = Future()
+        outcome, error = _run_inline((method, args, kwargs))
+        if error is None:
+            future.set_result(outcome)
+        else:
+            future.set_exception(error)
+        return future
+    return get_pool().submit(run_job, log.current_context(), method, args, kwargs)
+
+
+def result(future):
+    """
+    Result of a future returned by submit()
+
+    Raises:
+        WorkerStopped: The worker died; the pool is replaced for later jobs
+    """
+    try:
+        return future.result()
+    except BrokenProcessPool:
+        reset_pool()
+        raise _stopped_error()
+
+
+def call(method, *args, **kwargs):
+    """
+    Run one SimplePDFEditor method and return its result
+
+    With PDF_WORKER_ISOLATION on, the method runs in the resource-limited
+    pool; otherwise it runs inline in the calling process.
+    """
+    started = time.perf_counter()
+    try:
+        if not settings.PDF_WORKER_ISOLATION:
+            return getattr(SimplePDFEditor(), method)(*args, **kwargs)
+        return result(submit(method, *args, **kwargs))
+    finally:
+        logger.info('%s finished', method, extra={
+            'method': method,
+            'duration_ms': round((time.perf_counter() - started) * 1000, 1),
+        })
+
+
+def run_many(jobs, once=()):
+    """
+    Run SimplePDFEditor methods in parallel
+
+    A worker dying fails every job still queued in the pool, so jobs lost
+    that way are run again, each in its own process: one bad document
+    only fails its own job. With PDF_WORKER_ISOLATION off the jobs run
+    inline, one after another.
+
+    Args:
+        jobs: Dict of key -> (method name, args tuple, kwargs dict)
+        once: Keys of jobs that must not run again, e.g. because they
+            change a file in place; lost ones fail with WorkerStopped
+
+    Returns:
+        dict: key -> (result, exception); exception is None on success
+    """
+    if not settings.PDF_WORKER_ISOLATION:
+        return {key: _run_inline(job) for key, job in jobs.items()}
+
+    pool = get_pool()
+    context = log.current_context()
+    futures = {
+        pool.submit(run_job, context, method, args, kwargs): key
+        for key, (method, args, kwargs) in jobs.items()
+    }
+
+    results = {}
+    lost = []
+    for future in as_completed(futures):
+        key = futures[future]
+        try:
+            results[key] = (future.result(), None)
+        except BrokenProcessPool:
+            lost.append(key)
+        except Exception as e:
+            results[key] = (None, e)
+
+    if not lost:
+        return results
+
+    reset_pool(pool)
+    for key in set(lost) & set(once):
+        lost.remove(key)
+        results[key] = (None, _stopped_error())
+
+    if lost:
+        logger.warning('PDF worker stopped, retrying %d job(s) one per process', len(lost))
+        with ThreadPoolExecutor(max_workers=settings.PDF_WORKER_PROCESSES) as threads:
+            for key, outcome in zip(lost, threads.map(lambda key: _run_alone(jobs[key], context), lost)):
+                results[key] = outcome
+    return results
+
+
+def _run_inline(job):
+    method, args, kwargs = job
+    try:
+        return (getattr(SimplePDFEditor(), method)(*args, **kwargs), None)
+    except Exception as e:
+        return (None, e)
+
+
+def _run_alone(job, context):
+    method, args, kwargs = job
+    executor = _new_executor(1)
+    try:
+        return (executor.submit(run_job, context, method, args, kwargs).result(), None)
+    except BrokenProcessPool:
+        return (None, _stopped_error())
+    except Exception as e:
+        return (None, e)
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)